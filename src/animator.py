@@ -1,9 +1,23 @@
-from Tkinter import *
+try:
+    from Tkinter import *
+except ImportError:
+    # Tkinter is only needed to display animations. FrameRenderer draws them without it.
+    Tk = None
 import time
-import copy
 import util
 
+# Maximum number of frames per second drawn when sliding the cars that move in an iteration.
+MAX_FRAME_RATE = 30
+
+
 class Animator:
+    """
+    Animates a simulation on a Tkinter canvas. Each position with cars is drawn as one car widget (pointing in the
+    direction of the first car in the queue, and coloured by the cost of the queue) with a label of the number of cars.
+    After each iteration, only the positions that a car left or entered are redrawn, so the cost of animating an
+    iteration depends on the number of moves rather than on the size of the board or the number of cars.
+    """
+
     def __init__(self, size, num_roads, num_cars, high_cost, my_car):
         # TODO Replace fixed_cost with high_cost.
         self.num_roads = num_roads
@@ -23,15 +37,20 @@ class Animator:
         self.canvas_width = self.board_width + self.stats_width
         self.canvas_height = self.board_height
 
+        if Tk is None:
+            raise Exception('Animating the simulation requires Tkinter (or see render_filename).')
         self.master = Tk()
         self.canvas = Canvas(self.master, width=self.canvas_width, height=self.canvas_height)
         self.canvas.pack()
 
         self.iteration_time = 0.2
 
+        # The widgets drawn at each position, and the state of the queue that they show:
+        # * car_board and car_labels hold the car widget and label widget at each position (None if it is empty).
+        # * car_directions holds the direction of the car widget at each position.
         self.car_board = [[None] * self.num_roads for _ in xrange(self.num_roads)]
         self.car_labels = [[None] * self.num_roads for _ in xrange(self.num_roads)]
-        self.prev_board = None
+        self.car_directions = [[None] * self.num_roads for _ in xrange(self.num_roads)]
 
         self.stats_round_id = None
         self.stats_iteration_id = None
@@ -59,23 +78,17 @@ class Animator:
         return self.offset + (self.step_size * road_id) + (object_offset / 2)
 
     def _getCarColor(self, cost):
-        cost_color_value = 255 - int(min(1, float(cost) / self.cost_cutoff) * 200)
-        cost_color = '#%02x%02x%02x' % (0, 0, cost_color_value)
-        return cost_color
-
-    def _createCar(self, row_id, col_id, cost, car_queue):
-        if self.prev_board is not None:
-            cost = sum([self.prev_board[row_id][col_id][i].priority + self.fixed_cost
-                        for i in xrange(1, len(self.prev_board[row_id][col_id]))])
+        return '#%02x%02x%02x' % util.getQueueColor(cost, self.cost_cutoff)
+
+    def _getCarCost(self, car):
+        return car.priority + self.fixed_cost
+
+    def _isMyCarAt(self, row_id, col_id):
+        return self.my_car is not None and self.my_car.position is not None and \
+               self.my_car.position[0] == row_id and self.my_car.position[1] == col_id
+
+    def _createCar(self, row_id, col_id, cost, direction, is_my_car=False):
         cost_color = self._getCarColor(cost)
-        circle_car = False
-        if circle_car:
-            car_size = 10
-            return self.canvas.create_oval(self._coord(row_id, -car_size), self._coord(col_id, -car_size),
-                                                self._coord(row_id, car_size), self._coord(col_id, car_size),
-                                                fill=cost_color, outline=cost_color, width=car_size)
-
-        direction = car_queue[0].direction
         car_size = 40 # min(1, float(cost) / self.cost_cutoff) * 30 + 30
         if direction == 'up':
             polygon = self.canvas.create_polygon(self._coord(row_id, -car_size), self._coord(col_id, car_size),
@@ -95,12 +108,56 @@ class Animator:
                                               self._coord(row_id, -car_size), self._coord(col_id, 0), fill=cost_color)
 
         # Make my_car look special.
-        if self.my_car is not None and self.my_car.position is not None and \
-                        self.my_car.position[0] == row_id and self.my_car.position[1] == col_id:
+        if is_my_car:
             self.canvas.itemconfig(polygon, fill='red')
 
         return polygon
 
+    def _drawPosition(self, row_id, col_id, num_cars, cost, direction):
+        """
+        Redraws the widgets at a position to show a queue, reusing the existing widgets where possible.
+        :param num_cars: Number of cars in the queue (0 to remove the widgets).
+        :param cost: Total cost of the cars in the queue.
+        :param direction: Direction of the first car in the queue.
+        """
+        car = self.car_board[row_id][col_id]
+        label = self.car_labels[row_id][col_id]
+        if num_cars == 0:
+            if car is not None:
+                self.canvas.delete(car)
+                self.canvas.delete(label)
+                self.car_board[row_id][col_id] = None
+                self.car_labels[row_id][col_id] = None
+            return
+
+        is_my_car = self._isMyCarAt(row_id, col_id)
+        if car is not None and self.car_directions[row_id][col_id] == direction:
+            # Only the colour and count of the queue changed.
+            self.canvas.itemconfig(car, fill='red' if is_my_car else self._getCarColor(cost))
+            self.canvas.itemconfig(label, text='%d' % num_cars)
+            return
+
+        if car is not None:
+            self.canvas.delete(car)
+            self.canvas.delete(label)
+        self.car_board[row_id][col_id] = self._createCar(row_id, col_id, cost, direction, is_my_car)
+        self.car_labels[row_id][col_id] = self.canvas.create_text(self._coord(row_id), self._coord(col_id),
+                                                                  text='%d' % num_cars, fill='white', justify=CENTER)
+        self.car_directions[row_id][col_id] = direction
+
+    def _drawQueue(self, board, position):
+        """
+        Redraws the widgets at a position to show the queue at that position in the board.
+        """
+        queue = board[position[0]][position[1]]
+        self._drawPosition(position[0], position[1], len(queue), sum([self._getCarCost(car) for car in queue]),
+                           queue[0].direction if len(queue) > 0 else None)
+
+    def _sleepUntil(self, deadline):
+        delay = deadline - time.time()
+        if delay > 0:
+            time.sleep(delay)
+
     def initAnimation(self, protocol_name, car_class_name):
         # Draw road network.
         for row_id in xrange(1, self.num_roads, 2):
@@ -117,7 +174,7 @@ class Animator:
             for col_id in xrange(0, self.num_roads):
                 if row_id % 2 == 0 and col_id % 2 == 0:
                     continue
-        
+
                 x = self._coord(col_id)
                 self.canvas.create_oval(x - dot_width / 2, y - dot_width / 2, x + dot_width / 2, y + dot_width / 2,
                                         fill='black', width=dot_width)
@@ -135,116 +192,82 @@ class Animator:
         self.master.update()
         time.sleep(self.iteration_time * 5)
 
-    def initRound(self, board, cost_board, round_id, total_cost):
-        # Remove existing cars.
-        [[self.canvas.delete(car) for car in car_row] for car_row in self.car_board]
-        [[self.canvas.delete(car_label) for car_label in car_label_row] for car_label_row in self.car_labels]
-        self.car_board = [[None] * self.num_roads for _ in xrange(self.num_roads)]
-        self.car_labels = [[None] * self.num_roads for _ in xrange(self.num_roads)]
-
+    def initRound(self, board, round_id, total_cost):
+        '''
+        Draws the initial state of the board of a round.
+        :param board: List of lists of queues. The queue at (x,y) represents the queue of cars at that position.
+        '''
         for row_id in xrange(self.num_roads):
             for col_id in xrange(self.num_roads):
-                if len(board[row_id][col_id]) == 0:
-                    continue
-                car = self._createCar(row_id, col_id, cost_board[row_id][col_id], board[row_id][col_id])
-                car_label = self.canvas.create_text(self._coord(row_id), self._coord(col_id),
-                                                    text='%d' % len(board[row_id][col_id]), fill='white',
-                                                    justify=CENTER)
-                self.car_board[row_id][col_id] = car
-                self.car_labels[row_id][col_id] = car_label
+                self._drawPosition(row_id, col_id, 0, 0, None)
+                self._drawQueue(board, (row_id, col_id))
 
         # Update the stats.
         self._updateStats(round_id, 0, total_cost)
 
         # Update the canvas.
         self.master.update()
-        self.prev_board = copy.deepcopy(board)
 
-    def updateAnimation(self, board, cost_board, win_next_positions, round_id, iteration_id, total_cost):
+    def updateAnimation(self, board, win_next_positions, round_id, iteration_id, total_cost):
         '''
-        Updates the canvas and displays the new state of the board for self.iteration_time seconds.
-        :param board: List of lists of queues. The queue at (x,y) represents the queue of cars at that position.
-        :param cost_board: List of lists, whose value at (x,y) represents the total cost of all cars at that position.
+        Animates the moves of an iteration, and then displays the new state of the board for self.iteration_time
+        seconds. The sliding cars are drawn at no more than MAX_FRAME_RATE frames per second, and every delay is
+        measured from a deadline, so the time spent drawing is not added to the animation time.
+        :param board: List of lists of queues after the iteration. The queue at (x,y) represents the queue of cars at
+        that position.
         :param win_next_positions: List of tuples of the form (win_position, next_position), where win_position is a
         position that won in the latest iteration, and next_position is the position to which the car there moved.
         '''
-        # Populate slide_cars with the cars that move. slide_cars is a list of tuples of the form
-        # (car widget, label widget, dx, dy).
+        start_time = time.time()
+
+        # Populate slide_cars with the cars that move, and show the win positions without them. slide_cars is a list of
+        # tuples of the form (car widget, label widget, dx, dy). The moving car is now last in the queue at
+        # next_position, and the cars left behind are the queue at win_position (except for any car that moved there).
         slide_cars = []
+        next_positions = set([next_position for _, next_position in win_next_positions])
         for win_position, next_position in win_next_positions:
-            if len(self.prev_board[win_position[0]][win_position[1]]) > 1:
-                # The win position has cars after the moving car leaves, so create a new car widget and label for the
-                # moving car.
-                car = self._createCar(win_position[0], win_position[1],
-                                      self.prev_board[win_position[0]][win_position[1]][0].priority + self.fixed_cost,
-                                      self.prev_board[win_position[0]][win_position[1]])
-                label = self.canvas.create_text(self._coord(win_position[0]), self._coord(win_position[1]), text='1',
-                                                fill='white', justify=CENTER)
-
-                # Update the car and label at the winning position.
-                cost = sum([self.prev_board[win_position[0]][win_position[1]][i].priority + self.fixed_cost
-                            for i in xrange(1, len(self.prev_board[win_position[0]][win_position[1]]))])
-                self.canvas.itemconfig(self.car_board[win_position[0]][win_position[1]],
-                                       fill=self._getCarColor(cost))
-                self.canvas.itemconfig(self.car_labels[win_position[0]][win_position[1]],
-                                       text='%d' % (len(self.prev_board[win_position[0]][win_position[1]]) - 1))
-            else:
-                # There is only one car in the win position, so move the widgets at this position.
-                car = self.car_board[win_position[0]][win_position[1]]
-                self.car_board[win_position[0]][win_position[1]] = None
-                label = self.car_labels[win_position[0]][win_position[1]]
-                self.car_labels[win_position[0]][win_position[1]] = None
-
-            dx = 0
-            dy = 0
-            direction = self.prev_board[win_position[0]][win_position[1]][0].direction
-            if direction == 'up':
-                dy = -1
-            elif direction == 'down':
-                dy = 1
-            elif direction == 'left':
-                dx = -1
-            else:
-                dx = 1
+            moving_car = board[next_position[0]][next_position[1]][-1]
+            dx = next_position[0] - win_position[0]
+            dy = next_position[1] - win_position[1]
+            direction = 'up' if dy < 0 else 'down' if dy > 0 else 'left' if dx < 0 else 'right'
+            car = self._createCar(win_position[0], win_position[1], self._getCarCost(moving_car), direction,
+                                  moving_car is self.my_car)
+            label = self.canvas.create_text(self._coord(win_position[0]), self._coord(win_position[1]), text='1',
+                                            fill='white', justify=CENTER)
             slide_cars.append((car, label, dx, dy))
 
+            queue = list(board[win_position[0]][win_position[1]])
+            if win_position in next_positions:
+                queue = queue[:-1]
+            self._drawPosition(win_position[0], win_position[1], len(queue),
+                               sum([self._getCarCost(queue_car) for queue_car in queue]),
+                               queue[0].direction if len(queue) > 0 else None)
+
         # Slide the cars that won.
-        num_slide_iterations = 100
-        slide_interval = float(self.step_size) / num_slide_iterations
-        for _ in xrange(num_slide_iterations):
-            [self.canvas.move(car, dx * slide_interval, dy * slide_interval) for car, _, dx, dy in slide_cars]
-            [self.canvas.move(label, dx * slide_interval, dy * slide_interval) for _, label, dx, dy in slide_cars]
+        num_frames = max(1, int(self.iteration_time * MAX_FRAME_RATE))
+        frame_time = float(self.iteration_time) / num_frames
+        frame_step = float(self.step_size) / num_frames
+        for frame_id in xrange(num_frames):
+            for car, label, dx, dy in slide_cars:
+                self.canvas.move(car, dx * frame_step, dy * frame_step)
+                self.canvas.move(label, dx * frame_step, dy * frame_step)
             self.master.update()
-            time.sleep(float(self.iteration_time) / num_slide_iterations)
+            self._sleepUntil(start_time + (frame_id + 1) * frame_time)
 
-        # Update the next positions to reflect the cars having finished sliding.
+        # Remove the sliding cars and labels, and show the positions that the cars moved to.
+        for car, label, _, _ in slide_cars:
+            self.canvas.delete(car)
+            self.canvas.delete(label)
         for win_position, next_position in win_next_positions:
-            if self.car_labels[next_position[0]][next_position[1]] is not None:
-                # There is already a label at next_position, so delete it.
-                self.canvas.delete(self.car_labels[next_position[0]][next_position[1]])
-                self.car_labels[next_position[0]][next_position[1]] = None
-            else:
-                # There is no car widget at next_position, so create one.
-                car = self._createCar(next_position[0], next_position[1],
-                                      cost_board[next_position[0]][next_position[1]],
-                                      board[next_position[0]][next_position[1]])
-                self.car_board[next_position[0]][next_position[1]] = car
-
-            # Create a new label with the total number of cars at next_position.
-            label = self.canvas.create_text(self._coord(next_position[0]), self._coord(next_position[1]),
-                                            text='%d' % len(board[next_position[0]][next_position[1]]),
-                                            fill='white', justify=CENTER)
-            self.car_labels[next_position[0]][next_position[1]] = label
-
-        # Remove the sliding cars and labels.
-        [self.canvas.delete(car) for car, _, _, _ in slide_cars]
-        [self.canvas.delete(label) for _, label, _, _ in slide_cars]
+            self._drawQueue(board, win_position)
+            self._drawQueue(board, next_position)
 
         # Update the stats.
         self._updateStats(round_id, iteration_id, total_cost)
 
         # Update the canvas.
         self.master.update()
-        time.sleep(self.iteration_time)
+        self._sleepUntil(start_time + 2 * self.iteration_time)
 
-        self.prev_board = copy.deepcopy(board)
\ No newline at end of file
+    def close(self):
+        self.master.destroy()
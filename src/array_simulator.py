@@ -0,0 +1,320 @@
+import numpy as np
+import util
+from car import DIRECTION_CODES, DIRECTION_STEPS
+from protocol import RandomProtocol, GreedyProtocol, GeneralizedGreedyProtocol0
+
+
+class ArrayGameState(object):
+    """
+    Alternative to GameState that stores the state of the road network in NumPy arrays (one entry per car) instead of a
+    matrix of deques of Car objects. Each iteration resolves the moves, conflicts and cost accumulation of all cars with
+    vectorized operations, which removes the per-car interpreter overhead that dominates large simulations.
+
+    An instance simulates a batch of independent rounds in lockstep, as if the board were a rounds x width x height
+    array. Positions are flattened to 'cells' (round_index * width * height + x * height + y), so cars from different
+    rounds never share a queue or compete in a conflict. Rounds whose cars have all arrived simply have no travelling
+    cars left, which masks them out of every subsequent iteration.
+
+    Only protocols whose decisions depend on nothing but the queue contents are supported (see supportsProtocol()). For
+    these protocols the car actions are never consulted, so cars are reduced to their position, priority, remaining
+    route and queue order:
+    * Queue order is stored as a 'ticket' per car. A car receives a new, larger ticket whenever it joins a queue, so the
+      first car of a queue is the one with the smallest ticket at that position.
+    * The route is stored as per-leg arrays (dx, dy, num_steps) with a cursor to the current leg.
+    """
+
+    def __init__(self, config, round_ids, cars, my_car=None):
+        """
+        :param config: An instance of the Config class used to specify simulation parameters.
+        :param round_ids: List of the IDs of the rounds to simulate.
+        :param cars: List of cars, which get a new trip in each round.
+        :param my_car: Car under investigation (or None).
+        """
+        if not ArrayGameState.supportsProtocol(config.protocol):
+            raise Exception('The array engine does not support the %s protocol.' % str(config.protocol))
+
+        self.config = config
+        self.my_car = my_car
+        self.round_ids = list(round_ids)
+        self.num_rounds = len(self.round_ids)
+        self.width = self.config.width
+        self.height = self.config.height
+        self.num_cells = self.width * self.height
+
+        # Get the round ID and car ID of each trip. Before each round, randomly shuffle a copy of the cars, which
+        # determines the queue order at each starting position.
+        trip_round_ids = []
+        trip_car_ids = []
+        my_car_indices = []
+        self.cars = cars
+        for round_id in self.round_ids:
+            self.config.seedRound(round_id)
+            round_cars = list(self.cars)
+            self.config.shuffleCars(round_id, round_cars)
+            for car in round_cars:
+                if car is my_car:
+                    my_car_indices.append(len(trip_round_ids))
+                trip_round_ids.append(round_id)
+                trip_car_ids.append(car.car_id)
+        num_cars = len(trip_round_ids)
+
+        # Initialize the per-car arrays. Cars are stored round by round, in the shuffled order of each round.
+        self.round_indices = np.repeat(np.arange(self.num_rounds), len(self.cars))
+        if self.config.common_random_numbers:
+            self._initTripsFromArrays(self.config.getCarTrips(trip_round_ids, trip_car_ids))
+        else:
+            self._initTrips([self.config.getNextCarTrip(round_id, car_id)
+                             for round_id, car_id in zip(trip_round_ids, trip_car_ids)])
+
+        # Initialize the route cursor, and the step each car takes when it moves.
+        car_ids = np.arange(num_cars)
+        self.leg_ids = np.zeros(num_cars, dtype=np.int64)
+        self.steps_left = self.leg_steps[:, 0].copy()
+        self.dx = self.leg_dx[:, 0].copy()
+        self.dy = self.leg_dy[:, 0].copy()
+
+        # Cars join their starting queue in the shuffled order.
+        self.tickets = car_ids.copy()
+        self.next_ticket = num_cars
+
+        self.travelling = (self.x != self.destination_x) | (self.y != self.destination_y)
+
+        # Index of my_car in the per-car arrays for each round (empty if there is no my_car).
+        self.my_car_ids = np.array(my_car_indices, dtype=np.int64)
+
+        # Initialize the board storing the total cost at each (round, x, y) position in the board.
+        self.cost_board = self._getCellTotals(car_ids, self.costs)
+
+        # Flattened positions of the winning cars in the latest iteration, and of the positions they moved to.
+        self.win_cells = np.zeros(0, dtype=np.int64)
+        self.next_cells = np.zeros(0, dtype=np.int64)
+
+        # Initialize the total cost, my_car cost, optimal cost, and number of cars not yet arrived in each round.
+        self.total_costs = np.zeros(self.num_rounds, dtype=np.float64)
+        self.my_car_costs = np.zeros(len(self.my_car_ids), dtype=np.float64)
+        distances = np.abs(self.x - self.destination_x) + np.abs(self.y - self.destination_y)
+        self.optimal_costs = np.bincount(self.round_indices, weights=self.costs * distances, minlength=self.num_rounds)
+        self.num_cars_travelling = np.bincount(self.round_indices[self.travelling], minlength=self.num_rounds)
+
+    def _initTrips(self, trips):
+        """
+        Initializes the position, destination, cost and route arrays of the cars from their trips.
+        :param trips: List of (origin, destination, route, priority) tuples, one per car (see
+         Configurer.getNextCarTrip()).
+        """
+        num_cars = len(trips)
+        max_num_legs = max([len(route) for _, _, route, _ in trips]) if num_cars > 0 else 1
+        self.x = np.zeros(num_cars, dtype=np.int64)
+        self.y = np.zeros(num_cars, dtype=np.int64)
+        self.destination_x = np.zeros(num_cars, dtype=np.int64)
+        self.destination_y = np.zeros(num_cars, dtype=np.int64)
+        self.costs = np.zeros(num_cars, dtype=np.float64)
+        self.leg_dx = np.zeros((num_cars, max_num_legs), dtype=np.int64)
+        self.leg_dy = np.zeros((num_cars, max_num_legs), dtype=np.int64)
+        self.leg_steps = np.zeros((num_cars, max_num_legs), dtype=np.int64)
+        self.num_legs = np.zeros(num_cars, dtype=np.int64)
+        for i, (origin, destination, route, priority) in enumerate(trips):
+            self.x[i], self.y[i] = origin
+            self.destination_x[i], self.destination_y[i] = destination
+            self.costs[i] = self.config.high_cost * priority + 1 * (1 - priority)
+            self.num_legs[i] = len(route)
+            for leg_id, (direction, num_steps) in enumerate(route):
+                self.leg_dx[i, leg_id], self.leg_dy[i, leg_id] = DIRECTION_STEPS[DIRECTION_CODES[direction]]
+                self.leg_steps[i, leg_id] = num_steps
+
+    def _initTripsFromArrays(self, trips):
+        """
+        Initializes the position, destination, cost and route arrays of the cars from the arrays of their trips (from a
+        trip table or generated in bulk), without converting the trips to Python values.
+        :param trips: Dictionary of trip arrays with one entry per car (see Configurer.getCarTrips()).
+        """
+        origins = trips['origins'].astype(np.int64)
+        destinations = trips['destinations'].astype(np.int64)
+        priorities = trips['priorities'].astype(np.float64)
+        self.num_legs = trips['num_legs'].astype(np.int64)
+        max_num_legs = max(1, int(self.num_legs.max())) if len(self.num_legs) > 0 else 1
+        leg_directions = trips['leg_directions'][:, :max_num_legs].astype(np.int64)
+        self.leg_steps = trips['leg_steps'][:, :max_num_legs].astype(np.int64)
+
+        self.x, self.y = origins[:, 0].copy(), origins[:, 1].copy()
+        self.destination_x, self.destination_y = destinations[:, 0].copy(), destinations[:, 1].copy()
+        self.costs = self.config.high_cost * priorities + 1 * (1 - priorities)
+
+        # Unused legs have no steps, and no direction.
+        direction_steps = np.array(DIRECTION_STEPS, dtype=np.int64)
+        used_legs = self.leg_steps > 0
+        self.leg_dx = np.where(used_legs, direction_steps[leg_directions, 0], 0)
+        self.leg_dy = np.where(used_legs, direction_steps[leg_directions, 1], 0)
+
+    @staticmethod
+    def supportsProtocol(protocol):
+        """
+        Returns True if the array engine can simulate the provided protocol.
+        """
+        if type(protocol) is RandomProtocol:
+            return True
+        return type(protocol) in (GreedyProtocol, GeneralizedGreedyProtocol0) and protocol.num_iterations in (0, 1)
+
+    def getCompetitiveRatios(self):
+        """
+        Returns an array with the competitive ratio of each round.
+        """
+        competitive_ratios = np.empty(self.num_rounds, dtype=np.float64)
+        competitive_ratios.fill(float('inf'))
+        has_cost = self.optimal_costs != 0
+        competitive_ratios[has_cost] = self.total_costs[has_cost] / self.optimal_costs[has_cost]
+        return competitive_ratios
+
+    def updateState(self):
+        """
+        Runs one iteration of every unfinished round. Updates self.cost_board to reflect the new state of the
+        simulation, and self.win_cells and self.next_cells with the positions of the cars that moved.
+        """
+        travelling_ids = np.flatnonzero(self.travelling)
+
+        # Increment the total weighted travel time.
+        self.total_costs += np.bincount(self.round_indices[travelling_ids], weights=self.costs[travelling_ids],
+                                        minlength=self.num_rounds)
+        self.my_car_costs += self.costs[self.my_car_ids] * self.travelling[self.my_car_ids]
+
+        # Find the first car in each queue, i.e. the car with the smallest ticket at each position.
+        cells = self._getCells(travelling_ids)
+        order = np.lexsort((self.tickets[travelling_ids], cells))
+        sorted_cells = cells[order]
+        is_first = np.ones(len(sorted_cells), dtype=bool)
+        is_first[1:] = sorted_cells[1:] != sorted_cells[:-1]
+        head_ids = travelling_ids[order[is_first]]
+
+        # Group the first cars by the position they would *like* to move to. At most two queues compete for a position.
+        next_cells = self.round_indices[head_ids] * self.num_cells + \
+                     (self.x[head_ids] + self.dx[head_ids]) * self.height + self.y[head_ids] + self.dy[head_ids]
+        order = np.argsort(next_cells, kind='mergesort')
+        head_ids = head_ids[order]
+        next_cells = next_cells[order]
+        is_conflict = np.zeros(len(head_ids), dtype=bool)
+        is_conflict[:-1] = next_cells[:-1] == next_cells[1:]
+        conflict_ids_0 = head_ids[is_conflict]
+        conflict_ids_1 = head_ids[np.roll(is_conflict, 1)]
+        is_contested = is_conflict | np.roll(is_conflict, 1)
+
+        # Resolve the conflicts. Cars without a competing queue always move.
+        position_0_wins = self._getPosition0Wins(conflict_ids_0, conflict_ids_1, cells, travelling_ids)
+        win_ids = np.concatenate((head_ids[~is_contested], conflict_ids_0[position_0_wins],
+                                  conflict_ids_1[~position_0_wins]))
+
+        # Move the winning cars to the back of the queue at their next position.
+        self.win_cells = self._getCells(win_ids)
+        self.x[win_ids] += self.dx[win_ids]
+        self.y[win_ids] += self.dy[win_ids]
+        self.next_cells = self._getCells(win_ids)
+        self.tickets[win_ids] = self.next_ticket + np.arange(len(win_ids))
+        self.next_ticket += len(win_ids)
+
+        # Advance the route cursor of cars that completed the current leg of their route.
+        self.steps_left[win_ids] -= 1
+        next_leg_ids = win_ids[(self.steps_left[win_ids] == 0) & (self.leg_ids[win_ids] + 1 < self.num_legs[win_ids])]
+        self.leg_ids[next_leg_ids] += 1
+        self.steps_left[next_leg_ids] = self.leg_steps[next_leg_ids, self.leg_ids[next_leg_ids]]
+        self.dx[next_leg_ids] = self.leg_dx[next_leg_ids, self.leg_ids[next_leg_ids]]
+        self.dy[next_leg_ids] = self.leg_dy[next_leg_ids, self.leg_ids[next_leg_ids]]
+
+        # Update the number of cars travelling and self.cost_board.
+        self.travelling[win_ids] = (self.x[win_ids] != self.destination_x[win_ids]) | \
+                                   (self.y[win_ids] != self.destination_y[win_ids])
+        travelling_ids = np.flatnonzero(self.travelling)
+        self.num_cars_travelling = np.bincount(self.round_indices[travelling_ids], minlength=self.num_rounds)
+        self.cost_board += self._getCellTotals(travelling_ids, self.costs[travelling_ids])
+
+    def _getPosition0Wins(self, ids_0, ids_1, cells, travelling_ids):
+        """
+        Determines the winner of each conflict between the queue whose first car is ids_0[i] and the queue whose first
+        car is ids_1[i].
+        :return: Boolean array, which is True where the queue of ids_0[i] wins.
+        """
+        num_conflicts = len(ids_0)
+        if type(self.config.protocol) is RandomProtocol:
+            return np.random.random(num_conflicts) < 0.5
+
+        # The greedy protocols compare the externality of letting each queue proceed, which only depends on the total
+        # cost and length of both queues, and the cost of the first car in each queue.
+        queue_costs = np.bincount(cells, weights=self.costs[travelling_ids], minlength=self.num_rounds * self.num_cells)
+        queue_lengths = np.bincount(cells, minlength=self.num_rounds * self.num_cells)
+        cells_0 = self._getCells(ids_0)
+        cells_1 = self._getCells(ids_1)
+        cost_0 = self._getExternality(queue_costs[cells_0], queue_costs[cells_1], self.costs[ids_1],
+                                      queue_lengths[cells_1])
+        cost_1 = self._getExternality(queue_costs[cells_1], queue_costs[cells_0], self.costs[ids_0],
+                                      queue_lengths[cells_0])
+
+        # Winner is the position with a lower cost. Ties are broken randomly.
+        return (cost_0 < cost_1) | ((cost_0 == cost_1) & (np.random.random(num_conflicts) < 0.5))
+
+    def _getExternality(self, queue_costs, competing_queue_costs, competing_first_costs, competing_queue_lengths):
+        """
+        Vectorized equivalent of the externality computed by Protocol._getOptimalWinPosition() with num_iterations
+        equal to 0 or 1. The externality of a queue starts at the cost of the competing queue. When simulating one
+        iteration, the RandomProtocol lets the competing queue proceed with probability 0.5, in which case the queue
+        faces a new conflict with the rest of the competing queue. If it wins that conflict (comparing the cost of the
+        rest of the competing queue with its own cost), the cost of the rest of the competing queue is added.
+        """
+        externalities = competing_queue_costs.copy()
+        if self.config.protocol.num_iterations == 0:
+            return externalities
+
+        num_conflicts = len(queue_costs)
+        remaining_costs = competing_queue_costs - competing_first_costs
+        proceeds = (remaining_costs < queue_costs) | \
+                   ((remaining_costs == queue_costs) & (np.random.random(num_conflicts) < 0.5))
+        competing_proceeded = np.random.random(num_conflicts) < 0.5
+        add_remaining_cost = competing_proceeded & (competing_queue_lengths > 1) & proceeds
+        externalities[add_remaining_cost] += remaining_costs[add_remaining_cost]
+        return externalities
+
+    def isEnd(self):
+        """
+        Determines if all rounds are over (i.e. if all cars have reached their destinations).
+        :return: True if all rounds are over.
+        """
+        return not np.any(self.num_cars_travelling)
+
+    @property
+    def win_next_positions(self):
+        """
+        List of tuples of the form (win_position, next_position), where win_position is a position that won in the
+        latest iteration, and next_position is the position to which the car there moved. Positions are (round_index,
+        x, y) tuples.
+        """
+        return [(self._getPosition(win_cell), self._getPosition(next_cell))
+                for win_cell, next_cell in zip(self.win_cells.tolist(), self.next_cells.tolist())]
+
+    def printState(self, iteration_id):
+        """
+        Prints the number of cars at each position in the board of each unfinished round.
+        :param iteration_id: Iteration ID number.
+        """
+        if util.VERBOSE >= 2:
+            counts = self._getCellTotals(np.arange(len(self.x))).astype(np.int64)
+            for round_index, round_id in enumerate(self.round_ids):
+                if iteration_id == 0 or self.num_cars_travelling[round_index] > 0:
+                    util.printBoardCounts(counts[round_index].tolist(), round_id, iteration_id)
+
+    def _getCells(self, car_ids):
+        """
+        Returns the flattened (round_index * width * height + x * height + y) positions of the provided cars.
+        """
+        return self.round_indices[car_ids] * self.num_cells + self.x[car_ids] * self.height + self.y[car_ids]
+
+    def _getPosition(self, cell):
+        """
+        Returns the (round_index, x, y) position of the provided cell.
+        """
+        round_index, cell = divmod(cell, self.num_cells)
+        return round_index, cell / self.height, cell % self.height
+
+    def _getCellTotals(self, car_ids, weights=None):
+        """
+        Returns a rounds x width x height array with the number of provided cars at each position, or the sum of their
+        weights if weights is not None.
+        """
+        totals = np.bincount(self._getCells(car_ids), weights=weights, minlength=self.num_rounds * self.num_cells)
+        return totals.reshape((self.num_rounds, self.width, self.height))
@@ -0,0 +1,374 @@
+#!/usr/bin/python
+"""
+Benchmark suite for the simulator and the protocols. Some sample use cases are listed below:
+
+Run every benchmark and print the results as JSON:
+python benchmark.py
+
+Write the results to a file, then compare a later run against them:
+python benchmark.py --output=<path_to_file.json>
+python benchmark.py --compare=<path_to_file.json>
+
+Run a subset of the benchmarks on smaller workloads:
+python benchmark.py --benchmarks=tick,decision --quick
+
+The benchmarks are:
+* tick: iterations (GameState.updateState() calls) per second on generated grids, with the random protocol so that only
+  the simulator is measured.
+* decision: latency of Protocol.getWinPosition() for every protocol in util.PROTOCOL_CLASS_NAMES.
+* end_to_end: rounds per second of Simulator.run() on the configs/*.csv scenarios and on generated large grids.
+
+The JSON output has the format:
+{"format_version": 1, "environment": {...}, "results": [{"benchmark": ..., "name": ..., "params": {...},
+ "metrics": {...}}, ...]}
+Results are identified by their (benchmark, name) pair, which is the same across commits.
+"""
+
+from __future__ import print_function
+import glob
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+from optparse import OptionParser
+import numpy as np
+import util
+from configurer import *
+from simulator import *
+
+# Version of the JSON format of the results.
+BENCHMARK_FORMAT_VERSION = 1
+
+# Names of the benchmarks, in the order in which they run.
+BENCHMARK_NAMES = ('tick', 'decision', 'end_to_end')
+
+# Metrics for which a larger value is better. For all other metrics, a smaller value is better.
+HIGHER_IS_BETTER_METRICS = ('ticks_per_second', 'rounds_per_second', 'decisions_per_second')
+
+# Metrics compared by --compare (the others, e.g. counts, depend on how long the benchmark ran).
+COMPARED_METRICS = ('ticks_per_second', 'rounds_per_second', 'mean_decision_us', 'median_decision_us')
+
+# Generated grids of the tick and end_to_end benchmarks as (num_roads, num_cars) pairs, and the smaller grids used with
+# --quick.
+GRIDS = ((3, 40), (10, 400), (20, 2000))
+QUICK_GRIDS = ((3, 40), (6, 150))
+
+# Grid of the decision benchmark as a (num_roads, num_cars) pair.
+DECISION_GRID = (3, 40)
+QUICK_DECISION_GRID = (2, 20)
+
+
+class DecisionTimer(object):
+    """
+    Wraps the getWinPosition() method of a protocol instance to record the latency of each decision. Only the outermost
+    calls are timed, in case a protocol calls getWinPosition() again while looking ahead.
+    """
+
+    def __init__(self, protocol):
+        """
+        :param protocol: Protocol instance, whose getWinPosition() method is replaced.
+        """
+        self.latencies = []
+        self._depth = 0
+        self._getWinPosition = protocol.getWinPosition
+        protocol.getWinPosition = self.getWinPosition
+
+    def getWinPosition(self, *args):
+        self._depth += 1
+        start_time = time.time()
+        try:
+            return self._getWinPosition(*args)
+        finally:
+            self._depth -= 1
+            if self._depth == 0:
+                self.latencies.append(time.time() - start_time)
+
+
+def getConfiguration(protocol_name, num_roads, num_cars, num_rounds, random_seed, config_filename=None):
+    """
+    Returns a configuration for a benchmark, with truthful cars and no my_car.
+    :param protocol_name: Name of the protocol (see util.PROTOCOL_CLASS_NAMES).
+    :param num_roads: Number of roads in each direction (ignored if config_filename is not None).
+    :param num_cars: Number of cars (ignored if config_filename is not None).
+    :param num_rounds: Number of rounds.
+    :param random_seed: Random seed value.
+    :param config_filename: Pathname for a config file, or None to generate random trips.
+    """
+    config = Configurer(util.getProtocolClass(protocol_name), util.getCarClass('truthful'), None, num_rounds, 4.0,
+                        False, False)
+    if config_filename is not None:
+        config.configFromFile(config_filename)
+    else:
+        config.configWithArgs(num_cars, num_roads, random_seed, 0.1)
+    return config
+
+
+def runTickBenchmark(grids, min_time, random_seed):
+    """
+    Measures the number of iterations per second of GameState.updateState() with the random protocol.
+    :param grids: List of (num_roads, num_cars) pairs.
+    :param min_time: Minimum time in seconds spent measuring each grid (at least one round is simulated).
+    :param random_seed: Random seed value.
+    :return: List of results.
+    """
+    results = []
+    for num_roads, num_cars in grids:
+        config = getConfiguration('random', num_roads, num_cars, 1, random_seed)
+        cars = [config.CarClass(car_id, config.protocol) for car_id in xrange(num_cars)]
+        num_ticks = 0
+        tick_time = 0.0
+        round_id = 0
+        while round_id == 0 or tick_time < min_time:
+            config.seedRound(round_id)
+            game = GameState(config, round_id, list(cars))
+            while not game.isEnd():
+                start_time = time.time()
+                game.updateState()
+                tick_time += time.time() - start_time
+                num_ticks += 1
+            round_id += 1
+        results.append({'benchmark': 'tick',
+                        'name': 'grid_%d_roads_%d_cars' % (num_roads, num_cars),
+                        'params': {'num_roads': num_roads, 'num_cars': num_cars, 'protocol': 'random'},
+                        'metrics': {'ticks': num_ticks, 'rounds': round_id, 'seconds': tick_time,
+                                    'ticks_per_second': num_ticks / tick_time}})
+    return results
+
+
+def runSimulation(config, engine='deque'):
+    """
+    Runs Simulator.run() without printing its output.
+    :param config: Configuration of the simulation.
+    :param engine: Name of the simulation engine (see Simulator).
+    :return: (simulator, seconds) pair.
+    """
+    simulator = Simulator(config, engine)
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        start_time = time.time()
+        simulator.run()
+        run_time = time.time() - start_time
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+    return simulator, run_time
+
+
+def runCalibratedSimulation(getConfig, engine, min_time):
+    """
+    Runs a simulation of one round, then (unless one round took at least min_time seconds) a simulation of as many
+    rounds as take about min_time seconds. The first simulation also warms up caches, e.g. of the board topology.
+    :param getConfig: Function that returns a new configuration, given the number of rounds.
+    :param engine: Name of the simulation engine (see Simulator).
+    :param min_time: Target time in seconds.
+    :return: (num_rounds, simulator, seconds) of the last simulation.
+    """
+    num_rounds = 1
+    simulator, run_time = runSimulation(getConfig(num_rounds), engine)
+    if run_time < min_time:
+        num_rounds = max(1, int(min_time / max(run_time, 1e-6)))
+        simulator, run_time = runSimulation(getConfig(num_rounds), engine)
+    return num_rounds, simulator, run_time
+
+
+def runDecisionBenchmark(protocol_names, grid, min_time, random_seed):
+    """
+    Measures the latency of Protocol.getWinPosition() for each protocol.
+    :param protocol_names: List of protocol names.
+    :param grid: (num_roads, num_cars) pair.
+    :param min_time: Target time in seconds spent simulating each protocol.
+    :param random_seed: Random seed value.
+    :return: List of results.
+    """
+    results = []
+    num_roads, num_cars = grid
+    for protocol_name in protocol_names:
+        # Time the decisions of the protocol of the latest configuration.
+        timers = []
+
+        def getConfig(num_rounds):
+            config = getConfiguration(protocol_name, num_roads, num_cars, num_rounds, random_seed)
+            timers.append(DecisionTimer(config.protocol))
+            return config
+
+        num_rounds, _, _ = runCalibratedSimulation(getConfig, 'deque', min_time)
+        latencies = np.array(timers[-1].latencies) * 1e6
+        metrics = {'decisions': len(latencies), 'rounds': num_rounds}
+        if len(latencies) > 0:
+            metrics.update({'mean_decision_us': float(np.mean(latencies)),
+                            'median_decision_us': float(np.median(latencies)),
+                            'p90_decision_us': float(np.percentile(latencies, 90)),
+                            'max_decision_us': float(np.max(latencies)),
+                            'decisions_per_second': len(latencies) / (np.sum(latencies) / 1e6)})
+        results.append({'benchmark': 'decision',
+                        'name': protocol_name,
+                        'params': {'num_roads': num_roads, 'num_cars': num_cars, 'protocol': protocol_name},
+                        'metrics': metrics})
+    return results
+
+
+def runEndToEndBenchmark(config_filenames, grids, min_time, random_seed):
+    """
+    Measures the number of rounds per second of Simulator.run() with the greedy protocol, on config files and on
+    generated grids (with both engines).
+    :param config_filenames: List of pathnames of config files.
+    :param grids: List of (num_roads, num_cars) pairs.
+    :param min_time: Target time in seconds spent simulating each scenario.
+    :param random_seed: Random seed value.
+    :return: List of results.
+    """
+    scenarios = []
+    for config_filename in config_filenames:
+        name = os.path.splitext(os.path.basename(config_filename))[0]
+        scenarios.append(('config_%s' % name, {'config_filename': os.path.basename(config_filename)},
+                          config_filename, None, None, 'deque'))
+    for num_roads, num_cars in grids:
+        for engine in ('deque', 'array'):
+            scenarios.append(('grid_%d_roads_%d_cars_%s' % (num_roads, num_cars, engine),
+                              {'num_roads': num_roads, 'num_cars': num_cars},
+                              None, num_roads, num_cars, engine))
+
+    results = []
+    for name, params, config_filename, num_roads, num_cars, engine in scenarios:
+        getConfig = lambda num_rounds: getConfiguration('greedy', num_roads, num_cars, num_rounds, random_seed,
+                                                        config_filename)
+        num_rounds, simulator, run_time = runCalibratedSimulation(getConfig, engine, min_time)
+        params.update({'protocol': 'greedy', 'engine': engine})
+        results.append({'benchmark': 'end_to_end',
+                        'name': name,
+                        'params': params,
+                        'metrics': {'rounds': num_rounds, 'seconds': run_time,
+                                    'rounds_per_second': num_rounds / run_time,
+                                    'mean_cost': simulator.getMeanCost()}})
+    return results
+
+
+def getEnvironment():
+    """
+    Returns a description of the environment in which the benchmarks ran.
+    """
+    environment = {'python_version': platform.python_version(),
+                   'numpy_version': np.__version__,
+                   'platform': platform.platform(),
+                   'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                   'commit': None}
+    try:
+        environment['commit'] = subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                                        stderr=open(os.devnull, 'w')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        pass
+    return environment
+
+
+def compareResults(results, baseline_results, regression_threshold):
+    """
+    Prints the relative change of each compared metric from a baseline run.
+    :param results: List of results.
+    :param baseline_results: List of results of the baseline run.
+    :param regression_threshold: Relative slowdown above which a change is reported as a regression.
+    :return: Number of regressions.
+    """
+    baseline = dict(((result['benchmark'], result['name']), result['metrics']) for result in baseline_results)
+    num_regressions = 0
+    for result in results:
+        key = (result['benchmark'], result['name'])
+        if key not in baseline:
+            continue
+        for metric_name in COMPARED_METRICS:
+            if metric_name not in result['metrics'] or metric_name not in baseline[key]:
+                continue
+            value = result['metrics'][metric_name]
+            baseline_value = baseline[key][metric_name]
+            if baseline_value == 0:
+                continue
+            change = (value - baseline_value) / float(baseline_value)
+            slowdown = -change if metric_name in HIGHER_IS_BETTER_METRICS else change
+            status = ''
+            if slowdown > regression_threshold:
+                status = '\tREGRESSION'
+                num_regressions += 1
+            print('%s/%s %s: %.3f -> %.3f (%+.1f%%)%s' % (key[0], key[1], metric_name, baseline_value, value,
+                                                         100 * change, status), file=sys.stderr)
+    return num_regressions
+
+
+def getOptions():
+    """
+    Get command-line options and handle errors.
+    :return: Command line options and arguments.
+    """
+    parser = OptionParser()
+    parser.add_option('--benchmarks', dest='benchmarks', default=','.join(BENCHMARK_NAMES),
+                      help='comma-separated benchmarks to run: %s' % ', '.join(BENCHMARK_NAMES))
+    parser.add_option('--protocols', dest='protocols', default=','.join(util.PROTOCOL_CLASS_NAMES),
+                      help='comma-separated protocols of the decision benchmark')
+    parser.add_option('--quick', dest='quick', action='store_true',
+                      help='run on smaller grids, e.g. to check that the benchmarks work')
+    parser.add_option('--min_time', dest='min_time', type='float', default=1.0,
+                      help='time in seconds spent measuring each grid, protocol or scenario')
+    parser.add_option('--configs_dir', dest='configs_dir', default=None,
+                      help='directory of the config files of the end_to_end benchmark (default: configs)')
+    parser.add_option('-s', '--random_seed', dest='random_seed', type='int', default=0,
+                      help='seed of the generated trips')
+    parser.add_option('-o', '--output', dest='output', default=None,
+                      help='JSON file to which the results are written (default: standard output)')
+    parser.add_option('--compare', dest='compare', default=None,
+                      help='JSON file of a baseline run to compare the results to')
+    parser.add_option('--regression_threshold', dest='regression_threshold', type='float', default=0.1,
+                      help='relative slowdown from the baseline reported as a regression')
+    options, args = parser.parse_args()
+
+    benchmark_names = options.benchmarks.split(',')
+    for benchmark_name in benchmark_names:
+        if benchmark_name not in BENCHMARK_NAMES:
+            raise Exception('Unrecognized benchmark: %s' % benchmark_name)
+    options.benchmarks = benchmark_names
+    options.protocols = options.protocols.split(',')
+    for protocol_name in options.protocols:
+        util.getProtocolClass(protocol_name)
+    return options, args
+
+
+def main():
+    options, args = getOptions()
+
+    grids = QUICK_GRIDS if options.quick else GRIDS
+    decision_grid = QUICK_DECISION_GRID if options.quick else DECISION_GRID
+    configs_dir = options.configs_dir
+    if configs_dir is None:
+        configs_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'configs')
+    config_filenames = sorted(glob.glob(os.path.join(configs_dir, '*.csv')))
+
+    # Run the benchmarks.
+    results = []
+    if 'tick' in options.benchmarks:
+        results += runTickBenchmark(grids, options.min_time, options.random_seed)
+    if 'decision' in options.benchmarks:
+        results += runDecisionBenchmark(options.protocols, decision_grid, options.min_time, options.random_seed)
+    if 'end_to_end' in options.benchmarks:
+        results += runEndToEndBenchmark(config_filenames, grids, options.min_time, options.random_seed)
+
+    # Write the results.
+    output = json.dumps({'format_version': BENCHMARK_FORMAT_VERSION,
+                         'environment': getEnvironment(),
+                         'results': results}, indent=2, sort_keys=True)
+    if options.output is not None:
+        with open(options.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+    # Compare the results to a baseline run.
+    if options.compare is not None:
+        with open(options.compare, 'r') as f:
+            baseline = json.load(f)
+        if baseline.get('format_version') != BENCHMARK_FORMAT_VERSION:
+            raise Exception('Unsupported benchmark format version in: %s' % options.compare)
+        if compareResults(results, baseline['results'], options.regression_threshold) > 0:
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
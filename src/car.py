@@ -2,8 +2,26 @@ import random
 from abc import ABCMeta, abstractmethod
 
 
+# Integer codes of the directions in which a car can drive, the name of each direction, and the (dx, dy) step taken
+# when driving in each direction.
+UP, DOWN, LEFT, RIGHT = 0, 1, 2, 3
+DIRECTION_CODES = {'up': UP, 'down': DOWN, 'left': LEFT, 'right': RIGHT}
+DIRECTION_NAMES = ('up', 'down', 'left', 'right')
+DIRECTION_STEPS = ((0, -1), (0, 1), (-1, 0), (1, 0))
+
+
 class Car:
+    """
+    Base class of the cars in the simulation. Subclasses implement the car's strategy in getAction().
+
+    Cars are compact, since large simulations have many of them: the attributes are stored in __slots__ (subclasses
+    should also declare __slots__ to avoid a per-instance __dict__), and the route is stored as a tuple of legs of the
+    form (direction code, num_steps) with a cursor to the current leg, so moving a car never allocates a new route.
+    """
     __metaclass__ = ABCMeta
+    __slots__ = ('car_id', 'priority', 'position', 'destination', 'trip_num_iterations', 'protocol', 'legs', 'leg_id',
+                 'steps_left', 'step')
+
     @abstractmethod
     def getAction(self, position_0, num_cars_0, position_1, num_cars_1):
         """
@@ -24,45 +42,68 @@ class Car:
         self.car_id = car_id
         self.priority = None
         self.position = None
-        self.route = None
         self.destination = None
-        self.direction = None
         self.trip_num_iterations = None
         self.protocol = protocol
 
+        # Route of the current trip:
+        # * legs is a tuple of (direction code, num_steps) tuples.
+        # * leg_id is the index of the current leg (len(legs) once the route is completed).
+        # * steps_left is the number of steps left in the current leg.
+        # * step is the (dx, dy) step taken when moving in the current leg.
+        self.legs = ()
+        self.leg_id = 0
+        self.steps_left = 0
+        self.step = None
+
+    @property
+    def direction(self):
+        """
+        Name of the direction of the current leg ('up', 'down', 'left' or 'right'), or of the last leg once the route
+        is completed.
+        """
+        if len(self.legs) == 0:
+            return None
+        return DIRECTION_NAMES[self.legs[min(self.leg_id, len(self.legs) - 1)][0]]
+
+    @property
+    def route(self):
+        """
+        Remaining route, as a list of [direction, num_steps] lists (see Configurer.getNextCarTrip()).
+        """
+        if self.leg_id == len(self.legs):
+            return []
+        route = [[DIRECTION_NAMES[direction], num_steps] for direction, num_steps in self.legs[self.leg_id:]]
+        route[0][1] = self.steps_left
+        return route
+
     def initTrip(self, origin, destination, route, priority):
         self.position = origin
         self.destination = destination
-        self.route = route
         self.priority = priority
-        self.direction = route[0][0]
         self.trip_num_iterations = 0
+        self.legs = tuple([(DIRECTION_CODES[direction], num_steps) for direction, num_steps in route])
+        self.leg_id = 0
+        self.steps_left = self.legs[0][1]
+        self.step = DIRECTION_STEPS[self.legs[0][0]]
 
     def getNextPosition(self):
-        if len(self.route) == 0:
+        if self.leg_id == len(self.legs):
             raise Exception('Getting next position for car_id %d with empty route.' % self.car_id)
-        if self.route[0][0] == 'up':
-            return (self.position[0], self.position[1] - 1)
-        if self.route[0][0] == 'down':
-            return (self.position[0], self.position[1] + 1)
-        if self.route[0][0] == 'left':
-            return (self.position[0] - 1, self.position[1])
-        else:
-            return (self.position[0] + 1, self.position[1])
+        return self.position[0] + self.step[0], self.position[1] + self.step[1]
 
     def updatePosition(self, position):
         self.trip_num_iterations += 1
 
         if position != self.position:
-            # Decrement the current direction by 1.
-            self.route[0][1] -= 1
-            if self.route[0][1] == 0:
-                # The current direction is completed, so remove it.
-                self.route = self.route[1:]
-
-                # Update the direction, if there is a new one.
-                if len(self.route) > 0:
-                    self.direction = self.route[0][0]
+            # Decrement the steps left in the current leg by 1.
+            self.steps_left -= 1
+            if self.steps_left == 0:
+                # The current leg is completed, so move on to the next one, if there is one.
+                self.leg_id += 1
+                if self.leg_id < len(self.legs):
+                    self.steps_left = self.legs[self.leg_id][1]
+                    self.step = DIRECTION_STEPS[self.legs[self.leg_id][0]]
 
         # Update the position.
         self.position = position
@@ -70,8 +111,19 @@ class Car:
     def hasArrived(self):
         return self.position == self.destination
 
+    def getStateKey(self):
+        """
+        Returns a hashable key of the car's state that affects how the rest of its trip is simulated: its priority and
+        remaining route. The key does not include the car's position, which is given by the queue the car is in.
+        """
+        if self.leg_id == len(self.legs):
+            return self.priority,
+        return (self.priority, self.legs[self.leg_id][0], self.steps_left) + self.legs[self.leg_id + 1:]
+
 
 class RandomCar(Car):
+    __slots__ = ()
+
     def getAction(self, position_0, num_cars_0, position_1, num_cars_1):
         if self.protocol.canCarBidHigh(self.car_id):
             return random.choice([0, 1])
@@ -82,6 +134,8 @@ class RandomCar(Car):
 
 
 class TruthfulCar(Car):
+    __slots__ = ()
+
     def getAction(self, position_0, num_cars_0, position_1, num_cars_1):
         if self.protocol.canCarBidHigh(self.car_id):
             return self.priority
@@ -92,6 +146,8 @@ class TruthfulCar(Car):
 
 
 class AggressiveCar(Car):
+    __slots__ = ()
+
     def getAction(self, position_0, num_cars_0, position_1, num_cars_1):
         if self.protocol.canCarBidHigh(self.car_id):
             return 1
@@ -102,6 +158,8 @@ class AggressiveCar(Car):
 
 
 class StatisticallyAggressiveCar(Car):
+    __slots__ = ()
+
     def getAction(self, position_0, num_cars_0, position_1, num_cars_1):
         if random.random() < 1.0 / self.protocol.num_rounds_latency:
             return 1
@@ -1,6 +1,18 @@
 import random
 import numpy as np
 from collections import OrderedDict
+from trip_table import *
+from scenario import *
+
+# Multiplier used to combine the random seed and round ID into the seed of the pseudo-random number generator that
+# shuffles the cars when drawing common random numbers (see Configurer.shuffleCars()). It is a prime greater than the
+# number of rounds in any simulation, so that distinct (seed, round) pairs get distinct seeds.
+COMMON_SEED_MULTIPLIER = 1000003
+
+# Default parameters of the rollouts of MonteCarloGreedy (see Configurer.setMonteCarloParameters()).
+MONTE_CARLO_NUM_TRIALS = 3
+MONTE_CARLO_DISTANCE = 3
+MONTE_CARLO_MAX_ITERATIONS = 100
 
 class Configurer:
     """
@@ -44,10 +56,106 @@ class Configurer:
         self.width = None
         self.height = None
         self._car_trips = []
+        self._scenario = None
         self.random_seed = None
         self.high_priority_probability = 0.3
         self.filename = None
 
+        # Initialize parameters of the protocols that look ahead.
+        self.externality_cache_size = 10000
+        self.externality_node_budget = None
+        self.monte_carlo_num_trials = MONTE_CARLO_NUM_TRIALS
+        self.monte_carlo_distance = MONTE_CARLO_DISTANCE
+        self.monte_carlo_max_iterations = MONTE_CARLO_MAX_ITERATIONS
+        self.monte_carlo_paired_rollouts = False
+
+        # If True, draw each trip from its own pseudo-random number generator (see setCommonRandomNumbers()).
+        self.common_random_numbers = False
+
+        # Directory in which the trips drawn from common random numbers are cached (see setTripCacheDir()), and the trip
+        # table of this configuration, which is loaded on first use.
+        self.trip_cache_dir = None
+        self._trip_table = None
+
+        # Trips of all cars in the latest round read with getNextCarTrip() when drawing common random numbers.
+        self._round_trips_round_id = None
+        self._round_trips = None
+
+    def setExternalityCacheSize(self, externality_cache_size):
+        """
+        Sets the maximum number of externalities cached by protocols that look ahead when resolving a conflict.
+        :param externality_cache_size: Maximum number of cache entries. Set to 0 to disable the cache.
+        """
+        if externality_cache_size < 0:
+            raise Exception('externality_cache_size must be non-negative, but is: %d' % externality_cache_size)
+        self.externality_cache_size = externality_cache_size
+
+    def setExternalityNodeBudget(self, externality_node_budget):
+        """
+        Sets the maximum number of externalities that protocols that look ahead simulate to resolve a conflict. Once the
+        budget runs out, the remaining externalities of the conflict are computed with no look-ahead, which bounds the
+        time of each decision, but may change it.
+        :param externality_node_budget: Maximum number of externalities simulated per conflict, or None for no limit.
+        """
+        if externality_node_budget is not None and externality_node_budget < 1:
+            raise Exception('externality_node_budget must be at least 1, but is: %d' % externality_node_budget)
+        self.externality_node_budget = externality_node_budget
+
+    def setMonteCarloParameters(self, num_trials, distance, max_iterations, paired_rollouts=False):
+        """
+        Sets the parameters of the rollouts that MonteCarloGreedy simulates to resolve a conflict.
+        :param num_trials: Number of rollouts simulated for each position in the conflict.
+        :param distance: Distance from the intersection of the conflict within which cars are copied into a rollout.
+        :param max_iterations: Maximum number of iterations of a rollout.
+        :param paired_rollouts: If True, the rollouts of both positions in each trial draw the same pseudo-random
+         numbers, so that the difference between their costs is only due to the position that wins the conflict.
+        """
+        if num_trials < 1:
+            raise Exception('num_trials must be at least 1, but is: %d' % num_trials)
+        if distance < 0:
+            raise Exception('distance must be non-negative, but is: %d' % distance)
+        if max_iterations < 1:
+            raise Exception('max_iterations must be at least 1, but is: %d' % max_iterations)
+        self.monte_carlo_num_trials = num_trials
+        self.monte_carlo_distance = distance
+        self.monte_carlo_max_iterations = max_iterations
+        self.monte_carlo_paired_rollouts = paired_rollouts
+
+    def setCommonRandomNumbers(self, common_random_numbers):
+        """
+        Sets whether the trips of the cars are drawn from common random numbers. If True, the trip of a car in a round
+        and the order in which the cars are queued are drawn from pseudo-random number generators seeded by the random
+        seed, the round ID, and the car ID only. They do not depend on the protocol, the car classes, or on the other
+        pseudo-random numbers drawn in the simulation, so simulations of different protocols with the same random seed
+        see exactly the same trips and can be compared round by round. Requires a random seed.
+        :param common_random_numbers: True to draw trips from common random numbers.
+        """
+        self.common_random_numbers = common_random_numbers
+
+    def setTripCacheDir(self, trip_cache_dir):
+        """
+        Sets the directory in which trips drawn from common random numbers are cached. The trips of all rounds are then
+        generated once per scenario into a TripTable, which later runs with the same random seed, number of cars, number
+        of roads, number of rounds and high priority probability memory-map instead of generating the trips again.
+        Requires common random numbers (see setCommonRandomNumbers()).
+        :param trip_cache_dir: Pathname of the cache directory, or None to generate trips as they are needed.
+        """
+        self.trip_cache_dir = trip_cache_dir
+        self._trip_table = None
+
+    def getTripTable(self):
+        """
+        Returns the TripTable of this configuration, generating it on first use if it is not cached yet, or None if
+        trips are not cached (or are not drawn from common random numbers, or are read from a config file).
+        """
+        if self.trip_cache_dir is None or not self.common_random_numbers or self.config_from_file:
+            return None
+        if self._trip_table is None:
+            self._trip_table = TripTable.load(self.trip_cache_dir, self.random_seed, self.num_cars, self.num_roads,
+                                              self.num_rounds, self.high_priority_probability,
+                                              self._generateCarTrips)
+        return self._trip_table
+
     def configWithArgs(self, num_cars, num_roads, random_seed, high_priority_probability):
         """
         Set parameters that can either be specified by command-line args or from a file using values from the
@@ -74,10 +182,20 @@ class Configurer:
     def configFromFile(self, filename):
         """
         Set parameters that can either be specified by command-line args or from a file using values from the specified
-        filename
+        filename. The file is either a text config file, or a binary scenario file (see scenario.py), which is detected
+        from its contents. The trips of a binary scenario file are memory-mapped instead of loaded.
         :param filename: Pathname for a config file.
         """
         self.filename = filename
+        if isScenarioFile(filename):
+            self._scenario = Scenario(filename)
+            self.num_cars = self._scenario.num_cars
+            self.num_roads = self._scenario.num_roads
+            self.width = self._scenario.width
+            self.height = self._scenario.height
+            self._finalizeConfiguration()
+            return
+
         with open(filename, 'r') as f:
             try:
                 self.num_cars = int(f.readline().strip())
@@ -88,10 +206,8 @@ class Configurer:
             except:
                 raise Exception('Second line in config file must have the format: num_roads (int)')
 
-            # Important! Might need to multiply by 4 instead of 2 if using getRandomTurnRoute() instead of
-            # getRandomRoute().
-            self.width = self.num_roads * 2 + 1
-            self.height = self.num_roads * 2 + 1
+            self.width = getBoardSize(self.num_roads)
+            self.height = getBoardSize(self.num_roads)
 
             for line in f.readlines():
                 values = line.strip().split(' ')
@@ -99,30 +215,36 @@ class Configurer:
                     raise Exception('Line in config file must have the format: '
                                     'side (string)<space>position (int)<space>priority (int), but was:\n\t%s' % line)
                 side, position, priority = values
-                position = int(position)
-                priority = float(priority)
-                route = []
-                if side == 'top':
-                    origin = (position, 0)
-                    route.append(['down', self.height - 1])
-                    destination = (position, self.height - 1)
-                elif side == 'left':
-                    origin = (0, position)
-                    route.append(['right', self.width - 1])
-                    destination = (self.width - 1, position)
-                elif side == 'bottom':
-                    origin = (position, self.height - 1)
-                    route.append(['up', self.height - 1])
-                    destination = (position, 0)
-                elif side =='right':
-                    origin = (self.width - 1, position)
-                    route.append(['left', self.width - 1])
-                    destination = (0, position)
-                else:
-                    raise Exception('Side value in config file must be top, left, bottom, or right, but is: %s' % side)
-                self._car_trips.append((origin, destination, route, priority))
+                self._car_trips.append(getScenarioTrip(side, int(position), float(priority), self.width,
+                                                       self.height))
         self._finalizeConfiguration()
 
+    def seedRound(self, round_id):
+        """
+        Reseeds the random and numpy modules at the beginning of a round (if a random seed was specified), so that the
+        pseudo-random numbers drawn in a round only depend on the random seed and the round ID. This makes rounds
+        reproducible regardless of which rounds were simulated before, and in which process.
+        :param round_id: ID number of the round.
+        """
+        if self.random_seed is None:
+            return
+        round_seed = (self.random_seed + 7919 * (round_id + 1)) % 4294967296
+        random.seed(round_seed)
+        np.random.seed(round_seed)
+
+    def shuffleCars(self, round_id, cars):
+        """
+        Randomly shuffles the cars at the beginning of a round, which determines the order of the cars in each queue.
+        :param round_id: ID number of the round.
+        :param cars: List of cars, shuffled in place.
+        """
+        if self.common_random_numbers:
+            # Shuffle the cars in the order of their IDs, so that the order does not depend on the car classes.
+            cars.sort(key=lambda car: car.car_id)
+            random.Random(self.random_seed * COMMON_SEED_MULTIPLIER + round_id).shuffle(cars)
+        else:
+            random.shuffle(cars)
+
     def getNextCarTrip(self, round_id, car_id):
         """
         Get the starting position, destination, route from origin to destination, and priority for the trip. The
@@ -133,8 +255,18 @@ class Configurer:
         :return: origin, destination, route, priority
         """
         if self.config_from_file:
+            if self._scenario is not None:
+                return self._scenario.getTrip(car_id)
             return self._car_trips[car_id]
 
+        if self.common_random_numbers:
+            # Get the trips of all cars in the round at once, and read the trips of the other cars from there.
+            if round_id != self._round_trips_round_id:
+                self._round_trips = getTripTuples(self.getCarTrips(np.repeat(round_id, self.num_cars),
+                                                                   np.arange(self.num_cars)))
+                self._round_trips_round_id = round_id
+            return self._round_trips[car_id]
+
         # Set the random seed for pseudo-random number generation.
         if self.random_seed is not None:
             random.seed(self.random_seed + 43 * (car_id + 37 * round_id))
@@ -146,6 +278,59 @@ class Configurer:
             p=[1-self.high_priority_probability, self.high_priority_probability])
         return origin, destination, route, priority
 
+    def getCarTrips(self, round_ids, car_ids):
+        """
+        Gets the trips of a block of cars at once, as arrays. Requires common random numbers (see
+        setCommonRandomNumbers()): each trip only depends on its round ID, car ID and the configuration, so the trips
+        are the same however they are grouped into blocks, and the same as the trips returned by getNextCarTrip().
+        :param round_ids: Array of the round ID of each trip.
+        :param car_ids: Array of the car ID of each trip.
+        :return: Dictionary of trip arrays with one entry per trip (see TripTable).
+        """
+        if not self.common_random_numbers:
+            raise Exception('Getting trips in bulk requires common random numbers.')
+        round_ids = np.asarray(round_ids, dtype=np.int64)
+        car_ids = np.asarray(car_ids, dtype=np.int64)
+        if self.config_from_file:
+            if self._scenario is not None:
+                return self._scenario.getTrips(car_ids)
+            return getTripArrays([self._car_trips[car_id] for car_id in car_ids])
+        trip_table = self.getTripTable()
+        if trip_table is not None:
+            return trip_table.getTrips(round_ids, car_ids)
+        return self._generateCarTrips(round_ids, car_ids)
+
+    def _generateCarTrips(self, round_ids, car_ids):
+        """
+        Generates the trips of a block of cars from common random numbers with vectorized operations. The trips are
+        random routes with the same distribution as the routes of _getRandomRoute().
+        :param round_ids: Array of the round ID of each trip.
+        :param car_ids: Array of the car ID of each trip.
+        :return: Dictionary of trip arrays with one entry per trip (see TripTable).
+        """
+        # Each trip has a SplitMix64 stream of its own, whose state is a hash of the random seed, round ID and car ID.
+        # Draw the side, the road and the priority from the first three outputs of the stream.
+        seed_states = splitMix64(np.array([self.random_seed], dtype=np.uint64))
+        states = splitMix64(splitMix64(seed_states ^ round_ids.astype(np.uint64)) ^ car_ids.astype(np.uint64))
+        side_uniforms = getUniforms(splitMix64(states))
+        states += SPLIT_MIX_64_GAMMA
+        road_uniforms = getUniforms(splitMix64(states))
+        states += SPLIT_MIX_64_GAMMA
+        priority_uniforms = getUniforms(splitMix64(states))
+
+        # Pick a starting side: 0 = top, 1 = left, 2 = bottom, 3 = right. If the board is 3x3, cars can only start on
+        # the top or left (see _getRandomRoute()).
+        num_sides = 2 + (self.width >= 4) + (self.height >= 4)
+        sides = (side_uniforms * num_sides).astype(np.int64)
+
+        # Pick a random road on the starting side. The car goes straight along it to the opposite side of the board.
+        side_num_roads = np.array([(self.width - 2) / 4 + 1, (self.height - 2) / 4 + 1,
+                                   (self.width - 4) / 4 + 1, (self.height - 4) / 4 + 1], dtype=np.int64)
+        side_road_offsets = np.array([1, 1, 3, 3], dtype=np.int64)
+        roads = (road_uniforms * side_num_roads[sides]).astype(np.int64) * 4 + side_road_offsets[sides]
+        priorities = (priority_uniforms < self.high_priority_probability).astype(np.int8)
+        return getStraightTrips(sides, roads, priorities, self.width, self.height)
+
     def _getRandomRoute(self):
         """
         Generates a random route for a car. Cars start at a random coordinate on one of the edges of the board and
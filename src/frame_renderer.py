@@ -0,0 +1,347 @@
+import os
+import struct
+import zlib
+import numpy as np
+import util
+
+# Indices of the colours in the palette of the frames. The rest of the palette holds the shades of blue of the queues
+# (see util.getQueueColor()), starting at BLUE_INDEX with the darkest shade.
+WHITE_INDEX = 0
+BLACK_INDEX = 1
+RED_INDEX = 2
+BLUE_INDEX = 3
+MIN_BLUE = 55
+
+# Palette index of the pixels of a GIF frame that are unchanged since the previous frame (see GifWriter).
+TRANSPARENT_INDEX = 255
+
+# Bitmaps of the digits of the queue counts, 3 pixels wide and 5 pixels tall.
+DIGIT_BITMAPS = ('111101101101111', '010110010010111', '111001111100111', '111001111001111', '101101111001001',
+                 '111100111001111', '111100111101111', '111001001001001', '111101111101111', '111101111001111')
+
+# Number of pixels per pixel of a digit bitmap.
+DIGIT_SCALE = 2
+
+
+def getPalette():
+    """
+    Returns the palette of the frames, as a (256, 3) array of RGB values.
+    """
+    palette = np.zeros((256, 3), dtype=np.uint8)
+    palette[WHITE_INDEX] = (255, 255, 255)
+    palette[BLACK_INDEX] = (0, 0, 0)
+    palette[RED_INDEX] = (255, 0, 0)
+    palette[BLUE_INDEX:BLUE_INDEX + 256 - MIN_BLUE, 2] = np.arange(MIN_BLUE, 256)
+    return palette
+
+
+def writePng(filename, frame, palette):
+    """
+    Writes a frame to a PNG file with a palette.
+    :param filename: Pathname of the PNG file.
+    :param frame: 2D uint8 array of palette indices, indexed by [y, x].
+    :param palette: (256, 3) array of RGB values.
+    """
+    def getChunk(chunk_type, data):
+        return struct.pack('>I', len(data)) + chunk_type + data + \
+               struct.pack('>I', zlib.crc32(chunk_type + data) & 0xffffffff)
+
+    height, width = frame.shape
+    # Each row starts with filter type 0 (none).
+    rows = np.zeros((height, width + 1), dtype=np.uint8)
+    rows[:, 1:] = frame
+    with open(filename, 'wb') as f:
+        f.write('\x89PNG\r\n\x1a\n')
+        f.write(getChunk('IHDR', struct.pack('>IIBBBBB', width, height, 8, 3, 0, 0, 0)))
+        f.write(getChunk('PLTE', palette.tostring()))
+        f.write(getChunk('IDAT', zlib.compress(rows.tostring(), 6)))
+        f.write(getChunk('IEND', ''))
+
+
+def _getGifImageData(pixels):
+    """
+    Returns the LZW-coded image data of a GIF frame. Frames consist of long runs of the same colour, so the encoder
+    works one run at a time instead of one pixel at a time: it tracks the entries that the decoder adds to its code
+    table, and codes each run with the longest entries that repeat the run's colour. Any sequence of existing codes is
+    valid LZW, so this only gives up the compression of strings with several colours.
+    :param pixels: 1D uint8 array of palette indices.
+    :return: Image data, i.e. the LZW minimum code size followed by sub-blocks of at most 255 bytes.
+    """
+    clear_code = 256
+    end_code = 257
+    codes = [clear_code]
+    widths = [9]
+
+    # State of the decoder's code table:
+    # * next_code is the code of the next entry, and width is the current code width.
+    # * run_codes maps a colour to the list of the codes of the entries that repeat it, indexed by the number of
+    #   repetitions. Each new entry repeats the colour once more than an existing code, so the lengths are contiguous.
+    # * prev_color and prev_length describe the string of the previous code (prev_length is 0 if the string has
+    #   several colours or if there is no previous code since the last clear code).
+    next_code = end_code + 1
+    width = 9
+    run_codes = {}
+    prev_color = None
+    prev_length = 0
+    first_code = True
+
+    run_starts = np.concatenate(([0], np.flatnonzero(pixels[1:] != pixels[:-1]) + 1))
+    run_lengths = np.diff(np.concatenate((run_starts, [len(pixels)])))
+    for color, run_length in zip(pixels[run_starts].tolist(), run_lengths.tolist()):
+        while run_length > 0:
+            # Code the longest prefix of the run that has an entry.
+            color_codes = run_codes.get(color)
+            if color_codes is None:
+                color_codes = [None, color]
+                run_codes[color] = color_codes
+            length = min(run_length, len(color_codes) - 1)
+            codes.append(color_codes[length])
+            widths.append(width)
+            run_length -= length
+
+            # The decoder adds the previous string followed by the first colour of this string.
+            if not first_code:
+                if prev_length > 0 and prev_color == color and prev_length + 1 == len(color_codes):
+                    color_codes.append(next_code)
+                next_code += 1
+                if next_code == (1 << width) and width < 12:
+                    width += 1
+            first_code = False
+            prev_color = color
+            prev_length = length
+
+            if next_code >= 4095:
+                # The code table is full, so start a new one.
+                codes.append(clear_code)
+                widths.append(width)
+                next_code = end_code + 1
+                width = 9
+                run_codes = {}
+                prev_length = 0
+                first_code = True
+    codes.append(end_code)
+    widths.append(width)
+
+    # Pack the codes least significant bit first.
+    codes = np.array(codes, dtype=np.int32)
+    widths = np.array(widths, dtype=np.int32)
+    bits = ((codes[:, np.newaxis] >> np.arange(12)) & 1).astype(np.uint8)[np.arange(12) < widths[:, np.newaxis]]
+    bits = np.concatenate((bits, np.zeros(-len(bits) % 8, dtype=np.uint8)))
+    data = np.packbits(bits.reshape(-1, 8)[:, ::-1]).tostring()
+
+    sub_blocks = [chr(8)]
+    for start in xrange(0, len(data), 255):
+        sub_block = data[start:start + 255]
+        sub_blocks.append(chr(len(sub_block)) + sub_block)
+    sub_blocks.append('\x00')
+    return ''.join(sub_blocks)
+
+
+class GifWriter(object):
+    """
+    Writes frames to an animated GIF. Each frame only stores the bounding box of the pixels that changed since the
+    previous frame, and the unchanged pixels in the box are transparent, so that they form long runs that code compactly
+    (see _getGifImageData()).
+    """
+
+    def __init__(self, filename, width, height, palette, frame_delay=0.2):
+        """
+        :param filename: Pathname of the GIF file, which is overwritten if it exists.
+        :param width: Width of the frames.
+        :param height: Height of the frames.
+        :param palette: (256, 3) array of RGB values.
+        :param frame_delay: Time for which each frame is displayed, in seconds.
+        """
+        self.filename = filename
+        self.frame_delay = frame_delay
+        self._prev_frame = None
+        self._file = open(self.filename, 'wb')
+        self._file.write('GIF89a' + struct.pack('<HHBBB', width, height, 0xf7, 0, 0) + palette.tostring())
+        # Loop the animation forever.
+        self._file.write('\x21\xff\x0bNETSCAPE2.0\x03\x01\x00\x00\x00')
+
+    def writeFrame(self, frame):
+        """
+        Appends a frame to the animation.
+        :param frame: 2D uint8 array of palette indices, indexed by [y, x].
+        """
+        if self._prev_frame is None:
+            top, bottom, left, right = 0, frame.shape[0], 0, frame.shape[1]
+            pixels = frame
+        else:
+            changed_rows = np.flatnonzero((frame != self._prev_frame).any(axis=1))
+            changed_columns = np.flatnonzero((frame != self._prev_frame).any(axis=0))
+            if len(changed_rows) == 0:
+                # Repeat the previous frame with a single pixel.
+                changed_rows = changed_columns = np.zeros(1, dtype=np.int64)
+            top, bottom = changed_rows[0], changed_rows[-1] + 1
+            left, right = changed_columns[0], changed_columns[-1] + 1
+            box = frame[top:bottom, left:right]
+            pixels = np.where(box != self._prev_frame[top:bottom, left:right], box, TRANSPARENT_INDEX)
+        self._prev_frame = frame.copy()
+
+        # Keep the previous frame under this one (disposal method 1), and make TRANSPARENT_INDEX transparent.
+        self._file.write('\x21\xf9\x04' +
+                         struct.pack('<BHBB', 0x05, int(round(self.frame_delay * 100)), TRANSPARENT_INDEX, 0))
+        self._file.write('\x2c' + struct.pack('<HHHHB', left, top, right - left, bottom - top, 0))
+        self._file.write(_getGifImageData(np.ascontiguousarray(pixels).ravel()))
+
+    def close(self):
+        self._file.write('\x3b')
+        self._file.close()
+
+
+class FrameRenderer(object):
+    """
+    Headless counterpart of Animator, which draws the same road network, queues (coloured by their cost, with my_car in
+    red) and queue counts into in-memory frames instead of a Tkinter canvas. It has the same interface as Animator, and
+    writes each frame as soon as it is drawn, without sleeping: to a sequence of PNG files in a directory, or to an
+    animated GIF if filename ends with .gif.
+    """
+
+    def __init__(self, filename, size, num_roads, num_cars, high_cost, my_car):
+        """
+        :param filename: Pathname of a directory for a PNG sequence (created if it does not exist), or of a .gif file.
+        :param size: Width and height of the frames, in pixels.
+        :param num_roads: Width and height of the board.
+        :param num_cars: Number of cars in the simulation.
+        :param high_cost: Cost per iteration of a high priority car.
+        :param my_car: my_car instance, or None.
+        """
+        self.filename = filename
+        self.num_roads = num_roads
+        self.fixed_cost = util.highCostToFixedCost(high_cost)
+        self.my_car = my_car
+
+        # Use the same layout and colours as Animator.
+        self.cost_cutoff = max(num_cars / num_roads, 1)
+        self.offset = 20
+        self.step_size = (size - 2 * self.offset) / (self.num_roads - 1)
+        self.size = size
+        self.palette = getPalette()
+
+        self.gif_writer = None
+        if self.filename.endswith('.gif'):
+            self.gif_writer = GifWriter(self.filename, size, size, self.palette)
+        elif not os.path.isdir(self.filename):
+            os.makedirs(self.filename)
+
+        # Frame with the road network, on which the queues of each iteration are drawn.
+        self.background = np.full((size, size), WHITE_INDEX, dtype=np.uint8)
+
+        # Masks of the car shapes pointing in each direction, relative to the centre of the position.
+        self.car_half_size = 20
+        offsets = np.arange(-self.car_half_size, self.car_half_size + 1)
+        dy, dx = np.meshgrid(offsets, offsets, indexing='ij')
+        h = self.car_half_size
+        self.car_masks = {'up': self._getTriangleMask(dx, dy, (-h, h), (h, h), (0, -h)),
+                          'down': self._getTriangleMask(dx, dy, (-h, -h), (h, -h), (0, h)),
+                          'right': self._getTriangleMask(dx, dy, (-h, -h), (-h, h), (h, 0)),
+                          'left': self._getTriangleMask(dx, dy, (h, -h), (h, h), (-h, 0))}
+        self.digit_masks = [np.kron(np.array([int(bit) for bit in bitmap], dtype=bool).reshape(5, 3),
+                                    np.ones((DIGIT_SCALE, DIGIT_SCALE), dtype=bool)) for bitmap in DIGIT_BITMAPS]
+
+        self.round_id = None
+        self.num_frames = 0
+
+    @staticmethod
+    def _getTriangleMask(dx, dy, a, b, c):
+        """
+        Returns the mask of the pixels (dx, dy) inside the triangle with corners a, b and c.
+        """
+        def getSide(p, q):
+            return (q[0] - p[0]) * (dy - p[1]) - (q[1] - p[1]) * (dx - p[0])
+        sides = [getSide(a, b), getSide(b, c), getSide(c, a)]
+        return ((sides[0] >= 0) & (sides[1] >= 0) & (sides[2] >= 0)) | \
+               ((sides[0] <= 0) & (sides[1] <= 0) & (sides[2] <= 0))
+
+    def _coord(self, road_id):
+        return self.offset + self.step_size * road_id
+
+    def _getCarColorIndex(self, cost):
+        """
+        Returns the palette index of the colour of a queue with the given cost (see util.getQueueColor()).
+        """
+        return BLUE_INDEX + util.getQueueColor(cost, self.cost_cutoff)[2] - MIN_BLUE
+
+    def _stamp(self, frame, mask, x, y, color_index):
+        """
+        Draws a mask centred at pixel (x, y), clipped to the frame.
+        """
+        half_height = mask.shape[0] / 2
+        half_width = mask.shape[1] / 2
+        top, left = y - half_height, x - half_width
+        frame_top, frame_left = max(top, 0), max(left, 0)
+        frame_bottom = min(top + mask.shape[0], frame.shape[0])
+        frame_right = min(left + mask.shape[1], frame.shape[1])
+        if frame_top >= frame_bottom or frame_left >= frame_right:
+            return
+        clipped_mask = mask[frame_top - top:frame_bottom - top, frame_left - left:frame_right - left]
+        frame[frame_top:frame_bottom, frame_left:frame_right][clipped_mask] = color_index
+
+    def _drawCount(self, frame, x, y, count):
+        digits = [self.digit_masks[int(digit)] for digit in str(count)]
+        digit_width = 3 * DIGIT_SCALE
+        text_width = len(digits) * digit_width + (len(digits) - 1) * DIGIT_SCALE
+        left = x - text_width / 2
+        for digit_index, digit_mask in enumerate(digits):
+            digit_x = left + digit_index * (digit_width + DIGIT_SCALE) + digit_width / 2
+            self._stamp(frame, digit_mask, digit_x, y, WHITE_INDEX)
+
+    def _writeFrame(self, board, iteration_id):
+        """
+        Draws the queues of the board on the road network, and writes the frame.
+        """
+        frame = self.background.copy()
+        for row_id in xrange(self.num_roads):
+            for col_id in xrange(self.num_roads):
+                queue = board[row_id][col_id]
+                if len(queue) == 0:
+                    continue
+                x = self._coord(row_id)
+                y = self._coord(col_id)
+                if self.my_car is not None and self.my_car.position == (row_id, col_id):
+                    color_index = RED_INDEX
+                else:
+                    color_index = self._getCarColorIndex(sum([car.priority + self.fixed_cost for car in queue]))
+                self._stamp(frame, self.car_masks[queue[0].direction], x, y, color_index)
+                self._drawCount(frame, x, y, len(queue))
+
+        if self.gif_writer is not None:
+            self.gif_writer.writeFrame(frame)
+        else:
+            writePng(os.path.join(self.filename, 'round%d_iteration%05d.png' % (self.round_id, iteration_id)), frame,
+                     self.palette)
+        self.num_frames += 1
+
+    def initAnimation(self, protocol_name, car_class_name):
+        # Draw road network.
+        line_half_width = 1
+        first, last = self._coord(0), self._coord(self.num_roads - 1)
+        for road_id in xrange(1, self.num_roads, 2):
+            coord = self._coord(road_id)
+            self.background[coord - line_half_width:coord + line_half_width, first:last + 1] = BLACK_INDEX
+            self.background[first:last + 1, coord - line_half_width:coord + line_half_width] = BLACK_INDEX
+
+        # Draw intersections.
+        dot_half_width = 2
+        for row_id in xrange(0, self.num_roads):
+            y = self._coord(row_id)
+            for col_id in xrange(0, self.num_roads):
+                if row_id % 2 == 0 and col_id % 2 == 0:
+                    continue
+                x = self._coord(col_id)
+                self.background[y - dot_half_width:y + dot_half_width + 1,
+                                x - dot_half_width:x + dot_half_width + 1] = BLACK_INDEX
+
+    def initRound(self, board, round_id, total_cost):
+        self.round_id = round_id
+        self._writeFrame(board, 0)
+
+    def updateAnimation(self, board, win_next_positions, round_id, iteration_id, total_cost):
+        self._writeFrame(board, iteration_id)
+
+    def close(self):
+        if self.gif_writer is not None:
+            self.gif_writer.close()
+            self.gif_writer = None
@@ -0,0 +1,278 @@
+from __future__ import print_function
+import numpy as np
+from car import RandomCar, TruthfulCar, AggressiveCar
+from protocol import RandomProtocol, GreedyProtocol, GeneralizedGreedyProtocol0
+
+
+class MarkovEvaluator(object):
+    """
+    Alternative to Simulator that computes the expected stats of a single-intersection network (num_roads = 1) exactly,
+    instead of estimating them by simulating many rounds.
+
+    With one road in each direction, every car starts in one of two queues: A (top, driving down) or B (left, driving
+    right). In each iteration exactly one car enters the intersection, and it reaches its destination in the next
+    iteration. So the car that enters the intersection in iteration k has a cost of (k + 1) times its cost per
+    iteration, and the cost of a round only depends on the order in which the cars enter the intersection. That order is
+    a Markov chain whose state is the number of high and low priority cars left in each queue, plus the priority of the
+    first car of each queue (the cars behind it are in a uniformly random order).
+
+    Only protocols whose decisions depend on nothing but the queue contents are supported (see
+    supportsConfiguration()), so the cars' actions, and hence the car classes, do not affect the chain. These protocols
+    never reward cars, so all rewards are 0.
+    """
+
+    def __init__(self, config):
+        """
+        :param config: An instance of the Config class used to specify simulation parameters.
+        """
+        if not MarkovEvaluator.supportsConfiguration(config):
+            raise Exception('The exact evaluator only supports randomly generated single-intersection networks with '
+                            'the random and greedy protocols, but the configuration is: %s' % str(config))
+        self.config = config
+        self.high_cost = float(self.config.high_cost)
+        self.num_cars = self.config.num_cars
+
+        # Expected competitive ratio per round, and expected cost of my_car per round.
+        self.mean_cost = 0.0
+        self.my_car_mean_cost = 0.0
+
+    @staticmethod
+    def supportsConfiguration(config):
+        """
+        Returns True if the exact evaluator can compute the stats of the provided configuration.
+        """
+        if config.config_from_file or config.num_roads != 1:
+            return False
+        protocol = config.protocol
+        if type(protocol) is not RandomProtocol and \
+                not (type(protocol) in (GreedyProtocol, GeneralizedGreedyProtocol0) and
+                     protocol.num_iterations in (0, 1)):
+            return False
+        return config.CarClass in (RandomCar, TruthfulCar, AggressiveCar) and \
+            config.MyCarClass in (None, RandomCar, TruthfulCar, AggressiveCar)
+
+    def run(self):
+        """
+        Computes the expected competitive ratio per round, and the expected cost of my_car per round (if the config's
+        MyCarClass is not None).
+        """
+        if self.num_cars == 0:
+            return
+
+        # Get the expected total cost of a round given the number of high and low priority cars in each queue.
+        h_a, l_a, h_b, l_b, total_costs = self._getExpectedTotalCosts()
+
+        # Each car independently starts in queue A or B with probability 0.5, and is high priority with probability
+        # high_priority_probability, so the number of cars of each kind in each queue has a multinomial distribution.
+        p = self.config.high_priority_probability
+        probabilities = self._getMultinomialProbabilities([h_a, l_a, h_b, l_b],
+                                                          [p / 2.0, (1 - p) / 2.0, p / 2.0, (1 - p) / 2.0])
+
+        # The optimal cost of a car is its cost per iteration times its distance to its destination (2).
+        optimal_costs = 2 * (self.high_cost * (h_a + h_b) + l_a + l_b)
+        self.mean_cost = float(np.sum(probabilities * total_costs / optimal_costs))
+
+        # Cars are interchangeable, so my_car's expected cost is the expected cost of an average car.
+        if self.config.MyCarClass is not None:
+            self.my_car_mean_cost = float(np.sum(probabilities * total_costs)) / self.num_cars
+
+        print('CONFIGURATION: %s' % str(self.config))
+        print('MEAN COST: %.3f\tMY CAR COST: %.3f' % (self.getMeanCost(), self.getMyCarMeanCost()))
+
+    def getMeanCost(self):
+        return self.mean_cost
+
+    def getMeanReward(self):
+        return 0.0
+
+    def getMyCarMeanCost(self):
+        return self.my_car_mean_cost
+
+    def getMyCarMeanReward(self):
+        return 0.0
+
+    def getNumRounds(self):
+        # The stats are exact, so no rounds are simulated.
+        return 0
+
+    def _getExpectedTotalCosts(self):
+        """
+        Computes the expected total cost of a round for each possible initial state of the queues.
+        :return: (h_a, l_a, h_b, l_b, total_costs) tuple of arrays with one entry per initial state: the number of high
+         and low priority cars in queues A and B, and the expected total cost of the round.
+        """
+        # Solve the chain backwards from the state with no cars left. values[i, a, b] is the expected cost of the cars
+        # left in state i, given the priority a of the first car of queue A and b of the first car of queue B.
+        h_a, l_a, h_b, l_b, indices = self._getStates(0)
+        values = np.zeros((1, 2, 2))
+        for num_cars_left in xrange(1, self.num_cars + 1):
+            prev_indices = indices
+            prev_values = values
+            h_a, l_a, h_b, l_b, indices = self._getStates(num_cars_left)
+            values = np.zeros((len(h_a), 2, 2))
+
+            # The cars left entered the intersection after the (num_cars - num_cars_left) cars that already did.
+            iteration_id = self.num_cars - num_cars_left + 1
+            for a in (0, 1):
+                for b in (0, 1):
+                    values[:, a, b] = self._getStateValues(h_a, l_a, h_b, l_b, a, b, iteration_id, prev_indices,
+                                                           prev_values)
+
+        # Average over the priority of the first car of each queue.
+        total_costs = np.zeros(len(h_a))
+        for a in (0, 1):
+            for b in (0, 1):
+                total_costs += self._getFirstCarProbabilities(h_a, l_a, a) * \
+                    self._getFirstCarProbabilities(h_b, l_b, b) * values[:, a, b]
+        return h_a, l_a, h_b, l_b, total_costs
+
+    def _getStateValues(self, h_a, l_a, h_b, l_b, a, b, iteration_id, prev_indices, prev_values):
+        """
+        Computes the expected cost of the cars left in each of the provided states, given the priorities of the first
+        cars of the queues.
+        :param h_a, l_a, h_b, l_b: Arrays with the number of high and low priority cars in queues A and B per state.
+        :param a: Priority of the first car of queue A (ignored if queue A is empty).
+        :param b: Priority of the first car of queue B (ignored if queue B is empty).
+        :param iteration_id: Iteration in which a car enters the intersection from the provided states.
+        :param prev_indices: Map from (h_a, l_a, h_b) to the index of the state with one less car.
+        :param prev_values: Values of the states with one less car.
+        :return: Array of expected costs, with one entry per state (0 if a or b is not a possible priority).
+        """
+        n_a = h_a + l_a
+        n_b = h_b + l_b
+        cost_a = self.high_cost if a else 1.0
+        cost_b = self.high_cost if b else 1.0
+        queue_cost_a = self.high_cost * h_a + l_a
+        queue_cost_b = self.high_cost * h_b + l_b
+
+        # Find the states where the first cars can have the provided priorities.
+        possible = ((n_a == 0) | ((h_a if a else l_a) > 0)) & ((n_b == 0) | ((h_b if b else l_b) > 0))
+
+        # Probability that the first car of queue A enters the intersection.
+        win_probabilities_a = self._getWinProbabilities(queue_cost_a, queue_cost_b, cost_a, cost_b, n_a, n_b)
+        win_probabilities_a = np.where(n_b == 0, 1.0, np.where(n_a == 0, 0.0, win_probabilities_a))
+
+        # Expected cost if the first car of queue A enters the intersection. It reaches its destination in the next
+        # iteration. The next car of queue A is drawn from the cars left behind it.
+        values_a = self._getNextStateValues(h_a - a, l_a - (1 - a), h_b, l_b, 0, b, prev_indices, prev_values,
+                                            possible & (n_a > 0))
+        values_a += cost_a * (iteration_id + 1)
+
+        # Expected cost if the first car of queue B enters the intersection.
+        values_b = self._getNextStateValues(h_a, l_a, h_b - b, l_b - (1 - b), 1, a, prev_indices, prev_values,
+                                            possible & (n_b > 0))
+        values_b += cost_b * (iteration_id + 1)
+
+        values = win_probabilities_a * values_a + (1 - win_probabilities_a) * values_b
+        return np.where(possible, values, 0.0)
+
+    def _getNextStateValues(self, h_a, l_a, h_b, l_b, moved_queue, other_first_car, prev_indices, prev_values, mask):
+        """
+        Returns the values of the states reached after the first car of a queue enters the intersection, averaged over
+        the priority of the queue's next first car.
+        :param h_a, l_a, h_b, l_b: Arrays with the number of high and low priority cars left in queues A and B.
+        :param moved_queue: 0 if the car entered from queue A, 1 if it entered from queue B.
+        :param other_first_car: Priority of the first car of the queue that did not move.
+        :param prev_indices: Map from (h_a, l_a, h_b) to the index of the state with one less car.
+        :param prev_values: Values of the states with one less car.
+        :param mask: Array that is True for the states where the move is possible. Other states get a value of 0.
+        """
+        # Look up the next states (using state 0 where the move is not possible).
+        next_indices = np.where(mask, prev_indices[np.where(mask, h_a, 0), np.where(mask, l_a, 0),
+                                                   np.where(mask, h_b, 0)], 0)
+
+        values = np.zeros(len(h_a))
+        for first_car in (0, 1):
+            if moved_queue == 0:
+                probabilities = self._getFirstCarProbabilities(h_a, l_a, first_car)
+                values += probabilities * prev_values[next_indices, first_car, other_first_car]
+            else:
+                probabilities = self._getFirstCarProbabilities(h_b, l_b, first_car)
+                values += probabilities * prev_values[next_indices, other_first_car, first_car]
+        return np.where(mask, values, 0.0)
+
+    def _getWinProbabilities(self, queue_cost_a, queue_cost_b, cost_a, cost_b, n_a, n_b):
+        """
+        Returns the probability that the protocol lets the first car of queue A enter the intersection, when both queues
+        have cars.
+        :param queue_cost_a, queue_cost_b: Arrays with the total cost per iteration of the cars in queues A and B.
+        :param cost_a, cost_b: Costs per iteration of the first cars of queues A and B.
+        :param n_a, n_b: Arrays with the number of cars in queues A and B.
+        """
+        protocol = self.config.protocol
+        if type(protocol) is RandomProtocol:
+            return np.full(len(n_a), 0.5)
+
+        # The greedy protocols let the position with the lower externality win, breaking ties randomly. The externality
+        # of a position is the cost of the competing queue, plus (with one iteration of lookahead) the cost the
+        # competing queue imposes in the simulated iteration.
+        if protocol.num_iterations == 0:
+            return self._getLessThanProbabilities(queue_cost_b, queue_cost_a)
+
+        # With one iteration of lookahead, the simulated iteration is decided by RandomProtocol. If the competing queue
+        # wins it (probability 0.5) and still has cars, the simulation compares the externalities with no lookahead, and
+        # adds the competing queue's remaining cost if the simulated car proceeds.
+        rest_cost_a = queue_cost_a - cost_a
+        rest_cost_b = queue_cost_b - cost_b
+        extra_probabilities_a = 0.5 * (n_b > 1) * self._getLessThanProbabilities(rest_cost_b, queue_cost_a)
+        extra_probabilities_b = 0.5 * (n_a > 1) * self._getLessThanProbabilities(rest_cost_a, queue_cost_b)
+        win_probabilities = np.zeros(len(n_a))
+        for extra_a in (0, 1):
+            for extra_b in (0, 1):
+                probabilities = (extra_probabilities_a if extra_a else 1 - extra_probabilities_a) * \
+                    (extra_probabilities_b if extra_b else 1 - extra_probabilities_b)
+                win_probabilities += probabilities * \
+                    self._getLessThanProbabilities(queue_cost_b + extra_a * rest_cost_b,
+                                                   queue_cost_a + extra_b * rest_cost_a)
+        return win_probabilities
+
+    @staticmethod
+    def _getLessThanProbabilities(x, y):
+        """
+        Returns an array that is 1 where x < y, 0 where x > y, and 0.5 where x == y (i.e. where a random tie break
+        decides). Values within floating point error of each other are equal.
+        """
+        tolerance = 1e-9 * np.maximum(1.0, np.maximum(np.abs(x), np.abs(y)))
+        return np.where(np.abs(x - y) <= tolerance, 0.5, np.where(x < y, 1.0, 0.0))
+
+    @staticmethod
+    def _getFirstCarProbabilities(h, l, priority):
+        """
+        Returns the probability that the first car of a queue with h high and l low priority cars (in random order) has
+        the provided priority. For an empty queue, the first car is considered to have priority 0.
+        """
+        n = h + l
+        if priority:
+            return np.where(n > 0, h / np.maximum(n, 1).astype(np.float64), 0.0)
+        return np.where(n > 0, l / np.maximum(n, 1).astype(np.float64), 1.0)
+
+    @staticmethod
+    def _getStates(num_cars):
+        """
+        Enumerates the states with the provided number of cars left.
+        :return: (h_a, l_a, h_b, l_b, indices) tuple, where the first four are arrays with the number of high and low
+         priority cars in queues A and B per state, and indices maps (h_a, l_a, h_b) to the index of the state.
+        """
+        h_a, l_a, h_b = np.indices((num_cars + 1,) * 3).reshape(3, -1)
+        valid = h_a + l_a + h_b <= num_cars
+        indices = np.zeros((num_cars + 1,) * 3, dtype=np.int64)
+        indices.ravel()[valid] = np.arange(np.count_nonzero(valid))
+        h_a = h_a[valid]
+        l_a = l_a[valid]
+        h_b = h_b[valid]
+        return h_a, l_a, h_b, num_cars - h_a - l_a - h_b, indices
+
+    @staticmethod
+    def _getMultinomialProbabilities(counts, probabilities):
+        """
+        Returns the probability of each outcome of a multinomial distribution.
+        :param counts: List of arrays, with the number of draws of each category per outcome.
+        :param probabilities: List with the probability of each category.
+        """
+        num_draws = int(sum([count[0] for count in counts]))
+        log_factorials = np.concatenate(([0.0], np.cumsum(np.log(np.arange(1, num_draws + 1)))))
+        log_coefficients = log_factorials[num_draws] - sum([log_factorials[count] for count in counts])
+        results = np.exp(log_coefficients)
+        for count, probability in zip(counts, probabilities):
+            results *= probability ** count
+        return results
@@ -1,5 +1,20 @@
+import multiprocessing
 from run import *
 from simulator import *
+from markov_evaluator import *
+
+# Relative cost of simulating a round with each protocol, used to schedule the most expensive points of a sweep first.
+# Protocols that are not listed have a relative cost of 1.
+PROTOCOL_COSTS = {'generalized_greedy_2': 4,
+                  'generalized_greedy_4': 16,
+                  'generalized_greedy_6': 64,
+                  'generalized_greedy_8': 256,
+                  'random_greedy': 2,
+                  'monte_carlo_greedy': 1000}
+
+# Default max number of externalities simulated per conflict by the contexts of a plot that look ahead the furthest,
+# whose externality search is otherwise exponential in the look-ahead depth (see Configurer.setExternalityNodeBudget()).
+DEEP_EXTERNALITY_NODE_BUDGET = 1000
 
 
 class Plotter:
@@ -17,6 +32,11 @@ class Plotter:
             self.variable_step = int(self.variable_step)
 
     def runAndPlot(self, options):
+        # Reject the options of a single simulation that the points of a plot do not support, rather than ignore them.
+        for option_name in ('results_filename', 'config_filename', 'profile', 'trace_filename', 'render_filename'):
+            if getattr(options, option_name):
+                raise Exception('--%s is not supported when plotting.' % option_name)
+
         context_metric_values = []
         variable_values = [self.variable_min + (i * self.variable_step)
                            for i in xrange(1 + int((self.variable_max - self.variable_min) / self.variable_step))]
@@ -71,8 +91,8 @@ class Plotter:
                          'label': 'Greedy (Externality=2)'},
                         {'protocol': 'generalized_greedy_6', 'car': 'truthful',
                          'label': 'Greedy (Externality=3)'},
-                        # {'protocol': 'generalized_greedy_8', 'car': 'truthful',
-                        # 'label': 'Greedy (Externality=4)'},
+                        {'protocol': 'generalized_greedy_8', 'car': 'truthful',
+                         'label': 'Greedy (Externality=4)', 'externality_node_budget': DEEP_EXTERNALITY_NODE_BUDGET},
                         {'protocol': 'random', 'car': 'truthful',
                          'label': 'Random'}]
         elif options.contexts == 'rg_o_r':
@@ -85,49 +105,104 @@ class Plotter:
         else:
             raise Exception('Unrecognized context: %s' % options.contexts)
 
-        for context in contexts:
-            print 'Context: %s' % str(context)
-            metric_values = []
-            for variable_value in variable_values:
+        # Get the parameters of each point in the sweep, i.e. each (context, variable_value) pair.
+        sweep_points = []
+        for context_index, context in enumerate(contexts):
+            # Contexts may specify a default externality node budget, which --externality_node_budget overrides.
+            externality_node_budget = options.externality_node_budget
+            if externality_node_budget is None:
+                externality_node_budget = context.get('externality_node_budget')
+
+            for variable_index, variable_value in enumerate(variable_values):
+                sweep_point = {'context_index': context_index,
+                               'variable_index': variable_index,
+                               'protocol': context['protocol'],
+                               'car': context['car'],
+                               'my_car': context['my_car'] if 'my_car' in context else None,
+                               'num_cars': num_cars,
+                               'num_roads': num_roads,
+                               'num_rounds': num_rounds,
+                               'random_seed': random_seed,
+                               'high_priority_probability': high_priority_probability,
+                               'high_cost': high_cost,
+                               'force_unlimited_reward': force_unlimited_reward,
+                               'animate': options.animate,
+                               'engine': options.engine,
+                               'batch_size': options.batch_size,
+                               'externality_cache_size': options.externality_cache_size,
+                               'externality_node_budget': externality_node_budget,
+                               'monte_carlo_parameters': (options.monte_carlo_trials, options.monte_carlo_distance,
+                                                          options.monte_carlo_max_iterations,
+                                                          bool(options.monte_carlo_paired_rollouts)),
+                               'exact': options.exact,
+                               'target_ci': options.target_ci,
+                               'min_rounds': options.min_rounds,
+                               'common_random_numbers': options.common_random_numbers,
+                               'trip_cache_dir': options.trip_cache_dir,
+                               'metric_name': self.metric_name}
+
                 # Update the variable value.
-                if self.variable_name == 'num_cars':
-                    num_cars = variable_value
-                elif self.variable_name == 'num_roads':
-                    num_roads = variable_value
-                elif self.variable_name == 'high_priority_probability':
-                    high_priority_probability = variable_value
-                elif self.variable_name == 'high_cost':
-                    high_cost = variable_value
+                if self.variable_name in ('num_cars', 'num_roads', 'high_priority_probability', 'high_cost'):
+                    sweep_point[self.variable_name] = variable_value
                 else:
                     raise Exception('Unrecognized variable_name %s' % self.variable_name)
+                sweep_points.append(sweep_point)
 
-                # Set up the configurer using command-line args and randomly generated car routes.
-                config = Configurer(util.getProtocolClass(context['protocol']), util.getCarClass(context['car']),
-                                    util.getCarClass(context['my_car']) if 'my_car' in context else None,
-                                    num_rounds, high_cost, force_unlimited_reward, options.animate)
-                config.configWithArgs(num_cars, num_roads, random_seed, high_priority_probability)
-
-                # Initialize the simulator.
-                simulator = Simulator(config)
-
-                # Run the simulation.
-                simulator.run()
-
-                # Extract the metric value.
-                if self.metric_name == 'cost':
-                    metric_value = simulator.getMeanCost()
-                elif self.metric_name == 'reward':
-                    metric_value = simulator.getMeanReward()
-                elif self.metric_name == 'my_cost':
-                    metric_value = simulator.getMyCarMeanCost()
-                elif self.metric_name == 'my_reward':
-                    metric_value = simulator.getMyCarMeanReward()
-                else:
-                    raise Exception('Unrecognized metric_name %s' % self.metric_name)
-                
-                metric_values.append(metric_value)
-                
-            context_metric_values.append((context['label'], metric_values))
+        # Run the simulation for each point in the sweep. point_results maps the (context_index, variable_index) of each
+        # point to its (metric_value, num_rounds, round_metric_values) tuple (see _runSweepPoint()).
+        point_results = {}
+        if options.workers > 1:
+            if options.animate:
+                raise Exception('Animating the simulation requires a single worker.')
+
+            # Farm the points out to a pool of workers, starting with the most expensive points so that the slowest
+            # point does not start last. Gather the metric values as the points finish.
+            sweep_points.sort(key=_getSweepPointCost, reverse=True)
+            pool = multiprocessing.Pool(options.workers, initializer=_initSweepWorker)
+            try:
+                for context_index, variable_index, point_result in pool.imap_unordered(_runSweepPoint, sweep_points):
+                    print 'Finished: %s, %s=%s' % (contexts[context_index]['label'], self.variable_name,
+                                                   str(variable_values[variable_index]))
+                    point_results[(context_index, variable_index)] = point_result
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            for sweep_point in sweep_points:
+                if sweep_point['variable_index'] == 0:
+                    print 'Context: %s' % str(contexts[sweep_point['context_index']])
+                context_index, variable_index, point_result = _runSweepPoint(sweep_point)
+                point_results[(context_index, variable_index)] = point_result
+
+        for context_index, context in enumerate(contexts):
+            context_metric_values.append((context['label'], [point_results[(context_index, variable_index)][0]
+                                                             for variable_index in xrange(len(variable_values))]))
+
+        # Record the number of rounds simulated for each point, which is less than num_rounds for points that reach the
+        # target confidence interval early.
+        if options.target_ci is not None:
+            print 'Rounds simulated per %s value (target confidence interval half-width %s):' % \
+                  (self.variable_name, str(options.target_ci))
+            for context_index, context in enumerate(contexts):
+                print '%s: %s' % (context['label'], str([point_results[(context_index, variable_index)][1]
+                                                         for variable_index in xrange(len(variable_values))]))
+
+        # With common random numbers, every context sees the same trips in a round, so compare each context to the last
+        # one round by round. The paired differences have much narrower confidence intervals than the metric values.
+        if options.common_random_numbers:
+            reference_context_index = len(contexts) - 1
+            print 'Paired differences in %s vs. %s (mean +/- 95%% confidence interval half-width):' % \
+                  (self.metric_name, contexts[reference_context_index]['label'])
+            for context_index, context in enumerate(contexts[:reference_context_index]):
+                for variable_index, variable_value in enumerate(variable_values):
+                    round_metric_values = point_results[(context_index, variable_index)][2]
+                    reference_round_metric_values = point_results[(reference_context_index, variable_index)][2]
+                    if round_metric_values is None or reference_round_metric_values is None:
+                        continue
+                    statistics = getPairedDifferenceStatistics(round_metric_values, reference_round_metric_values)
+                    print '%s, %s=%s: %.4f +/- %.4f (%d rounds)' % \
+                          (context['label'], self.variable_name, str(variable_value), statistics.mean,
+                           statistics.getConfidenceHalfWidth(), statistics.count)
 
         # Compute the filename given all the parameters.
         filename = '%s_%s_vs_%s_%.1f_to_%.1f_%d' % \
@@ -141,6 +216,10 @@ class Plotter:
             filename += '_' + str(high_priority_probability)
         if self.variable_name is not 'high_cost':
             filename += '_' + str(high_cost)
+        if options.target_ci is not None:
+            filename += '_ci' + str(options.target_ci)
+        if options.common_random_numbers:
+            filename += '_crn'
         filename += '.png'
 
         self._plotVariableVsMetric(variable_values, context_metric_values, filename)
@@ -186,4 +265,71 @@ class Plotter:
         plt.xlim(xmin=variable_values[0], xmax=variable_values[-1])
         plt.savefig(util.getOutfilePathname(filename))
 
-        print('Saved file: %s' % filename)
\ No newline at end of file
+        print('Saved file: %s' % filename)
+
+def _getSweepPointCost(sweep_point):
+    """
+    Returns a rough estimate of the time it takes to run the simulation for a point of a sweep.
+    :param sweep_point: Dictionary of simulation parameters (see Plotter.runAndPlot()).
+    """
+    protocol_cost = PROTOCOL_COSTS.get(sweep_point['protocol'], 1)
+    return protocol_cost * sweep_point['num_rounds'] * sweep_point['num_cars'] * sweep_point['num_roads']
+
+
+def _initSweepWorker():
+    """
+    Initializes a worker process of Plotter.runAndPlot(). Forked workers inherit the state of the random and numpy
+    modules, so reseed them to avoid drawing the same numbers in every worker when no random seed was specified.
+    """
+    random.seed()
+    np.random.seed()
+
+
+def _runSweepPoint(sweep_point):
+    """
+    Runs the simulation for a point of a sweep.
+    :param sweep_point: Dictionary of simulation parameters (see Plotter.runAndPlot()).
+    :return: (context_index, variable_index, (metric_value, num_rounds, round_metric_values)) tuple, where num_rounds is
+     the number of rounds simulated, and round_metric_values is the list of metric values per round with common random
+     numbers (otherwise, or if the stats were computed exactly, None).
+    """
+    # Set up the configurer using command-line args and randomly generated car routes.
+    config = Configurer(util.getProtocolClass(sweep_point['protocol']), util.getCarClass(sweep_point['car']),
+                        util.getCarClass(sweep_point['my_car']), sweep_point['num_rounds'], sweep_point['high_cost'],
+                        sweep_point['force_unlimited_reward'], sweep_point['animate'])
+    config.setExternalityCacheSize(sweep_point['externality_cache_size'])
+    config.setExternalityNodeBudget(sweep_point['externality_node_budget'])
+    config.setMonteCarloParameters(*sweep_point['monte_carlo_parameters'])
+    config.setCommonRandomNumbers(sweep_point['common_random_numbers'])
+    config.setTripCacheDir(sweep_point['trip_cache_dir'])
+    config.configWithArgs(sweep_point['num_cars'], sweep_point['num_roads'], sweep_point['random_seed'],
+                          sweep_point['high_priority_probability'])
+
+    # Initialize the simulator. If requested, compute the stats exactly instead whenever the configuration allows it.
+    if sweep_point['exact'] and MarkovEvaluator.supportsConfiguration(config):
+        simulator = MarkovEvaluator(config)
+    else:
+        simulator = Simulator(config, sweep_point['engine'], sweep_point['batch_size'],
+                              target_ci=sweep_point['target_ci'], metric_name=sweep_point['metric_name'],
+                              min_rounds=sweep_point['min_rounds'],
+                              keep_round_metric_values=sweep_point['common_random_numbers'])
+
+    # Run the simulation.
+    simulator.run()
+
+    # Extract the metric value.
+    metric_name = sweep_point['metric_name']
+    if metric_name == 'cost':
+        metric_value = simulator.getMeanCost()
+    elif metric_name == 'reward':
+        metric_value = simulator.getMeanReward()
+    elif metric_name == 'my_cost':
+        metric_value = simulator.getMyCarMeanCost()
+    elif metric_name == 'my_reward':
+        metric_value = simulator.getMyCarMeanReward()
+    else:
+        raise Exception('Unrecognized metric_name %s' % metric_name)
+
+    round_metric_values = simulator.getRoundMetricValues() if isinstance(simulator, Simulator) else None
+    return sweep_point['context_index'], sweep_point['variable_index'], \
+        (metric_value, simulator.getNumRounds(), round_metric_values)
@@ -0,0 +1,111 @@
+import math
+from collections import OrderedDict
+
+# Phases of a simulation timed by a Profiler, in the order in which they are reported.
+# * round: A whole round, including all the phases below (see Simulator).
+# * trips: Getting the trips of the cars at the beginning of a round.
+# * setup: The rest of the setup of a round (e.g. shuffling the cars and filling the board).
+# * actions: Asking the cars in each conflict for their actions.
+# * decisions: Resolving conflicts with Protocol.getWinPosition(), including any look-ahead.
+# * rewards: Updating the rewards of the cars in each conflict.
+# * moves: Moving the winning cars to their next queues.
+# * next_positions: Updating the next positions of the queues whose first car changed.
+# * iterations: Whole iterations of the array engine, which does not time the phases above separately.
+PHASES = ('round', 'trips', 'setup', 'actions', 'decisions', 'rewards', 'moves', 'next_positions', 'iterations')
+
+# Number of buckets of the decision latency histograms. Bucket i counts the latencies in [2**(i-1), 2**i) microseconds,
+# bucket 0 counts the latencies under 1 microsecond, and the last bucket also counts all longer latencies.
+NUM_HISTOGRAM_BUCKETS = 32
+
+# Width of the longest bar in a histogram of the report.
+HISTOGRAM_BAR_WIDTH = 40
+
+
+class Profiler(object):
+    """
+    Accumulates the time spent in each phase of a simulation (see PHASES), and histograms of the latency of the
+    decisions of each protocol. Simulations only time their phases when they are given a Profiler, so profiling costs
+    nothing but a few checks for None when it is off.
+    """
+
+    def __init__(self):
+        # * phase_times: Key is a phase. Value is the total time spent in the phase, in seconds.
+        # * phase_counts: Key is a phase. Value is the number of times the phase was timed.
+        # * decision_histograms: Key is the name of a protocol. Value is a list of the number of decisions in each
+        #   latency bucket.
+        # * decision_times: Key is the name of a protocol. Value is the total time of its decisions, in seconds.
+        self.phase_times = dict((phase, 0.0) for phase in PHASES)
+        self.phase_counts = dict((phase, 0) for phase in PHASES)
+        self.decision_histograms = OrderedDict()
+        self.decision_times = OrderedDict()
+
+    def addTime(self, phase, seconds):
+        """
+        Adds the time spent in a phase.
+        :param phase: Name of the phase (see PHASES).
+        :param seconds: Time spent in the phase.
+        """
+        self.phase_times[phase] += seconds
+        self.phase_counts[phase] += 1
+
+    def addDecision(self, protocol_name, seconds):
+        """
+        Adds the latency of a decision of a protocol (which is also added to the time of the decisions phase).
+        :param protocol_name: Name of the protocol.
+        :param seconds: Latency of the decision.
+        """
+        self.addTime('decisions', seconds)
+        histogram = self.decision_histograms.get(protocol_name)
+        if histogram is None:
+            histogram = [0] * NUM_HISTOGRAM_BUCKETS
+            self.decision_histograms[protocol_name] = histogram
+            self.decision_times[protocol_name] = 0.0
+        histogram[min(math.frexp(seconds * 1e6)[1], NUM_HISTOGRAM_BUCKETS - 1) if seconds >= 1e-6 else 0] += 1
+        self.decision_times[protocol_name] += seconds
+
+    def merge(self, other):
+        """
+        Adds the times and decisions of another profiler (e.g. of a worker process) to this profiler.
+        :param other: Profiler instance.
+        """
+        for phase in PHASES:
+            self.phase_times[phase] += other.phase_times[phase]
+            self.phase_counts[phase] += other.phase_counts[phase]
+        for protocol_name, histogram in other.decision_histograms.iteritems():
+            if protocol_name not in self.decision_histograms:
+                self.decision_histograms[protocol_name] = [0] * NUM_HISTOGRAM_BUCKETS
+                self.decision_times[protocol_name] = 0.0
+            self.decision_histograms[protocol_name] = [count + other_count for count, other_count in
+                                                       zip(self.decision_histograms[protocol_name], histogram)]
+            self.decision_times[protocol_name] += other.decision_times[protocol_name]
+
+    def __str__(self):
+        """
+        Returns a report with the time spent in each phase, and the decision latency histogram of each protocol.
+        """
+        round_time = self.phase_times['round']
+        lines = ['%-16s%12s%12s%12s%9s' % ('Phase', 'Total (s)', 'Count', 'Mean (us)', 'Share')]
+        for phase in PHASES:
+            count = self.phase_counts[phase]
+            if count == 0:
+                continue
+            total = self.phase_times[phase]
+            share = '%.1f%%' % (100.0 * total / round_time) if round_time > 0 else ''
+            lines.append('%-16s%12.3f%12d%12.2f%9s' % (phase, total, count, 1e6 * total / count, share))
+
+        for protocol_name, histogram in self.decision_histograms.iteritems():
+            num_decisions = sum(histogram)
+            lines.append('Decision latency (%s): %d decisions, mean %.2f us' %
+                         (protocol_name, num_decisions, 1e6 * self.decision_times[protocol_name] / num_decisions))
+            max_count = max(histogram)
+            for bucket, count in enumerate(histogram):
+                if count == 0:
+                    continue
+                if bucket == 0:
+                    label = '< 1 us'
+                elif bucket == NUM_HISTOGRAM_BUCKETS - 1:
+                    label = '>= %d us' % (1 << (bucket - 1))
+                else:
+                    label = '%d-%d us' % (1 << (bucket - 1), 1 << bucket)
+                lines.append('  %16s %10d %s' % (label, count, '#' * max(1, HISTOGRAM_BAR_WIDTH * count / max_count)))
+        return '\n'.join(lines)
@@ -8,6 +8,9 @@ class Protocol(object):
     If self.fixed_actions_per_round is True, then the functions initRound() and setCarRoundAction() are called at the
     beginning of each round, and getCarRoundAction() is called instead of calling the car's getAction() when determining
     cars' actions at each conflict.
+
+    If self.independent_rounds is True, then the protocol does not carry any state (e.g. rewards) from one round to the
+    next, so rounds can be simulated independently of each other (e.g. in parallel).
     '''
     __metaclass__ = ABCMeta
 
@@ -17,6 +20,11 @@ class Protocol(object):
         self.initial_reward = 0.0
         self.unlimited_reward = config.force_unlimited_reward
         self.fixed_actions_per_round = False
+        self.independent_rounds = False
+
+        # Cache of the externalities computed when looking ahead for the current decision (see
+        # _getOptimalWinPosition()). The table is created the first time an externality is computed.
+        self.externality_table = None
 
         # Initialize a map from car_id to the car's reward.
         for car_id in xrange(self.config.num_cars):
@@ -110,6 +118,18 @@ class Protocol(object):
 
     def _getOptimalWinPosition(self, position_0, actions_0, position_1, actions_1, game_state, num_iterations=None):
         """
+        If num_iterations is not None, the winner is the position with the lower externality: the cost that letting the
+        first car of the position proceed imposes on the cars around it, estimated by simulating its neighbourhood for
+        num_iterations iterations with RandomProtocol. Whenever the simulated car reaches another conflict, the
+        externalities of both positions of that conflict are computed recursively to decide whether it proceeds.
+
+        The search is pruned without changing any decision: the cost of a simulation never decreases, so it stops as
+        soon as it exceeds the externality of the competing position, which is computed first if its lower bound (the
+        cost of the queue it competes with) is lower. Each externality is simulated with coin flips seeded by a seed
+        drawn for the decision and by the state of its neighbourhood, so it does not depend on the other externalities
+        simulated (or pruned) before it. The externalities are only cached for the decision, since the externalities of
+        other decisions are simulated with other seeds. The number of externalities simulated per conflict can be
+        limited with Configurer.setExternalityNodeBudget().
         :param num_iterations: Number of iterations to simulate when computing optimal win position.
         """
         if position_1 is None:
@@ -130,37 +150,99 @@ class Protocol(object):
             else:
                 win_position = position_1
         else:
-            def getExternality(game_state, iteration, position):
-                # Keep a pointer to the main simulation's protocol.
-                old_protocol = game_state.config.protocol
-                game_state.config.protocol = RandomProtocol(game_state.config)
+            if self.externality_table is None:
+                self.externality_table = util.TranspositionTable(self.config.externality_cache_size)
+            else:
+                self.externality_table.clear()
+
+            # Seed of the coin flips of the simulated externalities, drawn from the main simulation's generator (which
+            # is reseeded at the beginning of each round, see Configurer.seedRound()), so each decision gets its own
+            # random draws.
+            decision_seed = random.getrandbits(32)
+
+            # Count the look-ahead simulated for the conflict in the counters of the main simulation's game.
+            event_counters = game_state.event_counters
+
+            # Limit the number of externalities simulated for this conflict. search is a dictionary with the number of
+            # externalities simulated so far (num_nodes), and the number computed with no look-ahead because the budget
+            # ran out (num_truncations).
+            node_budget = self.config.externality_node_budget
+            search = {'num_nodes': 0, 'num_truncations': 0}
+
+            def getExternality(game_state, iteration, position, bound=None):
+                # Returns the externality of position, or any cost greater than bound once the externality is known to
+                # be greater than bound.
+                # The externality only depends on the cars in the neighbourhood of position that the simulation copies,
+                # so look it up by the state of that neighbourhood.
+                positions = game_state.topology.getPositionsWithinDistance(position, iteration)
+                key = (iteration, position, game_state.getStateKey(positions))
+                cost = self.externality_table.get(key)
+                if cost is not None:
+                    return cost
+
+                if node_budget is not None and search['num_nodes'] >= node_budget and iteration > 0:
+                    # The budget ran out, so compute the externality with no look-ahead.
+                    search['num_truncations'] += 1
+                    if event_counters is not None:
+                        event_counters.externality_truncations += 1
+                    return getExternality(game_state, 0, position, bound)
 
                 # Compute externality.
-                cost = getExternalityRec(game_state, iteration, position)
-
-                # Set game_state's protocol back to the original protocol.
-                game_state.config.protocol = old_protocol
+                search['num_nodes'] += 1
+                num_truncations = search['num_truncations']
+                cost, is_exact = getExternalityRec(game_state, iteration, position, positions, bound,
+                                                   random.Random(hash((decision_seed, key))))
+
+                # Only cache the externalities that were neither cut short nor computed with a truncated look-ahead.
+                if is_exact and search['num_truncations'] == num_truncations:
+                    self.externality_table.put(key, cost)
                 return cost
 
-            def getExternalityRec(curr_game_state, num_iterations, position):
-                # Create a copy of the game that will be simulated using RandomProtocol.
-                game = curr_game_state.getCopy(position, num_iterations)
-
-                my_car = game.board[position[0]][position[1]][0]
-                if my_car.hasArrived():
-                    return 0
-
-                competing_position = util.getCompetingPosition(position)
-                cost = util.getQueueCost(game.board[competing_position[0]][competing_position[1]],
-                                         self.config.high_cost)
-                self_cost = util.getCarCost(game.board[position[0]][position[1]][0], self.config.high_cost)
-                self_queue_cost = util.getQueueCost(game.board[position[0]][position[1]], self.config.high_cost)
+            def getExternalities(game_state, iteration, position_a, position_b):
+                # Returns the externalities of two competing positions. The externality of the position with the smaller
+                # lower bound is computed first, and bounds the search of the other, so the larger externality may only
+                # be a partial cost (which is still larger than the other externality).
+                competing_positions = game_state.topology.competing_positions
+                if game_state.getQueueCost(competing_positions[position_b]) < \
+                        game_state.getQueueCost(competing_positions[position_a]):
+                    externality_b = getExternality(game_state, iteration, position_b)
+                    externality_a = getExternality(game_state, iteration, position_a, externality_b)
+                else:
+                    externality_a = getExternality(game_state, iteration, position_a)
+                    externality_b = getExternality(game_state, iteration, position_b, externality_a)
+                return externality_a, externality_b
+
+            def getExternalityRec(curr_game_state, num_iterations, position, positions, bound, node_random):
+                # Returns the cost, and whether it is exact (False if the search stopped because the cost exceeded
+                # bound).
+                # Extract the neighbourhood of position into a game that will be simulated using RandomProtocol (see
+                # RolloutState).
+                game = curr_game_state.getRolloutState(positions)
+                game.random = node_random
+                if event_counters is not None:
+                    event_counters.externality_calls += 1
+                    event_counters.copied_cars += game.num_cars
+
+                my_car = game.getFirstCar(position)
+                if game.hasArrived(my_car):
+                    return 0, True
+
+                topology = game.topology
+                competing_position = topology.competing_positions[position]
+                cost = game.getQueueCost(competing_position)
+                self_queue_cost = game.getQueueCost(position)
 
                 # Force my_car to win in the first iteration.
                 force_win = True
                 force_lose = False
 
                 for curr_iteration in xrange(num_iterations):
+                    # The cost never decreases, so stop as soon as it exceeds the bound.
+                    if bound is not None and cost > bound:
+                        if event_counters is not None:
+                            event_counters.externality_cutoffs += 1
+                        return cost, False
+
                     # Simulate one iteration of the game. If this is the first simulated round, let position_a win.
                     if force_win:
                         game.updateState(automatic_win_position=position)
@@ -171,48 +253,44 @@ class Protocol(object):
                     force_win = False
                     force_lose = False
 
-                    if my_car.hasArrived():
+                    if game.hasArrived(my_car):
                         break
 
                     # If the car is not first in a queue, the cost is infinite.
-                    if game.board[my_car.position[0]][my_car.position[1]][0] is not my_car:
+                    my_car_position = game.getCarPosition(my_car)
+                    if game.getFirstCar(my_car_position) != my_car:
                         # return float('inf')
                         cost += self_queue_cost
                         continue
 
                     # If the car is is in conflict with a non-empty queue, determine whether it proceeds or waits for an
                     # iteration.
-                    if not util.isIntersection(my_car.position):
-                        competing_position = util.getCompetingPosition(my_car.position)
-                        if util.isInBounds(competing_position, game.board) and \
-                                        len(game.board[competing_position[0]][competing_position[1]]) > 0:
+                    if not topology.intersections[my_car_position]:
+                        competing_position = topology.competing_positions[my_car_position]
+                        if topology.isInBounds(competing_position) and game.getQueueLength(competing_position) > 0:
                             # Car is in a conflict with a non-empty queue.
 
                             # NOTE: Uncommenting the following addition to cost improves results, but does not have an
                             # intuitive theoretical justification.
-                            # cost += util.getQueueCost(game.board[competing_position[0]][competing_position[1]],
-                            #                           game.config.high_cost)
+                            # cost += game.getQueueCost(competing_position)
                             # continue
 
-                            externality = getExternality(game, num_iterations - curr_iteration - 1, my_car.position)
-                            competing_externality = getExternality(game, num_iterations - curr_iteration - 1,
-                                                                   competing_position)
+                            externality, competing_externality = getExternalities(
+                                game, num_iterations - curr_iteration - 1, my_car_position, competing_position)
 
                             if externality > competing_externality or \
-                                    (externality == competing_externality and random.choice([True, False])):
+                                    (externality == competing_externality and node_random.choice([True, False])):
                                 # Car remains where it is.
                                 force_lose = True
                                 continue
                             else:
                                 # Car proceeds. Add the cost of the competing queue.
                                 force_win = True
-                                cost += util.getQueueCost(game.board[competing_position[0]][competing_position[1]],
-                                                          game.config.high_cost)
+                                cost += game.getQueueCost(competing_position)
 
-                return cost
+                return cost, True
 
-            position_0_cost = getExternality(game_state, num_iterations, position_0)
-            position_1_cost = getExternality(game_state, num_iterations, position_1)
+            position_0_cost, position_1_cost = getExternalities(game_state, num_iterations, position_0, position_1)
 
             # Winner is the position with a lower cost. Ties are broken randomly.
             if position_0_cost < position_1_cost or \
@@ -233,6 +311,7 @@ class RandomProtocol(Protocol):
         super(RandomProtocol, self).__init__(config)
         # Set reward to unlimited in order to make everything completely random.
         self.unlimited_reward = True
+        self.independent_rounds = True
 
     def getWinPosition(self, position_0, actions_0, position_1, actions_1, game_state):
         if position_1 is None:
@@ -373,6 +452,7 @@ class GreedyProtocol(Protocol):
         super(GreedyProtocol, self).__init__(config)
         # Set reward to unlimited in order so that cars can always report truthfully.
         self.unlimited_reward = True
+        self.independent_rounds = True
         self.num_iterations = num_iterations
 
     def getWinPosition(self, position_0, actions_0, position_1, actions_1, game_state):
@@ -472,6 +552,7 @@ class MonteCarloGreedy(GreedyProtocol):
         super(GreedyProtocol, self).__init__(config)
         # Set reward to unlimited in order so that cars can always report truthfully.
         self.unlimited_reward = True
+        self.independent_rounds = True
         self.num_iterations = num_iterations
 
     def getWinPosition(self, position_0, actions_0, position_1, actions_1, game_state):
@@ -485,26 +566,24 @@ class MonteCarloGreedy(GreedyProtocol):
         elif len(actions_1) > 0 and len(actions_0) == 0:
             return position_1
 
-        num_trials = 3
-        distance = 3
-        max_iterations = 100
-
-        def simulate(game_state, distance, max_iterations, position):
-            # Create a copy of the game that will be simulated using RandomProtocol.
-            intersection_position = util.getNextPosition(position, 1)
-
-            # Keep a pointer to the main simulation's protocol.
-            old_protocol = game_state.config.protocol
-            game_state.config.protocol = RandomProtocol(game_state.config)
+        num_trials = self.config.monte_carlo_num_trials
+        distance = self.config.monte_carlo_distance
+        max_iterations = self.config.monte_carlo_max_iterations
+
+        def simulate(game_state, distance, max_iterations, position, rollout_random=None):
+            # Extract the neighbourhood of the intersection into a game that will be simulated using RandomProtocol (see
+            # RolloutState). If rollout_random is not None, the coin flips of the simulation are drawn from it.
+            intersection_position = game_state.topology.next_positions[position]
+            game = game_state.getRolloutState(game_state.getRolloutPositions(intersection_position, distance,
+                                                                             centered=True))
+            if rollout_random is not None:
+                game.random = rollout_random
+            if game_state.event_counters is not None:
+                game_state.event_counters.monte_carlo_rollouts += 1
+                game_state.event_counters.copied_cars += game.num_cars
 
             # Compute cost of a simulation.
-            game = game_state.getCopy(intersection_position, distance, centered=True)
-            cost = getSimulationCost(game, max_iterations, position)
-
-            # Set game_state's protocol back to the original protocol.
-            game_state.config.protocol = old_protocol
-
-            return cost
+            return getSimulationCost(game, max_iterations, position)
 
         def getSimulationCost(game, max_iterations, position):
             if game.isEnd():
@@ -522,10 +601,25 @@ class MonteCarloGreedy(GreedyProtocol):
 
             return game.getCompetitiveRatio()
 
-        position_0_cost = sum([simulate(game_state, distance, max_iterations, position_0)
-                               for _ in xrange(num_trials)]) / num_trials
-        position_1_cost = sum([simulate(game_state, distance, max_iterations, position_1)
-                               for _ in xrange(num_trials)]) / num_trials
+        if self.config.monte_carlo_paired_rollouts:
+            # Simulate the rollouts of both positions in each trial from the same pseudo-random numbers (common random
+            # numbers), so that the noise the two rollouts share cancels out when comparing their costs. The seed of
+            # each trial is drawn from the main simulation's generator.
+            trial_seeds = [random.getrandbits(32) for _ in xrange(num_trials)]
+            position_0_cost = 0.0
+            position_1_cost = 0.0
+            for trial_seed in trial_seeds:
+                position_0_cost += simulate(game_state, distance, max_iterations, position_0,
+                                            random.Random(trial_seed))
+                position_1_cost += simulate(game_state, distance, max_iterations, position_1,
+                                            random.Random(trial_seed))
+            position_0_cost /= num_trials
+            position_1_cost /= num_trials
+        else:
+            position_0_cost = sum([simulate(game_state, distance, max_iterations, position_0)
+                                   for _ in xrange(num_trials)]) / num_trials
+            position_1_cost = sum([simulate(game_state, distance, max_iterations, position_1)
+                                   for _ in xrange(num_trials)]) / num_trials
 
         # Winner is the position with a lower cost. Ties are broken randomly.
         if position_0_cost < position_1_cost or \
@@ -0,0 +1,167 @@
+import csv
+import math
+
+# Number of standard errors in the half-width of a 95% confidence interval (normal approximation).
+CONFIDENCE_95_Z = 1.96
+
+
+class RunningStatistics(object):
+    """
+    Mean and variance of a stream of values, updated one value at a time with Welford's algorithm. This uses constant
+    memory, and unlike accumulating sums of values and squared values, it does not lose precision on long streams.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        # Sum of squared differences from the current mean.
+        self._m2 = 0.0
+
+    def add(self, value):
+        """
+        Adds a value to the stream.
+        :param value: Float value.
+        """
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self._m2 += delta * (value - self.mean)
+
+    def getVariance(self):
+        """
+        Returns the sample variance of the values (0 if there are fewer than two values).
+        """
+        if self.count < 2:
+            return 0.0
+        return self._m2 / (self.count - 1)
+
+    def getStandardDeviation(self):
+        """
+        Returns the sample standard deviation of the values.
+        """
+        return math.sqrt(self.getVariance())
+
+    def getConfidenceHalfWidth(self, z=CONFIDENCE_95_Z):
+        """
+        Returns the half-width of the confidence interval of the mean, i.e. the mean is within
+        [self.mean - half_width, self.mean + half_width] with the confidence given by z (95% by default).
+        :param z: Number of standard errors in the half-width.
+        :return: Float half-width (infinite if there are fewer than two values).
+        """
+        if self.count < 2:
+            return float('inf')
+        return z * math.sqrt(self.getVariance() / self.count)
+
+
+def getPairedDifferenceStatistics(values, reference_values):
+    """
+    Returns the statistics of the differences between paired values, e.g. the per-round costs of two protocols simulated
+    with common random numbers. Pairing cancels the variance the two simulations share, so the confidence interval of
+    the mean difference is usually much narrower than the confidence intervals of the two means.
+    :param values: List of values.
+    :param reference_values: List of reference values. If the lists have different lengths (e.g. simulations that
+     stopped early), only the pairs of the shorter list are used.
+    :return: RunningStatistics of value - reference_value.
+    """
+    statistics = RunningStatistics()
+    for value, reference_value in zip(values, reference_values):
+        statistics.add(value - reference_value)
+    return statistics
+
+
+class EventCounters(object):
+    """
+    Counts of the events in a round of a simulation, which explain how the cost of simulating a round scales (e.g. with
+    the size of the board or the look-ahead of a protocol):
+    * conflicts: Number of conflicts resolved, i.e. of queues whose first car asked to move.
+    * contested_conflicts: Number of conflicts between two non-empty queues.
+    * externality_calls: Number of externalities simulated by look-ahead protocols (see
+      Protocol._getOptimalWinPosition()), not counting the ones found in the externality cache.
+    * externality_cutoffs: Number of externalities whose simulation stopped early, because their cost already exceeded
+      the externality of the competing position.
+    * externality_truncations: Number of externalities simulated with no look-ahead, because the node budget of the
+      decision ran out (see Configurer.setExternalityNodeBudget()).
+    * monte_carlo_rollouts: Number of rollouts simulated by MonteCarloGreedy.
+    * copied_cars: Number of cars copied into the games simulated when looking ahead (see
+      GameState.getRolloutState()).
+    * max_queue_length: Maximum number of cars in any queue of the board.
+    """
+    NAMES = ('conflicts', 'contested_conflicts', 'externality_calls', 'externality_cutoffs', 'externality_truncations',
+             'monte_carlo_rollouts', 'copied_cars', 'max_queue_length')
+
+    def __init__(self):
+        self.conflicts = 0
+        self.contested_conflicts = 0
+        self.externality_calls = 0
+        self.externality_cutoffs = 0
+        self.externality_truncations = 0
+        self.monte_carlo_rollouts = 0
+        self.copied_cars = 0
+        self.max_queue_length = 0
+
+    def merge(self, other):
+        """
+        Adds the counts of another round to these counts (the maximum queue length is the maximum of both).
+        :param other: EventCounters instance.
+        """
+        for name in self.NAMES:
+            if name == 'max_queue_length':
+                self.max_queue_length = max(self.max_queue_length, other.max_queue_length)
+            else:
+                setattr(self, name, getattr(self, name) + getattr(other, name))
+
+    def getValues(self):
+        """
+        Returns the list of counts, in the order of NAMES.
+        """
+        return [getattr(self, name) for name in self.NAMES]
+
+    def __str__(self):
+        return '\t'.join(['%s: %d' % (name, getattr(self, name)) for name in self.NAMES])
+
+
+class ResultsWriter(object):
+    """
+    Writes the stats of each round of a simulation to a CSV file as soon as the round finishes, so that the results of
+    a run can be post-processed (even while the run is in progress) without keeping them in memory. The file has one
+    header line with the column names, followed by one line per round. The my_car columns are empty if there is no
+    my_car, and the event counter columns (see EventCounters) are empty if the engine does not count events.
+    """
+    COLUMNS = ('round_id', 'cost', 'reward', 'my_car_cost', 'my_car_reward') + EventCounters.NAMES
+
+    # Number of rounds written between flushes of the file.
+    FLUSH_INTERVAL = 1000
+
+    def __init__(self, filename):
+        """
+        :param filename: Pathname of the CSV file, which is overwritten if it exists.
+        """
+        self.filename = filename
+        self._file = open(self.filename, 'wb')
+        self._writer = csv.writer(self._file)
+        self._writer.writerow(self.COLUMNS)
+        self._num_unflushed_rounds = 0
+
+    def writeRound(self, round_id, cost, reward, my_car_cost, my_car_reward, event_counters=None):
+        """
+        Appends the stats of a round to the file.
+        :param round_id: Round ID number.
+        :param cost: Competitive ratio of the round.
+        :param reward: Total reward after the round.
+        :param my_car_cost: Cost of my_car in the round (None if there is no my_car).
+        :param my_car_reward: Reward of my_car after the round (None if there is no my_car).
+        :param event_counters: EventCounters of the round (None if the engine does not count events).
+        """
+        if event_counters is not None:
+            counts = event_counters.getValues()
+        else:
+            counts = [''] * len(EventCounters.NAMES)
+        self._writer.writerow([round_id] + [repr(value) if value is not None else ''
+                                            for value in (cost, reward, my_car_cost, my_car_reward)] + counts)
+        self._num_unflushed_rounds += 1
+        if self._num_unflushed_rounds >= self.FLUSH_INTERVAL:
+            self._file.flush()
+            self._num_unflushed_rounds = 0
+
+    def close(self):
+        self._file.close()
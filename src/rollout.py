@@ -0,0 +1,256 @@
+import random
+from car import DIRECTION_STEPS
+
+
+class RolloutState(object):
+    """
+    Minimal game used by the protocols that look ahead (e.g. MonteCarloGreedy and the generalized greedy protocols) to
+    simulate a small neighbourhood of the board with RandomProtocol. Building and stepping a GameState for every rollout
+    copies Car objects, allocates deques, and asks each car for an action and the protocol for each decision, even
+    though RandomProtocol only flips a coin in each contested conflict. A RolloutState only stores what such a rollout
+    depends on, in flat lists with one entry per car:
+    * The queue contents, as a dictionary whose key is a 'cell' (x * height + y) and whose value is the list of the
+      indices of the cars in the queue, in queue order.
+    * The priority, remaining route (as in Car: the legs, the index of the current leg and the steps left in it) and
+      destination cell of each car.
+
+    Only the cells that hold cars are stored, so the cost of a rollout depends on the number of cars in the
+    neighbourhood rather than on the size of the board. Use GameState.getRolloutState() to extract a neighbourhood.
+    """
+
+    def __init__(self, config, topology):
+        """
+        Initializes a game without cars (see addCar()).
+        :param config: Configurer instance.
+        :param topology: Topology of the board (see util.getTopology()).
+        """
+        self.config = config
+        self.topology = topology
+        self.width = topology.width
+        self.height = topology.height
+
+        # Change of the cell of a car when it moves in each direction (see car.DIRECTION_STEPS).
+        self._cell_steps = tuple([dx * self.height + dy for dx, dy in DIRECTION_STEPS])
+
+        # Key is a cell. Value is the list of the indices of the cars in the queue at the cell.
+        self.queues = {}
+
+        # Initialize the per-car lists:
+        # * priorities, legs, leg_ids, steps_left and destinations describe the trip of each car (see Car).
+        # * costs is the cost of each car per iteration.
+        # * cells is the cell of each car, and cell_steps is the change of its cell when it moves.
+        # * arrived is True for each car that has reached its destination.
+        self.priorities = []
+        self.legs = []
+        self.leg_ids = []
+        self.steps_left = []
+        self.destinations = []
+        self.costs = []
+        self.cells = []
+        self.cell_steps = []
+        self.arrived = []
+        self.num_cars = 0
+
+        # Initialize the number and cost of the cars travelling, the total cost and the optimal cost.
+        self.num_cars_travelling = 0
+        self.travelling_cost = 0.0
+        self.total_cost = 0.0
+        self.optimal_cost = 0
+
+        # Source of the coin flips of RandomProtocol: the random module, or a random.Random instance (e.g. to make a
+        # rollout only depend on its own seed).
+        self.random = random
+
+    def getCell(self, position):
+        return position[0] * self.height + position[1]
+
+    def getPosition(self, cell):
+        return cell // self.height, cell % self.height
+
+    def addCar(self, cell, priority, legs, leg_id, steps_left, destination):
+        """
+        Adds a car to the end of the queue at a cell.
+        :param cell: Cell of the car.
+        :param priority: Priority of the car.
+        :param legs: Tuple of the (direction code, num_steps) legs of the car's route (see Car).
+        :param leg_id: Index of the car's current leg.
+        :param steps_left: Number of steps left in the car's current leg.
+        :param destination: Cell of the car's destination.
+        """
+        car = self.num_cars
+        self.num_cars += 1
+        queue = self.queues.get(cell)
+        if queue is None:
+            self.queues[cell] = [car]
+        else:
+            queue.append(car)
+
+        cost = self.config.high_cost * priority + 1 * (1 - priority)
+        self.priorities.append(priority)
+        self.legs.append(legs)
+        self.leg_ids.append(leg_id)
+        self.steps_left.append(steps_left)
+        self.destinations.append(destination)
+        self.costs.append(cost)
+        self.cells.append(cell)
+        self.cell_steps.append(self._cell_steps[legs[leg_id][0]] if leg_id < len(legs) else 0)
+        self.arrived.append(cell == destination)
+        if cell != destination:
+            self.num_cars_travelling += 1
+            self.travelling_cost += cost
+
+        # The optimal cost assumes that the car can drive through other cars (see util.getCarOptimalCost()).
+        self.optimal_cost += cost * (abs(cell // self.height - destination // self.height) +
+                                     abs(cell % self.height - destination % self.height))
+
+    def getRolloutState(self, positions):
+        """
+        Returns a new game containing the cars at the provided positions, which can be simulated without affecting this
+        game (see GameState.getRolloutState()).
+        :param positions: Iterable of (x,y) positions. Positions that are out of bounds are ignored.
+        :return: RolloutState instance.
+        """
+        rollout_state = RolloutState(self.config, self.topology)
+        for x, y in positions:
+            if 0 <= x < self.width and 0 <= y < self.height:
+                cell = x * self.height + y
+                for car in self.queues.get(cell, ()):
+                    rollout_state.addCar(cell, self.priorities[car], self.legs[car], self.leg_ids[car],
+                                         self.steps_left[car], self.destinations[car])
+        return rollout_state
+
+    def getFirstCar(self, position):
+        """
+        Returns the index of the first car in the queue at position, or None if the queue is empty.
+        """
+        queue = self.queues.get(self.getCell(position))
+        if not queue:
+            return None
+        return queue[0]
+
+    def getCarPosition(self, car):
+        return self.getPosition(self.cells[car])
+
+    def getCarCost(self, car):
+        return self.costs[car]
+
+    def hasArrived(self, car):
+        return self.arrived[car]
+
+    def getQueueLength(self, position):
+        return len(self.queues.get(self.getCell(position), ()))
+
+    def getQueueCost(self, position):
+        """
+        Returns the total cost of the cars in the queue at position (see util.getQueueCost()).
+        """
+        return sum([self.costs[car] for car in self.queues.get(self.getCell(position), ())])
+
+    def getCompetitiveRatio(self):
+        if self.optimal_cost == 0:
+            return float('inf')
+        return self.total_cost / self.optimal_cost
+
+    def isEnd(self):
+        return self.num_cars_travelling == 0
+
+    def getStateKey(self, positions):
+        """
+        Returns the same key of the state of the queues at the provided positions as GameState.getStateKey(), so keys
+        of RolloutStates and GameStates can be compared.
+        :param positions: Iterable of (x,y) positions. Positions that are out of bounds are ignored.
+        """
+        key = []
+        for position in sorted(positions):
+            if not (0 <= position[0] < self.width and 0 <= position[1] < self.height):
+                continue
+            queue = self.queues.get(position[0] * self.height + position[1])
+            if queue:
+                car_keys = tuple([self._getCarStateKey(car) for car in queue if not self.arrived[car]])
+                if len(car_keys) > 0:
+                    key.append((position, car_keys))
+        return tuple(key)
+
+    def _getCarStateKey(self, car):
+        """
+        Returns the same key of the state of a car as Car.getStateKey().
+        """
+        legs = self.legs[car]
+        leg_id = self.leg_ids[car]
+        if leg_id == len(legs):
+            return self.priorities[car],
+        return (self.priorities[car], legs[leg_id][0], self.steps_left[car]) + legs[leg_id + 1:]
+
+    def updateState(self, automatic_win_position=None, automatic_lose_position=None):
+        """
+        Runs one iteration of the game with RandomProtocol: the first car of each queue moves if its queue is the only
+        one that wants to move into the next cell, and otherwise a coin flip picks the queue whose first car moves.
+
+        The automatic positions have the same effect as in GameState.updateState(). NOTE: There, the protocol still
+        resolves the conflict of automatic_win_position, and the queue at automatic_lose_position wins its conflict, so
+        only automatic_lose_position affects the iteration.
+
+        The conflicts are resolved in increasing order of the cell that the cars want to move into, and the first
+        position of each conflict (which wins the coin flip if self.random.random() < 0.5, as in RandomProtocol) is the
+        one with the lower cell, so the rollout only depends on the state of the pseudo-random number generator.
+        """
+        queues = self.queues
+        arrived = self.arrived
+        cell_steps = self.cell_steps
+        lose_cell = self.getCell(automatic_lose_position) if automatic_lose_position is not None else None
+
+        # Increment the total weighted travel time.
+        self.total_cost += self.travelling_cost
+
+        # Group the queues whose first car is travelling by the cell into which the car would like to move.
+        conflicts = {}
+        for cell, queue in queues.iteritems():
+            if queue and not arrived[queue[0]]:
+                next_cell = cell + cell_steps[queue[0]]
+                cells = conflicts.get(next_cell)
+                if cells is None:
+                    conflicts[next_cell] = [cell]
+                else:
+                    cells.append(cell)
+
+        # Resolve the conflicts. Each conflict lets exactly one queue move.
+        moves = []
+        for next_cell in sorted(conflicts):
+            cells = conflicts[next_cell]
+            if len(cells) == 1:
+                win_cell = cells[0]
+            elif lose_cell is not None and lose_cell in cells:
+                win_cell = lose_cell
+            elif self.random.random() < 0.5:
+                win_cell = min(cells)
+            else:
+                win_cell = max(cells)
+            moves.append((win_cell, next_cell))
+
+        # Move the first car of each winning queue, and update its route.
+        for cell, next_cell in moves:
+            queue = queues[cell]
+            car = queue.pop(0)
+            if len(queue) == 0:
+                del queues[cell]
+            next_queue = queues.get(next_cell)
+            if next_queue is None:
+                queues[next_cell] = [car]
+            else:
+                next_queue.append(car)
+            self.cells[car] = next_cell
+
+            self.steps_left[car] -= 1
+            if self.steps_left[car] == 0:
+                # The current leg is completed, so move on to the next one, if there is one.
+                legs = self.legs[car]
+                leg_id = self.leg_ids[car] + 1
+                self.leg_ids[car] = leg_id
+                if leg_id < len(legs):
+                    self.steps_left[car] = legs[leg_id][1]
+                    cell_steps[car] = self._cell_steps[legs[leg_id][0]]
+
+            if next_cell == self.destinations[car]:
+                arrived[car] = True
+                self.num_cars_travelling -= 1
+                self.travelling_cost -= self.costs[car]
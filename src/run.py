@@ -8,6 +8,10 @@ python run.py --num_cars=10 --num_roads=5 --num_rounds=10 --protocol=vcg --car=t
 Load a simulation configuration from a file:
 python run.py --config_filename=<path_to_file.txt> --num_rounds=10
 
+Load a simulation configuration from a binary scenario file (convert a config file with scenario.py):
+python scenario.py <path_to_file.txt> <path_to_file.scenario>
+python run.py --config_filename=<path_to_file.scenario> --num_rounds=10
+
 Generate a plot (either num_cars vs. total_cost, or num_roads vs. total_cost):
 python run.py --plot_road_simulations --num_cars=10 --num_rounds=10
 python run.py --plot_car_simulations --num_roads=10 --num_rounds=10
@@ -16,6 +20,19 @@ Other flags that can be combined with any of the use cases listed above:
 --random_seed=<int value>
 --high_cost=<float greater than or equal to 1.0>
 --unlimited_reward
+--engine=<deque or array>
+--batch_size=<int value, requires --engine=array>
+--workers=<int value>
+--externality_cache_size=<int value>
+--externality_node_budget=<int value>
+--monte_carlo_trials=<int value>, --monte_carlo_distance=<int value>, --monte_carlo_max_iterations=<int value>
+--monte_carlo_paired_rollouts
+--exact
+--results_filename=<path_to_file.csv, not when plotting>
+--target_ci=<float value, num_rounds is then the max number of rounds>
+--min_rounds=<int value, requires --target_ci>
+--common_random_numbers (requires --random_seed)
+--trip_cache_dir=<path_to_dir, requires --common_random_numbers>
 
 """
 
@@ -23,6 +40,7 @@ import util
 from configurer import *
 from plotter import *
 from simulator import *
+from markov_evaluator import *
 from optparse import OptionParser
 
 def getOptions():
@@ -49,7 +67,7 @@ def getOptions():
     parser.add_option('--high_priority_probability', dest='high_priority_probability', type='float', default=0.1,
                       help='fixed cost per car per iteration')
     parser.add_option('--config_filename', dest='config_filename', default=None,
-                      help='pathname for file specifying the board configuration')
+                      help='pathname for file specifying the board configuration (text config or binary scenario)')
     parser.add_option('--plot', dest='plot', action='store_true',
                       help='generate a plot of variable_name vs. metric_name')
     parser.add_option('--contexts', dest='contexts',
@@ -72,6 +90,48 @@ def getOptions():
                       help='display an animation of the simulation')
     parser.add_option('--print_board', dest='print_board', action='store_true',
                       help='print the state of the board in each iteration of the simulation')
+    parser.add_option('--engine', dest='engine', default='deque',
+                      help='simulation engine: deque (supports all protocols), array (faster, random and greedy only)')
+    parser.add_option('--batch_size', dest='batch_size', type='int', default=1,
+                      help='number of rounds the array engine simulates together')
+    parser.add_option('--workers', dest='workers', type='int', default=1,
+                      help='number of processes across which rounds (or the points of a plot) are simulated')
+    parser.add_option('--externality_cache_size', dest='externality_cache_size', type='int', default=10000,
+                      help='max number of externalities cached by the generalized greedy protocols (0 to disable)')
+    parser.add_option('--externality_node_budget', dest='externality_node_budget', type='int', default=None,
+                      help='max number of externalities the generalized greedy protocols simulate per conflict, beyond '
+                           'which they stop looking ahead (no limit by default)')
+    parser.add_option('--monte_carlo_trials', dest='monte_carlo_trials', type='int', default=MONTE_CARLO_NUM_TRIALS,
+                      help='number of rollouts simulated by monte_carlo_greedy for each position in a conflict')
+    parser.add_option('--monte_carlo_distance', dest='monte_carlo_distance', type='int', default=MONTE_CARLO_DISTANCE,
+                      help='distance from the conflict within which cars are copied into a monte_carlo_greedy rollout')
+    parser.add_option('--monte_carlo_max_iterations', dest='monte_carlo_max_iterations', type='int',
+                      default=MONTE_CARLO_MAX_ITERATIONS,
+                      help='max number of iterations of a monte_carlo_greedy rollout')
+    parser.add_option('--monte_carlo_paired_rollouts', dest='monte_carlo_paired_rollouts', action='store_true',
+                      help='simulate the monte_carlo_greedy rollouts of both positions in a conflict from common '
+                           'random numbers')
+    parser.add_option('--exact', dest='exact', action='store_true',
+                      help='compute the expected stats exactly instead of simulating (num_roads=1, random and greedy '
+                           'only)')
+    parser.add_option('--results_filename', dest='results_filename',
+                      help='CSV file to which the stats of each round are written as the simulation runs')
+    parser.add_option('--target_ci', dest='target_ci', type='float', default=None,
+                      help='stop once the 95% confidence interval half-width of the metric (metric_name, or cost by '
+                           'default) is at most this value, simulating at most num_rounds rounds')
+    parser.add_option('--min_rounds', dest='min_rounds', type='int', default=MIN_TARGET_CI_ROUNDS,
+                      help='min number of rounds simulated before stopping early with --target_ci')
+    parser.add_option('--common_random_numbers', dest='common_random_numbers', action='store_true',
+                      help='draw the same trips for every protocol and car class with the same random seed, and report '
+                           'paired differences between the contexts of a plot')
+    parser.add_option('--trip_cache_dir', dest='trip_cache_dir', default=None,
+                      help='directory in which the trips drawn from common random numbers are cached across runs')
+    parser.add_option('--trace_filename', dest='trace_filename', default=None,
+                      help='file to which a compact trace of the simulation is written (see simulation_trace.py)')
+    parser.add_option('--render_filename', dest='render_filename', default=None,
+                      help='render the animation without a display, to PNG files in this directory or to a .gif file')
+    parser.add_option('--profile', dest='profile', action='store_true',
+                      help='time each phase of the simulation and the decisions of the protocol, and print a report')
     parser.add_option('-u', '--force_unlimited_reward', dest='force_unlimited_reward', action='store_true',
                       help='initialize cars with infinite reward so they can signal high priority whenever desired')
     options, args = parser.parse_args()
@@ -100,14 +160,27 @@ def main():
         configuration = Configurer(util.getProtocolClass(options.protocol), util.getCarClass(options.car_class_name),
                                    util.getCarClass(options.my_car_class_name), options.num_rounds, options.high_cost,
                                    options.force_unlimited_reward, options.animate)
+        configuration.setExternalityCacheSize(options.externality_cache_size)
+        configuration.setExternalityNodeBudget(options.externality_node_budget)
+        configuration.setMonteCarloParameters(options.monte_carlo_trials, options.monte_carlo_distance,
+                                              options.monte_carlo_max_iterations,
+                                              bool(options.monte_carlo_paired_rollouts))
+        configuration.setCommonRandomNumbers(options.common_random_numbers)
+        configuration.setTripCacheDir(options.trip_cache_dir)
         if options.config_filename:
             configuration.configFromFile(options.config_filename)
         else:
             configuration.configWithArgs(options.num_cars, options.num_roads, options.random_seed,
                                          options.high_priority_probability)
 
-        # Initialize the simulator.
-        simulator = Simulator(configuration)
+        # Initialize the simulator, or the exact evaluator for single-intersection networks.
+        if options.exact:
+            simulator = MarkovEvaluator(configuration)
+        else:
+            simulator = Simulator(configuration, options.engine, options.batch_size, options.workers,
+                                  options.results_filename, options.target_ci, options.metric_name or 'cost',
+                                  options.min_rounds, profile=options.profile,
+                                  trace_filename=options.trace_filename, render_filename=options.render_filename)
 
         # Run the simulation.
         simulator.run()
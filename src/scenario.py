@@ -0,0 +1,202 @@
+#!/usr/bin/python
+"""
+Binary scenario files, a compact alternative to text config files for scenarios with very many cars.
+
+Convert a text config file (see Configurer.configFromFile()) to a binary scenario file:
+python scenario.py <path_to_file.txt> <path_to_file.scenario>
+
+A binary scenario file has a fixed-size header, followed by one fixed-size record per car:
+* Header: the magic string SCENARIO_MAGIC, then the format version (uint32), number of roads (uint32) and number of cars
+  (uint64), all little-endian.
+* Records: side (int8 index into SIDES), position (int32) and priority (float64), all little-endian and packed.
+The records are memory-mapped, so loading a scenario does not read or parse the trips until they are used.
+"""
+
+import sys
+import numpy as np
+from trip_table import getStraightTrips
+
+# Magic string at the start of every binary scenario file.
+SCENARIO_MAGIC = 'SCENARIO'
+
+# Version of the binary scenario format.
+SCENARIO_VERSION = 1
+
+# Layout of the header and of the per-car records of a binary scenario file.
+SCENARIO_HEADER_DTYPE = np.dtype([('magic', 'S8'), ('version', '<u4'), ('num_roads', '<u4'), ('num_cars', '<u8')])
+SCENARIO_RECORD_DTYPE = np.dtype([('side', 'i1'), ('position', '<i4'), ('priority', '<f8')])
+
+# Sides of the board from which cars can start, indexed by the side field of the records.
+SIDES = ('top', 'left', 'bottom', 'right')
+
+# Number of records buffered in memory when converting a text config file.
+CONVERT_BLOCK_SIZE = 1 << 16
+
+
+def isScenarioFile(filename):
+    """
+    Returns True if a file is a binary scenario file (rather than a text config file).
+    :param filename: Pathname of the file.
+    """
+    with open(filename, 'rb') as f:
+        return f.read(len(SCENARIO_MAGIC)) == SCENARIO_MAGIC
+
+
+def getBoardSize(num_roads):
+    """
+    Returns the width (and height) of the board of a scenario.
+    :param num_roads: Number of roads in each direction.
+    """
+    # Important! Might need to multiply by 4 instead of 2 if using getRandomTurnRoute() instead of getRandomRoute().
+    return num_roads * 2 + 1
+
+
+def getScenarioTrip(side, position, priority, width, height):
+    """
+    Returns the trip of a car that starts on a side of the board and goes straight to the opposite side.
+    :param side: Starting side: top, left, bottom, or right.
+    :param position: Coordinate of the car's road along the starting side.
+    :param priority: Priority of the car.
+    :param width: Width of the board.
+    :param height: Height of the board.
+    :return: origin, destination, route, priority (see Configurer.getNextCarTrip()).
+    """
+    route = []
+    if side == 'top':
+        origin = (position, 0)
+        route.append(['down', height - 1])
+        destination = (position, height - 1)
+    elif side == 'left':
+        origin = (0, position)
+        route.append(['right', width - 1])
+        destination = (width - 1, position)
+    elif side == 'bottom':
+        origin = (position, height - 1)
+        route.append(['up', height - 1])
+        destination = (position, 0)
+    elif side == 'right':
+        origin = (width - 1, position)
+        route.append(['left', width - 1])
+        destination = (0, position)
+    else:
+        raise Exception('Side value in config file must be top, left, bottom, or right, but is: %s' % side)
+    return origin, destination, route, priority
+
+
+class Scenario(object):
+    """
+    Memory-mapped binary scenario file. Trips are built from the records of the cars when they are requested, so the
+    scenario never holds more than the trips in use.
+    """
+
+    def __init__(self, filename):
+        """
+        :param filename: Pathname of the binary scenario file.
+        """
+        self.filename = filename
+        self._load()
+
+    def __getstate__(self):
+        # Pickle the pathname instead of the records, so that worker processes memory-map the file themselves.
+        return {'filename': self.filename}
+
+    def __setstate__(self, state):
+        self.filename = state['filename']
+        self._load()
+
+    def _load(self):
+        """
+        Reads the header of the file and memory-maps the records.
+        """
+        header = np.fromfile(self.filename, dtype=SCENARIO_HEADER_DTYPE, count=1)
+        if len(header) == 0 or header['magic'][0] != SCENARIO_MAGIC:
+            raise Exception('Not a binary scenario file: %s' % self.filename)
+        if header['version'][0] != SCENARIO_VERSION:
+            raise Exception('Unsupported binary scenario version %d in: %s' % (header['version'][0], self.filename))
+        self.num_roads = int(header['num_roads'][0])
+        self.num_cars = int(header['num_cars'][0])
+        self.width = getBoardSize(self.num_roads)
+        self.height = getBoardSize(self.num_roads)
+        if self.num_cars > 0:
+            self.records = np.memmap(self.filename, dtype=SCENARIO_RECORD_DTYPE, mode='r',
+                                     offset=SCENARIO_HEADER_DTYPE.itemsize, shape=(self.num_cars,))
+        else:
+            self.records = np.zeros(0, dtype=SCENARIO_RECORD_DTYPE)
+
+    def getTrip(self, car_id):
+        """
+        Returns the trip of a car.
+        :param car_id: ID number of the car.
+        :return: origin, destination, route, priority (see Configurer.getNextCarTrip()).
+        """
+        side, position, priority = self.records[car_id].tolist()
+        return getScenarioTrip(SIDES[side], position, priority, self.width, self.height)
+
+    def getTrips(self, car_ids):
+        """
+        Returns the trips of a block of cars as arrays, with vectorized operations.
+        :param car_ids: Array of car IDs.
+        :return: Dictionary of trip arrays with one entry per car (see Configurer.getCarTrips()).
+        """
+        records = self.records[car_ids]
+        return getStraightTrips(records['side'].astype(np.int64), records['position'].astype(np.int64),
+                                records['priority'].copy(), self.width, self.height)
+
+
+def convertTextScenario(text_filename, scenario_filename):
+    """
+    Converts a text config file (see Configurer.configFromFile()) to a binary scenario file. The text file is read one
+    line at a time and the records are written in blocks, so files with millions of cars are converted in constant
+    memory.
+    :param text_filename: Pathname of the text config file.
+    :param scenario_filename: Pathname of the binary scenario file, which is overwritten if it exists.
+    """
+    side_indices = dict((side, side_index) for side_index, side in enumerate(SIDES))
+    with open(text_filename, 'r') as f:
+        try:
+            num_cars = int(f.readline().strip())
+        except:
+            raise Exception('First line in config file must have the format: num_cars (int)')
+        try:
+            num_roads = int(f.readline().strip())
+        except:
+            raise Exception('Second line in config file must have the format: num_roads (int)')
+
+        with open(scenario_filename, 'wb') as out:
+            header = np.zeros(1, dtype=SCENARIO_HEADER_DTYPE)
+            header['magic'] = SCENARIO_MAGIC
+            header['version'] = SCENARIO_VERSION
+            header['num_roads'] = num_roads
+            header['num_cars'] = num_cars
+            header.tofile(out)
+
+            records = np.zeros(CONVERT_BLOCK_SIZE, dtype=SCENARIO_RECORD_DTYPE)
+            num_block_records = 0
+            num_records = 0
+            for line in f:
+                values = line.strip().split(' ')
+                if len(values) != 3:
+                    raise Exception('Line in config file must have the format: '
+                                    'side (string)<space>position (int)<space>priority (int), but was:\n\t%s' % line)
+                side, position, priority = values
+                if side not in side_indices:
+                    raise Exception('Side value in config file must be top, left, bottom, or right, but is: %s' %
+                                    side)
+                records[num_block_records] = (side_indices[side], int(position), float(priority))
+                num_block_records += 1
+                if num_block_records == CONVERT_BLOCK_SIZE:
+                    records.tofile(out)
+                    num_records += num_block_records
+                    num_block_records = 0
+            records[:num_block_records].tofile(out)
+            num_records += num_block_records
+
+    if num_records < num_cars:
+        raise Exception('Config file has %d cars, but lists only %d: %s' % (num_cars, num_records, text_filename))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3:
+        print('Usage: python scenario.py <path_to_file.txt> <path_to_file.scenario>')
+        sys.exit(1)
+    convertTextScenario(sys.argv[1], sys.argv[2])
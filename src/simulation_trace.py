@@ -0,0 +1,309 @@
+#!/usr/bin/python
+"""
+Compact binary traces of simulations, which record the initial placement of the cars in each round and the moves of
+each iteration, so that the state of the board at any iteration can be reconstructed later without simulating the
+protocols again (e.g. to inspect a headless run).
+
+Record a trace with run.py --trace_filename=<path_to_file.trace>. Then, summarize the rounds in a trace, or print the
+number of cars at each position of the board at an iteration of a round:
+python simulation_trace.py <path_to_file.trace> [<round_id> [<iteration_id>]]
+
+A trace has a header, followed by one record per round. All integers are unsigned LEB128 varints.
+* Header: the magic string TRACE_MAGIC, then the format version, width and height of the board, my_car's car_id + 1
+  (0 if there is no my_car), and the high cost (float64, little-endian).
+* Round record: round_id, number of iterations, and the length in bytes of the rest of the record, so that readers can
+  skip to any round. Then the number of cars, followed by the cars in the order of their positions (see getCell()) and
+  of their queues, each as the difference between its cell and the previous car's cell, its car_id, and a byte with its
+  priority (bit 0), whether it has arrived (bit 1) and the code of its direction (bits 2-3, see car.DIRECTION_CODES).
+  Then, for each iteration, the number of moves, followed by the moves in the order of their win positions, each as
+  (difference between its win cell and the previous move's win cell) << 3 | (whether the car arrived) << 2 | (direction
+  code of the move).
+The moves of an iteration are independent of their order (each moves the first car of a different queue to the back of
+another queue), so sorting them by cell keeps the differences small.
+"""
+
+import struct
+import sys
+from collections import deque
+from car import DIRECTION_CODES, DIRECTION_NAMES, DIRECTION_STEPS
+import util
+
+# Magic string at the start of every trace.
+TRACE_MAGIC = 'SMCTRACE'
+
+# Version of the trace format.
+TRACE_VERSION = 1
+
+
+def getCell(position, height):
+    """
+    Returns the index of a position in the column-major order of the board.
+    :param position: (x,y) tuple.
+    :param height: Height of the board.
+    """
+    return position[0] * height + position[1]
+
+
+def _writeVarint(buf, value):
+    """
+    Appends an unsigned LEB128 varint to a bytearray.
+    """
+    while value >= 0x80:
+        buf.append((value & 0x7f) | 0x80)
+        value >>= 7
+    buf.append(value)
+
+
+def _readVarint(buf, offset):
+    """
+    Reads an unsigned LEB128 varint from a bytearray.
+    :return: (value, offset after the varint) tuple.
+    """
+    value = 0
+    shift = 0
+    while True:
+        byte = buf[offset]
+        offset += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, offset
+        shift += 7
+
+
+class TraceCar(object):
+    """
+    Car reconstructed from a trace. It has the attributes of a Car that describe its state on the board, so that a
+    replayed board can be drawn and inspected like the board of a GameState.
+    """
+    __slots__ = ('car_id', 'priority', 'position', 'direction', 'arrived')
+
+    def __init__(self, car_id, priority, position, direction, arrived):
+        self.car_id = car_id
+        self.priority = priority
+        self.position = position
+        self.direction = direction
+        self.arrived = arrived
+
+    def hasArrived(self):
+        return self.arrived
+
+
+class TraceWriter(object):
+    """
+    Writes the trace of a simulation. Each round is buffered in memory and written as one record when it ends, so a
+    round that is interrupted (e.g. when a simulation stops early) is left out of the trace.
+    """
+
+    def __init__(self, filename, width, height, high_cost, my_car_id=None):
+        """
+        :param filename: Pathname of the trace, which is overwritten if it exists.
+        :param width: Width of the board.
+        :param height: Height of the board.
+        :param high_cost: Cost per iteration of a high priority car.
+        :param my_car_id: car_id of my_car, or None.
+        """
+        self.filename = filename
+        self.height = height
+        self._file = open(self.filename, 'wb')
+        header = bytearray(TRACE_MAGIC)
+        for value in (TRACE_VERSION, width, height, my_car_id + 1 if my_car_id is not None else 0):
+            _writeVarint(header, value)
+        header.extend(struct.pack('<d', high_cost))
+        self._file.write(header)
+
+        self._round_id = None
+        self._num_iterations = 0
+        self._body = None
+
+    def beginRound(self, round_id, board):
+        """
+        Starts the record of a round with the initial placement of its cars.
+        :param round_id: Round ID number.
+        :param board: Board of the GameState of the round, before its first iteration.
+        """
+        self._round_id = round_id
+        self._num_iterations = 0
+        self._body = bytearray()
+        cars = []
+        for x, column in enumerate(board):
+            for y, queue in enumerate(column):
+                cars.extend([(getCell((x, y), self.height), car) for car in queue])
+        _writeVarint(self._body, len(cars))
+        prev_cell = 0
+        for cell, car in cars:
+            _writeVarint(self._body, cell - prev_cell)
+            _writeVarint(self._body, car.car_id)
+            self._body.append(int(car.priority) | int(car.hasArrived()) << 1 | DIRECTION_CODES[car.direction] << 2)
+            prev_cell = cell
+
+    def writeIteration(self, win_next_positions, board):
+        """
+        Appends the moves of an iteration to the record of the current round.
+        :param win_next_positions: List of (win_position, next_position) tuples of the iteration (see GameState).
+        :param board: Board of the GameState of the round, after the iteration.
+        """
+        self._num_iterations += 1
+        _writeVarint(self._body, len(win_next_positions))
+        prev_cell = 0
+        for win_position, next_position in sorted(win_next_positions):
+            cell = getCell(win_position, self.height)
+            direction = DIRECTION_STEPS.index((next_position[0] - win_position[0], next_position[1] - win_position[1]))
+            arrived = board[next_position[0]][next_position[1]][-1].hasArrived()
+            _writeVarint(self._body, (cell - prev_cell) << 3 | int(arrived) << 2 | direction)
+            prev_cell = cell
+
+    def endRound(self):
+        """
+        Writes the record of the current round.
+        """
+        record = bytearray()
+        for value in (self._round_id, self._num_iterations, len(self._body)):
+            _writeVarint(record, value)
+        self._file.write(record)
+        self._file.write(self._body)
+        self._body = None
+
+    def close(self):
+        self._file.close()
+
+
+class TraceReader(object):
+    """
+    Reads a trace. Opening a trace only reads the headers of its round records, so any round can be replayed without
+    decoding the rounds before it.
+    """
+
+    def __init__(self, filename):
+        """
+        :param filename: Pathname of the trace.
+        """
+        self.filename = filename
+        with open(self.filename, 'rb') as f:
+            self._data = bytearray(f.read())
+        if self._data[:len(TRACE_MAGIC)] != TRACE_MAGIC:
+            raise Exception('Not a trace: %s' % self.filename)
+        offset = len(TRACE_MAGIC)
+        version, offset = _readVarint(self._data, offset)
+        if version != TRACE_VERSION:
+            raise Exception('Unsupported trace version %d in: %s' % (version, self.filename))
+        self.width, offset = _readVarint(self._data, offset)
+        self.height, offset = _readVarint(self._data, offset)
+        my_car_id, offset = _readVarint(self._data, offset)
+        self.my_car_id = my_car_id - 1 if my_car_id > 0 else None
+        self.high_cost = struct.unpack('<d', str(self._data[offset:offset + 8]))[0]
+        offset += 8
+
+        # Index the round records. Key is a round ID. Value is a (number of iterations, start offset of the body, end
+        # offset of the body) tuple.
+        self.round_ids = []
+        self._rounds = {}
+        while offset < len(self._data):
+            round_id, offset = _readVarint(self._data, offset)
+            num_iterations, offset = _readVarint(self._data, offset)
+            length, offset = _readVarint(self._data, offset)
+            if offset + length > len(self._data):
+                # The trace was truncated (e.g. the simulation was killed) in the middle of this record.
+                break
+            self.round_ids.append(round_id)
+            self._rounds[round_id] = (num_iterations, offset, offset + length)
+            offset += length
+
+    def getNumIterations(self, round_id):
+        """
+        Returns the number of iterations of a round.
+        :param round_id: Round ID number.
+        """
+        return self._getRound(round_id)[0]
+
+    def replayRound(self, round_id):
+        """
+        Replays a round from the trace.
+        :param round_id: Round ID number.
+        :return: Generator of (iteration_id, board, win_next_positions, total_cost) tuples, one for the initial state of
+         the round (with iteration_id 0 and no moves) and one after each iteration. board is a list of lists of deques
+         of TraceCars, like the board of a GameState, and is updated in place by each iteration. total_cost is the total
+         cost of the cars up to the iteration.
+        """
+        num_iterations, offset, end_offset = self._getRound(round_id)
+        data = self._data
+        height = self.height
+        high_cost = self.high_cost
+
+        # Place the cars.
+        board = [[deque() for _ in xrange(height)] for _ in xrange(self.width)]
+        travelling_cost = 0.0
+        num_cars, offset = _readVarint(data, offset)
+        cell = 0
+        for _ in xrange(num_cars):
+            cell_delta, offset = _readVarint(data, offset)
+            car_id, offset = _readVarint(data, offset)
+            flags = data[offset]
+            offset += 1
+            cell += cell_delta
+            position = (cell / height, cell % height)
+            car = TraceCar(car_id, flags & 1, position, DIRECTION_NAMES[flags >> 2], bool(flags & 2))
+            board[position[0]][position[1]].append(car)
+            if not car.arrived:
+                travelling_cost += high_cost * car.priority + 1 - car.priority
+        total_cost = 0.0
+        yield 0, board, [], total_cost
+
+        # Apply the moves of each iteration.
+        for iteration_id in xrange(1, num_iterations + 1):
+            total_cost += travelling_cost
+            num_moves, offset = _readVarint(data, offset)
+            win_next_positions = []
+            cell = 0
+            for _ in xrange(num_moves):
+                move, offset = _readVarint(data, offset)
+                cell += move >> 3
+                win_position = (cell / height, cell % height)
+                step = DIRECTION_STEPS[move & 3]
+                next_position = (win_position[0] + step[0], win_position[1] + step[1])
+                car = board[win_position[0]][win_position[1]].popleft()
+                car.position = next_position
+                car.direction = DIRECTION_NAMES[move & 3]
+                if move & 4:
+                    car.arrived = True
+                    travelling_cost -= high_cost * car.priority + 1 - car.priority
+                board[next_position[0]][next_position[1]].append(car)
+                win_next_positions.append((win_position, next_position))
+            yield iteration_id, board, win_next_positions, total_cost
+
+        if offset != end_offset:
+            raise Exception('Corrupt record of round %d in trace: %s' % (round_id, self.filename))
+
+    def getBoard(self, round_id, iteration_id):
+        """
+        Returns the board of a round after an iteration (see replayRound()).
+        :param round_id: Round ID number.
+        :param iteration_id: Iteration ID number (0 for the initial state of the round).
+        """
+        if iteration_id < 0 or iteration_id > self.getNumIterations(round_id):
+            raise Exception('Round %d of the trace has no iteration %d' % (round_id, iteration_id))
+        for replay_iteration_id, board, _, _ in self.replayRound(round_id):
+            if replay_iteration_id == iteration_id:
+                return board
+
+    def _getRound(self, round_id):
+        if round_id not in self._rounds:
+            raise Exception('Round %d is not in the trace: %s' % (round_id, self.filename))
+        return self._rounds[round_id]
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2 or len(sys.argv) > 4:
+        print('Usage: python simulation_trace.py <path_to_file.trace> [<round_id> [<iteration_id>]]')
+        sys.exit(1)
+    trace_reader = TraceReader(sys.argv[1])
+    if len(sys.argv) == 2:
+        print('Board: %dx%d\tHigh cost: %.3f\tMy car: %s' %
+              (trace_reader.width, trace_reader.height, trace_reader.high_cost, trace_reader.my_car_id))
+        for trace_round_id in trace_reader.round_ids:
+            print('Round %d\tIterations: %d' % (trace_round_id, trace_reader.getNumIterations(trace_round_id)))
+    else:
+        trace_round_id = int(sys.argv[2])
+        trace_iteration_id = int(sys.argv[3]) if len(sys.argv) == 4 else trace_reader.getNumIterations(trace_round_id)
+        trace_board = trace_reader.getBoard(trace_round_id, trace_iteration_id)
+        util.printBoardCounts([[len(queue) for queue in column] for column in trace_board], trace_round_id,
+                              trace_iteration_id)
@@ -1,26 +1,109 @@
 from __future__ import print_function
 from collections import deque
+import multiprocessing
+import time
 from configurer import *
 from animator import *
+from frame_renderer import FrameRenderer
+from array_simulator import *
+from results import *
+from profiler import Profiler
+from rollout import RolloutState
+from simulation_trace import TraceWriter
 import util
 
+# Maximum number of rounds in a block of rounds simulated by a worker process, which bounds the number of round results
+# held in memory at a time.
+MAX_BLOCK_SIZE = 1000
+
+# Default minimum number of rounds simulated before a simulation with a target confidence interval may stop, so that the
+# variance estimate is reliable.
+MIN_TARGET_CI_ROUNDS = 30
+
 
 class Simulator:
-    def __init__(self, config):
+    def __init__(self, config, engine='deque', batch_size=1, workers=1, results_filename=None, target_ci=None,
+                 metric_name='cost', min_rounds=MIN_TARGET_CI_ROUNDS, keep_round_metric_values=False, profile=False,
+                 trace_filename=None, render_filename=None):
         """
         :param config: An instance of the Config class used to specify simulation parameters.
+        :param engine: Name of the engine used to simulate each round: 'deque' (GameState, which supports all protocols)
+         or 'array' (ArrayGameState, which supports the random and greedy protocols).
+        :param batch_size: Number of rounds the array engine simulates together in lockstep.
+        :param workers: Number of processes across which rounds are spread. Only protocols whose rounds are independent
+         (see Protocol.independent_rounds) are simulated in parallel. Results are identical to a serial run with the
+         same random seed.
+        :param results_filename: Pathname of a CSV file to which the stats of each round are written as the simulation
+         runs (see ResultsWriter), or None.
+        :param target_ci: If not None, stop the simulation as soon as the half-width of the 95% confidence interval of
+         the mean of metric_name is at most target_ci. The number of rounds in config is then the maximum number of
+         rounds.
+        :param metric_name: Name of the metric whose confidence interval is compared to target_ci: cost, reward,
+         my_cost, or my_reward.
+        :param min_rounds: Minimum number of rounds simulated before stopping early.
+        :param keep_round_metric_values: If True, keep the value of metric_name in each round (see
+         getRoundMetricValues()), e.g. to pair the rounds of simulations that use common random numbers.
+        :param profile: If True, time each phase of the simulation and the decisions of the protocol (see Profiler),
+         and print the report at the end of run().
+        :param trace_filename: Pathname of a file to which a trace of the simulation is written (see TraceWriter), or
+         None.
+        :param render_filename: If not None, render the animation of the simulation without a display (see
+         FrameRenderer): to a sequence of PNG files in this directory, or to an animated GIF if it ends with .gif.
         """
         self.config = config
-
-        # Store cost and reward stats from the simulation.
-        # * simulation_costs is a list of the total cost per round.
-        # * simulation_rewards is a list of the total reward per round.
-        # * my_car_costs is a list of my_car's cost per round.
-        # * my_car_rewards is a list of my_car's reward per round.
-        self.simulation_costs = []
-        self.simulation_rewards = []
-        self.my_car_costs = []
-        self.my_car_rewards = []
+        self.engine = engine
+        self.batch_size = batch_size
+        self.workers = workers
+        self.results_filename = results_filename
+        self.target_ci = target_ci
+        self.metric_name = metric_name
+        self.min_rounds = min_rounds
+        self.trace_filename = trace_filename
+        self.render_filename = render_filename
+        if self.engine not in ('deque', 'array'):
+            raise Exception('Unrecognized engine: %s' % self.engine)
+        if self.engine == 'array' and (self.config.animate or self.render_filename is not None):
+            raise Exception('The array engine does not support animation.')
+        if self.batch_size < 1:
+            raise Exception('batch_size must be at least 1, but is: %d' % self.batch_size)
+        if self.batch_size > 1 and self.engine != 'array':
+            raise Exception('Simulating rounds in batches requires the array engine.')
+        if self.workers < 1:
+            raise Exception('workers must be at least 1, but is: %d' % self.workers)
+        if self.workers > 1 and (self.config.animate or self.render_filename is not None):
+            raise Exception('Animating the simulation requires a single worker.')
+        if self.trace_filename is not None and self.engine != 'deque':
+            raise Exception('Recording a trace requires the deque engine.')
+        if self.trace_filename is not None and self.workers > 1:
+            raise Exception('Recording a trace requires a single worker.')
+        if self.config.common_random_numbers and self.config.random_seed is None:
+            raise Exception('Common random numbers require a random seed.')
+        if self.config.trip_cache_dir is not None and not self.config.common_random_numbers:
+            raise Exception('Caching trips requires common random numbers.')
+        if self.target_ci is not None and self.target_ci <= 0:
+            raise Exception('target_ci must be positive, but is: %f' % self.target_ci)
+        if self.metric_name not in ('cost', 'reward', 'my_cost', 'my_reward'):
+            raise Exception('Unrecognized metric_name %s' % self.metric_name)
+        if self.target_ci is not None and self.metric_name.startswith('my_') and self.config.MyCarClass is None:
+            raise Exception('A target confidence interval for %s requires my_car.' % self.metric_name)
+
+        # Store running statistics of the cost and reward stats from the simulation, which use constant memory however
+        # many rounds are simulated (the stats of each round can be written to a file with results_filename).
+        # * cost_statistics are statistics of the total cost per round.
+        # * reward_statistics are statistics of the total reward per round.
+        # * my_car_cost_statistics are statistics of my_car's cost per round.
+        # * my_car_reward_statistics are statistics of my_car's reward per round.
+        self.cost_statistics = RunningStatistics()
+        self.reward_statistics = RunningStatistics()
+        self.my_car_cost_statistics = RunningStatistics()
+        self.my_car_reward_statistics = RunningStatistics()
+        self.results_writer = None
+        self.trace_writer = None
+
+        # Store the totals of the event counters of the rounds (see EventCounters). Only the deque engine counts events.
+        self.event_counters = EventCounters()
+        self.round_metric_values = [] if keep_round_metric_values else None
+        self.profiler = Profiler() if profile else None
 
         # Initialize the cars. If MyCarClass is not None, make one of the cars MyCarClass.
         self.cars = []
@@ -34,15 +117,23 @@ class Simulator:
             car = self.config.CarClass(car_id, self.config.protocol)
             self.cars.append(car)
 
+        # Load the cached trips (generating them if needed) before any worker processes are started, so that the workers
+        # share the table instead of each generating it.
+        self.config.getTripTable()
+
         self.animator = None
-        if self.config.animate:
+        if self.render_filename is not None:
+            self.animator = FrameRenderer(self.render_filename, 500, self.config.height, self.config.num_cars,
+                                          self.config.high_cost, self.my_car)
+        elif self.config.animate:
             self.animator = Animator(500, self.config.height, self.config.num_cars, self.config.high_cost, self.my_car)
 
     def run(self):
         """
         Runs the simulation for self.num_rounds number of rounds. Computes the total cost and reward for all cars per
         round, and also the cost and reward for my_car per round (if the MyCarClass passed into the constructor was not
-        None).
+        None). If target_ci was passed into the constructor, stops as soon as the confidence interval of the metric is
+        narrow enough.
         """
         if self.config.num_rounds == 0 or self.config.num_cars == 0 or self.config.num_roads == 0:
             return
@@ -51,70 +142,324 @@ class Simulator:
             self.animator.initAnimation(str(self.config.protocol), str(self.cars[0]))
 
         # Run the simulation for num_rounds times.
-        for round_id in xrange(self.config.num_rounds):
-            # Initialize the game.
-            game = GameState(self.config, round_id, self.cars, self.my_car)
-            game.printState(round_id, 0)
+        if self.workers > 1 and not self.config.protocol.independent_rounds:
+            print('The %s protocol carries state across rounds, so its rounds are simulated serially.' %
+                  str(self.config.protocol))
+        if self.results_filename is not None:
+            self.results_writer = ResultsWriter(self.results_filename)
+        if self.trace_filename is not None:
+            self.trace_writer = TraceWriter(self.trace_filename, self.config.width, self.config.height,
+                                            self.config.high_cost, self.my_car.car_id if self.my_car else None)
+        if self.workers > 1 and self.config.protocol.independent_rounds:
+            round_results = self._simulateRoundsInParallel(0, self.config.num_rounds)
+        else:
+            round_results = self._simulateRounds(0, self.config.num_rounds)
+        try:
+            for round_result in round_results:
+                self._recordRound(*round_result)
+                if self._hasReachedTargetCI():
+                    break
+        finally:
+            # Close the generator of rounds, which stops any rounds still being simulated in parallel.
+            round_results.close()
+            if self.results_writer is not None:
+                self.results_writer.close()
+                self.results_writer = None
+            if self.trace_writer is not None:
+                self.trace_writer.close()
+                self.trace_writer = None
             if self.animator:
-                self.animator.initRound(game.board, game.cost_board, round_id, 0)
-
-            # Simulate the round until all cars reach their destinations.
-            iteration_id = 0
-            while not game.isEnd():
-                game.updateState()
-                iteration_id += 1
-                game.printState(round_id, iteration_id)
-                if self.animator:
-                    self.animator.updateAnimation(game.board, game.cost_board, game.win_next_positions, round_id,
-                                                  iteration_id, game.total_cost)
-
-            # Keep track of stats from the round.
-            self.simulation_costs.append(game.getCompetitiveRatio())
-            self.simulation_rewards.append(self.config.protocol.getTotalReward(self.config.num_cars))
-            if self.my_car is not None:
-                self.my_car_costs.append(game.my_car_cost)
-                self.my_car_rewards.append(self.config.protocol.getCarReward(self.my_car.car_id))
+                self.animator.close()
 
-            game.printState(round_id, iteration_id)
-
-            if util.VERBOSE >= 1:
-                print('Round %d\tTotal reward = %.3f\tTotal cost = %.3f' % (round_id, self.simulation_rewards[-1],
-                                                                            self.simulation_costs[-1]))
-                if self.my_car is not None:
-                    print('\tMy car reward = %.3f\tMy car cost = %.3f' % (self.my_car_rewards[-1],
-                                                                          self.my_car_costs[-1]))
         if self.config.num_cars == 0:
             return
         print('CONFIGURATION: %s' % str(self.config))
         print('MEAN COST: %.3f\tMY CAR COST: %.3f' %
               (self.getMeanCost(), self.getMyCarMeanCost()))
+        print('COST STD DEV: %.3f\tCOST 95%% CONFIDENCE INTERVAL: %.3f +/- %.3f' %
+              (self.cost_statistics.getStandardDeviation(), self.getMeanCost(),
+               self.cost_statistics.getConfidenceHalfWidth()))
+        if self.target_ci is not None:
+            print('ROUNDS: %d of at most %d\t%s 95%% CONFIDENCE HALF-WIDTH: %.3f (target %.3f)' %
+                  (self.getNumRounds(), self.config.num_rounds, self.metric_name.upper(),
+                   self.getConfidenceHalfWidth(self.metric_name), self.target_ci))
+        externality_table = self.config.protocol.externality_table
+        if externality_table is not None:
+            print('EXTERNALITY CACHE: %s' % str(externality_table))
+        if self.engine == 'deque':
+            print('EVENTS: %s' % str(self.event_counters))
+        if self.profiler is not None:
+            print('PROFILE:\n%s' % str(self.profiler))
+
+    def _simulateRounds(self, start_round_id, end_round_id):
+        """
+        Simulates the rounds with IDs in [start_round_id, end_round_id) in order in the current process.
+        :param start_round_id: ID number of the first round.
+        :param end_round_id: ID number after the last round.
+        :return: Generator of (round_id, cost, reward, my_car_cost, my_car_reward, event_counters) tuples, one per
+         round.
+        """
+        if self.engine == 'array':
+            for batch_start_round_id in xrange(start_round_id, end_round_id, self.batch_size):
+                round_ids = range(batch_start_round_id, min(batch_start_round_id + self.batch_size, end_round_id))
+                for round_result in self._simulateArrayRounds(round_ids):
+                    yield round_result
+        else:
+            for round_id in xrange(start_round_id, end_round_id):
+                yield self._simulateRound(round_id)
+
+    def _simulateRoundsInParallel(self, start_round_id, end_round_id):
+        """
+        Simulates the rounds with IDs in [start_round_id, end_round_id) across a pool of self.workers processes. Each
+        process simulates contiguous blocks of rounds, and the results are merged in round order.
+        :param start_round_id: ID number of the first round.
+        :param end_round_id: ID number after the last round.
+        :return: Generator of (round_id, cost, reward, my_car_cost, my_car_reward, event_counters) tuples, one per
+         round.
+        """
+        # Use a few blocks per worker so that slow blocks do not leave the other workers idle. Blocks are a multiple of
+        # the batch size, so that the array engine simulates the same batches as in a serial run.
+        num_batches = (end_round_id - start_round_id + self.batch_size - 1) / self.batch_size
+        block_num_batches = max(1, min(num_batches / (4 * self.workers), MAX_BLOCK_SIZE / self.batch_size))
+        block_size = block_num_batches * self.batch_size
+        blocks = [(self.config, self.engine, self.batch_size, self.profiler is not None, block_start_round_id,
+                   min(block_start_round_id + block_size, end_round_id))
+                  for block_start_round_id in xrange(start_round_id, end_round_id, block_size)]
+
+        # If the caller stops early, terminate the blocks that are still being simulated instead of waiting for them.
+        pool = multiprocessing.Pool(self.workers, initializer=_initWorker)
+        try:
+            for block_results, block_profiler in pool.imap(_simulateRoundsInWorker, blocks):
+                if block_profiler is not None:
+                    self.profiler.merge(block_profiler)
+                for round_result in block_results:
+                    yield round_result
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def _simulateRound(self, round_id):
+        """
+        Simulates one round with a GameState.
+        :param round_id: Round ID number.
+        :return: (round_id, cost, reward, my_car_cost, my_car_reward, event_counters) tuple.
+        """
+        if self.profiler is not None:
+            start_time = time.time()
+
+        # Initialize the game. Each round shuffles its own copy of the cars, so that the round does not depend on the
+        # rounds simulated before it.
+        self.config.seedRound(round_id)
+        event_counters = EventCounters()
+        game = GameState(self.config, round_id, list(self.cars), self.my_car, profiler=self.profiler,
+                         event_counters=event_counters)
+        game.printState(round_id, 0)
+        if self.animator:
+            self.animator.initRound(game.board, round_id, 0)
+        if self.trace_writer is not None:
+            self.trace_writer.beginRound(round_id, game.board)
+
+        # Simulate the round until all cars reach their destinations.
+        iteration_id = 0
+        while not game.isEnd():
+            game.updateState()
+            iteration_id += 1
+            game.printState(round_id, iteration_id)
+            if self.trace_writer is not None:
+                self.trace_writer.writeIteration(game.win_next_positions, game.board)
+            if self.animator:
+                self.animator.updateAnimation(game.board, game.win_next_positions, round_id, iteration_id,
+                                              game.total_cost)
+
+        game.printState(round_id, iteration_id)
+        if self.trace_writer is not None:
+            self.trace_writer.endRound()
+
+        # Keep track of stats from the round.
+        my_car_cost = None
+        my_car_reward = None
+        if self.my_car is not None:
+            my_car_cost = game.my_car_cost
+            my_car_reward = self.config.protocol.getCarReward(self.my_car.car_id)
+        if self.profiler is not None:
+            self.profiler.addTime('round', time.time() - start_time)
+        return (round_id, game.getCompetitiveRatio(), self.config.protocol.getTotalReward(self.config.num_cars),
+                my_car_cost, my_car_reward, event_counters)
+
+    def _simulateArrayRounds(self, round_ids):
+        """
+        Simulates the provided rounds together with an ArrayGameState.
+        :param round_ids: List of round ID numbers.
+        :return: List of (round_id, cost, reward, my_car_cost, my_car_reward, event_counters) tuples, one per round.
+        """
+        # Initialize the game. The array engine only times the setup (including the trips) and whole iterations of the
+        # batch of rounds.
+        profiler = self.profiler
+        if profiler is not None:
+            start_time = time.time()
+        game = ArrayGameState(self.config, round_ids, self.cars, self.my_car)
+        game.printState(0)
+        if profiler is not None:
+            profiler.addTime('setup', time.time() - start_time)
+
+        # Simulate the rounds until all cars reach their destinations.
+        iteration_id = 0
+        while not game.isEnd():
+            if profiler is not None:
+                iteration_start_time = time.time()
+            game.updateState()
+            if profiler is not None:
+                profiler.addTime('iterations', time.time() - iteration_start_time)
+            iteration_id += 1
+            game.printState(iteration_id)
+        if profiler is not None:
+            profiler.addTime('round', time.time() - start_time)
+
+        # Keep track of stats from the rounds. The supported protocols do not change rewards during a round.
+        round_results = []
+        competitive_ratios = game.getCompetitiveRatios()
+        for round_index, round_id in enumerate(round_ids):
+            my_car_cost = None
+            my_car_reward = None
+            if self.my_car is not None:
+                my_car_cost = float(game.my_car_costs[round_index])
+                my_car_reward = self.config.protocol.getCarReward(self.my_car.car_id)
+            round_results.append((round_id, float(competitive_ratios[round_index]),
+                                  self.config.protocol.getTotalReward(self.config.num_cars), my_car_cost,
+                                  my_car_reward, None))
+        return round_results
+
+    def _recordRound(self, round_id, cost, reward, my_car_cost, my_car_reward, event_counters):
+        """
+        Stores the stats from a round.
+        :param round_id: Round ID number.
+        :param cost: Competitive ratio of the round.
+        :param reward: Total reward after the round.
+        :param my_car_cost: Cost of my_car in the round (None if there is no my_car).
+        :param my_car_reward: Reward of my_car after the round (None if there is no my_car).
+        :param event_counters: EventCounters of the round (None if the engine does not count events).
+        """
+        self.cost_statistics.add(cost)
+        self.reward_statistics.add(reward)
+        if self.my_car is not None:
+            self.my_car_cost_statistics.add(my_car_cost)
+            self.my_car_reward_statistics.add(my_car_reward)
+        if event_counters is not None:
+            self.event_counters.merge(event_counters)
+        if self.results_writer is not None:
+            self.results_writer.writeRound(round_id, cost, reward, my_car_cost, my_car_reward, event_counters)
+        if self.round_metric_values is not None:
+            if self.metric_name == 'cost':
+                self.round_metric_values.append(cost)
+            elif self.metric_name == 'reward':
+                self.round_metric_values.append(reward / float(self.config.num_cars))
+            elif self.metric_name == 'my_cost':
+                self.round_metric_values.append(my_car_cost)
+            else:
+                self.round_metric_values.append(my_car_reward)
+
+        if util.VERBOSE >= 1:
+            print('Round %d\tTotal reward = %.3f\tTotal cost = %.3f' % (round_id, reward, cost))
+            if self.my_car is not None:
+                print('\tMy car reward = %.3f\tMy car cost = %.3f' % (my_car_reward, my_car_cost))
+
+    def _hasReachedTargetCI(self):
+        """
+        Returns True if the simulation has a target confidence interval, and at least min_rounds rounds have been
+        simulated and the confidence interval of the metric is at most the target.
+        """
+        if self.target_ci is None or self.getNumRounds() < self.min_rounds:
+            return False
+        return self.getConfidenceHalfWidth(self.metric_name) <= self.target_ci
 
     def getMeanCost(self):
         """
         Returns the mean cost per car per round.
         """
-        return sum(self.simulation_costs) / float(self.config.num_rounds) #/ float(self.config.num_cars)
+        return self.cost_statistics.mean
 
     def getMeanReward(self):
         """
         Returns the mean reward per car per round.
         """
-        return sum(self.simulation_rewards) / float(self.config.num_rounds) / float(self.config.num_cars)
+        return self.reward_statistics.mean / float(self.config.num_cars)
 
     def getMyCarMeanCost(self):
         """
         Returns the mean cost of my_car per round.
         """
-        return sum(self.my_car_costs) / float(self.config.num_rounds)
+        return self.my_car_cost_statistics.mean
 
     def getMyCarMeanReward(self):
         """
         Returns the mean reward of my_car per round.
         """
-        return sum(self.my_car_rewards) / float(self.config.num_rounds)
+        return self.my_car_reward_statistics.mean
+
+    def getNumRounds(self):
+        """
+        Returns the number of rounds simulated, which is less than the number of rounds in the configuration if the
+        simulation stopped early (see target_ci).
+        """
+        return self.cost_statistics.count
+
+    def getEventCounters(self):
+        """
+        Returns the EventCounters summed over the rounds simulated so far (the max_queue_length is the maximum over the
+        rounds). The array engine does not count events, so its counters stay 0.
+        """
+        return self.event_counters
+
+    def getRoundMetricValues(self):
+        """
+        Returns the list of values of metric_name in each round, in the order of the round IDs (None unless
+        keep_round_metric_values was passed into the constructor).
+        """
+        return self.round_metric_values
+
+    def getConfidenceHalfWidth(self, metric_name):
+        """
+        Returns the half-width of the 95% confidence interval of the mean of a metric, in the units of its getter (e.g.
+        the reward is per car per round).
+        :param metric_name: Name of the metric: cost, reward, my_cost, or my_reward.
+        """
+        if metric_name == 'cost':
+            return self.cost_statistics.getConfidenceHalfWidth()
+        elif metric_name == 'reward':
+            return self.reward_statistics.getConfidenceHalfWidth() / float(self.config.num_cars)
+        elif metric_name == 'my_cost':
+            return self.my_car_cost_statistics.getConfidenceHalfWidth()
+        elif metric_name == 'my_reward':
+            return self.my_car_reward_statistics.getConfidenceHalfWidth()
+        else:
+            raise Exception('Unrecognized metric_name %s' % metric_name)
+
+
+def _initWorker():
+    """
+    Initializes a worker process of Simulator._simulateRoundsInParallel(). Forked workers inherit the state of the
+    random and numpy modules, so reseed them to avoid drawing the same numbers in every worker when no random seed was
+    specified (with a random seed, each round is reseeded by Configurer.seedRound()).
+    """
+    random.seed()
+    np.random.seed()
+
 
+def _simulateRoundsInWorker(args):
+    """
+    Simulates a block of rounds in a worker process of Simulator._simulateRoundsInParallel().
+    :param args: (config, engine, batch_size, profile, start_round_id, end_round_id) tuple.
+    :return: (round_results, profiler) tuple, where round_results is a list of (round_id, cost, reward, my_car_cost,
+     my_car_reward, event_counters) tuples, one per round, and profiler is the Profiler of the block (None unless
+     profile is True).
+    """
+    config, engine, batch_size, profile, start_round_id, end_round_id = args
+    simulator = Simulator(config, engine, batch_size, profile=profile)
+    return list(simulator._simulateRounds(start_round_id, end_round_id)), simulator.profiler
 
-class GameState:
+
+class GameState(object):
     """
     This class manages the state of the road network when running the simulator. A new instance of this class should be
     created for reach round in the simulation.
@@ -128,24 +473,55 @@ class GameState:
     The queues at road segments can have any number of cars.
     """
 
-    def __init__(self, config, round_id, cars, my_car=None, init_new_trips=True):
+    def __init__(self, config, round_id, cars, my_car=None, init_new_trips=True, profiler=None, event_counters=None):
+        """
+        :param config: Configurer instance.
+        :param round_id: Round ID number.
+        :param cars: List of the cars in the game.
+        :param my_car: my_car instance (one of cars), or None.
+        :param init_new_trips: If True, shuffle the cars and give each car a new trip for the round. Otherwise, the cars
+         keep their positions and trips.
+        :param profiler: Profiler instance that times the setup of the game and each phase of updateState(), or None.
+         The time of any look-ahead is part of the decisions of the protocol.
+        :param event_counters: EventCounters instance that counts the events of the game, or None. The protocol counts
+         the look-ahead that it simulates with RolloutStates (see getRolloutState()) in these counters too.
+        """
         self.config = config
         self.my_car = my_car
+        self.profiler = profiler
+        self.event_counters = event_counters
+        if profiler is not None:
+            start_time = time.time()
+            trips_time = 0.0
+
+        # Get the lookup tables of the structure of the board, which are shared by all games on the same board size.
+        self.topology = util.getTopology(self.config.width, self.config.height)
 
         # Initialize the board, which stores queues of cars at each (x,y) position
         self.board = [[deque() for _ in xrange(self.config.height)] for _ in xrange(self.config.width)]
 
-        # Initialize the board storing the total cost at each (x,y) position in the board.
-        self.cost_board = [[0] * self.config.height for _ in xrange(self.config.width)]
-
         # List of tuples of the form (win_position, next_position), where win_position is a position that won in the
         # latest iteration, and next_position is the position to which the car there moved.
         self.win_next_positions = []
 
+        # The following dictionaries are updated incrementally whenever a car moves, so that an iteration only touches
+        # the queues whose first car can move rather than every car in the round.
+        # * queue_costs: Key is a position. Value is the total cost of the travelling cars in its queue.
+        # * queue_next_positions: Key is a position whose first car is travelling. Value is the position to which that
+        #   car would *like* to move.
+        # * next_position_queues: Key is a next position. Value is a list of the (at most two) positions whose first
+        #   car would like to move there.
+        self._queue_costs = {}
+        self._queue_next_positions = {}
+        self._next_position_queues = {}
+
         # Initialize a trip for each car. Add each car to the board. Also, randomly shuffle the order of the cars.
         self.cars = cars
         if init_new_trips:
-            random.shuffle(self.cars)
+            self.config.shuffleCars(round_id, self.cars)
+        self.num_cars_travelling = 0
+        self.travelling_cost = 0.0
+        occupied_positions = set()
         for car in self.cars:
             position = car.position
 
@@ -153,15 +529,31 @@ class GameState:
                 # Get the starting position, destination, route from origin to destination, and priority for the trip. The
                 # route is a list of 'directions', where each direction is a tuple of the form ({'up', 'down', 'left', or
                 # 'right'}, num_steps).
+                if profiler is not None:
+                    trip_start_time = time.time()
                 origin, destination, route, priority = self.config.getNextCarTrip(round_id, car.car_id)
+                if profiler is not None:
+                    trips_time += time.time() - trip_start_time
                 position = origin
 
                 # Initialize the car's trip.
                 car.initTrip(origin, destination, route, priority)
 
             # Add the car to the board.
+            car_cost = self.getCarCost(car)
             self.board[position[0]][position[1]].append(car)
-            self.cost_board[position[0]][position[1]] += self.getCarCost(car)
+            occupied_positions.add(position)
+            if not car.hasArrived():
+                self._queue_costs[position] = self._queue_costs.get(position, 0) + car_cost
+                self.num_cars_travelling += 1
+                self.travelling_cost += car_cost
+
+        for position in occupied_positions:
+            self._updateQueueNextPosition(position)
+        if event_counters is not None:
+            for position in occupied_positions:
+                event_counters.max_queue_length = max(event_counters.max_queue_length,
+                                                      len(self.board[position[0]][position[1]]))
 
         # Call the protocol functions that need to be called if the protocol involves fixed actions per round.
         if init_new_trips and self.config.protocol.fixed_actions_per_round:
@@ -169,11 +561,14 @@ class GameState:
             for car in self.cars:
                 self.config.protocol.setCarRoundAction(car.car_id, car.getAction(car.position, 1, None, 0))
 
-        # Initialize the total cost, my_car cost, optimal cost, and number of cars not yet arrived.
+        # Initialize the total cost, my_car cost and optimal cost.
         self.total_cost = 0.0
         self.my_car_cost = 0.0
         self.optimal_cost = sum([util.getCarOptimalCost(car, self.config.high_cost) for car in self.cars])
-        self.num_cars_travelling = len(cars)
+
+        if profiler is not None:
+            profiler.addTime('trips', trips_time)
+            profiler.addTime('setup', time.time() - start_time - trips_time)
 
     def getCompetitiveRatio(self):
         if self.optimal_cost == 0:
@@ -182,57 +577,45 @@ class GameState:
 
     def updateState(self, automatic_win_position=None, automatic_lose_position=None):
         """
-        Runs one iteration of the simulation. Updates self.board and self.cost_board to reflect the new state of the
-        simulation. Also updates self.win_next_positions with a list of (win_position, next_position) tuples.
+        Runs one iteration of the simulation. Updates self.board to reflect the new state of the simulation. Also
+        updates self.win_next_positions with a list of (win_position, next_position) tuples.
 
         If automatic_win_position is not None, that position automatically wins. This is useful when simulating the
         effects of letting one car win.
         """
-        # Increment the total weighted travel time and remove all the arrived cars from self.cars.
-        travelling_cars = []
-        for car in self.cars:
-            if not car.hasArrived():
-                self.total_cost += self.getCarCost(car)
-                travelling_cars.append(car)
-        self.cars = travelling_cars
+        profiler = self.profiler
+        event_counters = self.event_counters
+        if event_counters is not None:
+            event_counters.conflicts += len(self._next_position_queues)
+        if profiler is not None:
+            protocol_name = str(self.config.protocol)
+
+        # Increment the total weighted travel time.
+        self.total_cost += self.travelling_cost
         if self.my_car is not None and not self.my_car.hasArrived():
             self.my_car_cost += self.getCarCost(self.my_car)
 
-        # Determine the next position to which each car would *like* to move.
-        # * next_positions is a dictionary. Key is next_position. Value is a set of car_ids wanting to move there.
-        # * car_next_positions is a dictionary. Key is car_id. Value is its desired next position.
-        next_positions = {}
-        car_next_positions = {}
-        for car in self.cars:
-            next_position = car.getNextPosition()
-            if next_position not in next_positions:
-                next_positions[next_position] = set()
-            next_positions[next_position].add(car)
-            car_next_positions[car.car_id] = next_position
-
-        # Resolve the conflicts in order to determine which cars move.
-        # * win_positions are sets containing positions with at least one car that won.
-        win_positions = set()
-        for next_position, cars in next_positions.iteritems():
+        # Resolve the conflicts in order to determine which cars move. Only the queues whose first car is travelling
+        # are involved in a conflict, and each conflict lets exactly one queue move.
+        # * win_next_positions is a list of (win_position, next_position) tuples for the positions that won.
+        win_next_positions = []
+        for next_position, positions in self._next_position_queues.iteritems():
             # Arbitrarily set one position in the conflict as position_0, and the other (if it exists) as position_1.
-            position_0 = None
-            position_1 = None
-            for car in cars:
-                if position_0 is None:
-                    position_0 = car.position
-                    continue
-                elif car.position != position_0:
-                    position_1 = car.position
-                    break
+            position_0 = positions[0]
+            position_1 = positions[1] if len(positions) > 1 else None
+            if position_1 is not None and event_counters is not None:
+                event_counters.contested_conflicts += 1
 
             # Compute the information given to each car when asking it for a decision. num_cars is number of cars at
             # the given position corresponding to the index.
-            num_cars = [0, 0]
-            for car in cars:
-                if car.position == position_0:
-                    num_cars[0] += 1
-                else:
-                    num_cars[1] += 1
+            cars = list(self.board[position_0[0]][position_0[1]])
+            num_cars = [len(cars), 0]
+            if position_1 is not None:
+                cars.extend(self.board[position_1[0]][position_1[1]])
+                num_cars[1] = len(cars) - num_cars[0]
+
+            if profiler is not None:
+                actions_start_time = time.time()
 
             # Get each car's action (i.e. move forward, if possible, or agree not to move).
             # * actions is a dictionary. Key is car_id. Value is the car's action.
@@ -240,17 +623,21 @@ class GameState:
             # * actions_car_id_list is a list of car_ids for each position.
             actions = {}
             actions_list = [[], []]
-            for car in cars:
+            for i, car in enumerate(cars):
                 if self.config.protocol.fixed_actions_per_round:
                     action = self.config.protocol.getCarRoundAction(car.car_id)
                 else:
                     action = car.getAction(position_0, num_cars[0], position_1, num_cars[1])
                 actions[car.car_id] = action
-                if car.position == position_0:
+                if i < num_cars[0]:
                     actions_list[0].append(action)
                 else:
                     actions_list[1].append(action)
 
+            if profiler is not None:
+                decision_start_time = time.time()
+                profiler.addTime('actions', decision_start_time - actions_start_time)
+
             # Determine which position wins.
             win_position = None
             if automatic_win_position and \
@@ -273,31 +660,74 @@ class GameState:
                 win_position = self.config.protocol.getWinPosition(position_0, actions_list[0], position_1,
                                                                    actions_list[1], self)
 
+            if profiler is not None:
+                rewards_start_time = time.time()
+                profiler.addDecision(protocol_name, rewards_start_time - decision_start_time)
+
             # Store the win position.
-            win_positions.add(win_position)
+            win_next_positions.append((win_position, next_position))
 
             # Reward cars.
             for car in cars:
                 self.config.protocol.updateCarReward(car.car_id, car.position, win_position, actions[car.car_id],
                                                      position_0, actions_list[0], position_1, actions_list[1])
+            if profiler is not None:
+                profiler.addTime('rewards', time.time() - rewards_start_time)
 
         # Move the cars that are first in the queues in the winning positions. Inform these cars of their new positions.
-        # Also, populate win_next_positions.
-        self.win_next_positions = []
-        for position in win_positions:
+        # Update the queue costs, and the number and cost of cars travelling, for the cars that move or arrive.
+        if profiler is not None:
+            moves_start_time = time.time()
+        changed_positions = set()
+        for position, next_position in win_next_positions:
             moving_car = self.board[position[0]][position[1]].popleft()
-            next_position = car_next_positions[moving_car.car_id]
             moving_car.updatePosition(next_position)
-            self.board[next_position[0]][next_position[1]].append(moving_car)
-            self.win_next_positions.append((position, next_position))
+            next_queue = self.board[next_position[0]][next_position[1]]
+            next_queue.append(moving_car)
+            if event_counters is not None and len(next_queue) > event_counters.max_queue_length:
+                event_counters.max_queue_length = len(next_queue)
+
+            car_cost = self.getCarCost(moving_car)
+            self._queue_costs[position] -= car_cost
+            if moving_car.hasArrived():
+                self.num_cars_travelling -= 1
+                self.travelling_cost -= car_cost
+            else:
+                self._queue_costs[next_position] = self._queue_costs.get(next_position, 0) + car_cost
+
+            changed_positions.add(position)
+            changed_positions.add(next_position)
+        self.win_next_positions = win_next_positions
+        if profiler is not None:
+            next_positions_start_time = time.time()
+            profiler.addTime('moves', next_positions_start_time - moves_start_time)
+
+        # Only the queues whose contents changed can have a new first car.
+        for position in changed_positions:
+            self._updateQueueNextPosition(position)
+        if profiler is not None:
+            profiler.addTime('next_positions', time.time() - next_positions_start_time)
+
+    def _updateQueueNextPosition(self, position):
+        """
+        Updates the next position of the first car in the queue at position, if the car is travelling.
+        """
+        next_position = self._queue_next_positions.pop(position, None)
+        if next_position is not None:
+            positions = self._next_position_queues[next_position]
+            positions.remove(position)
+            if len(positions) == 0:
+                del self._next_position_queues[next_position]
+
+        queue = self.board[position[0]][position[1]]
+        if len(queue) == 0 or queue[0].hasArrived():
+            return
 
-        # Update number of cars travelling and update self.cost_board to reflect the total cost of cars at each
-        # location in the board.
-        self.num_cars_travelling = 0
-        for car in self.cars:
-            if not car.hasArrived():
-                self.num_cars_travelling += 1
-                self.cost_board[car.position[0]][car.position[1]] += self.getCarCost(car)
+        next_position = queue[0].getNextPosition()
+        self._queue_next_positions[position] = next_position
+        if next_position not in self._next_position_queues:
+            self._next_position_queues[next_position] = []
+        self._next_position_queues[next_position].append(position)
 
     def isEnd(self):
         """
@@ -315,20 +745,57 @@ class GameState:
         """
         return self.config.high_cost * car.priority + 1 * (1 - car.priority)
 
-    def getCopy(self, position, num_iterations=2, centered=False):
-        cars = []
+    def getQueueCost(self, position):
+        """
+        Returns the total cost of the cars in the queue at position (see util.getQueueCost()).
+        """
+        return util.getQueueCost(self.board[position[0]][position[1]], self.config.high_cost)
 
+    def getStateKey(self, positions):
+        """
+        Returns a canonical, hashable key of the state of the queues at the provided positions. Two games with the same
+        key for a set of positions have the same travelling cars (up to car IDs) queued in the same order at those
+        positions. Cars that have arrived are left out, since they never move or accrue cost again.
+        :param positions: Iterable of (x,y) positions. Positions that are out of bounds are ignored.
+        :return: Tuple of (position, car state keys) tuples, one per queue with travelling cars, sorted by position.
+        """
+        key = []
+        for position in sorted(positions):
+            # Only the queues with travelling cars have a non-zero queue cost.
+            if self._queue_costs.get(position, 0) > 0:
+                car_keys = tuple([car.getStateKey() for car in self.board[position[0]][position[1]]
+                                  if not car.hasArrived()])
+                key.append((position, car_keys))
+        return tuple(key)
+
+    def getRolloutPositions(self, position, num_iterations=2, centered=False):
+        """
+        Returns the positions whose cars a look-ahead around position copies into a RolloutState (see
+        getRolloutState()): the positions within num_iterations of position, or if centered is True, the positions
+        (x + dx, y + dy) such that dx and dy are between 0 and num_iterations, and smaller than the board size minus 1.
+        """
         if centered:
-            for dx in xrange(max(-num_iterations, 0), min(num_iterations + 1, len(self.board) - 1)):
-                for dy in xrange(max(0, -num_iterations), min(num_iterations + 1, len(self.board[0]) - 1)):
-                    cars += self._getCarCopies((position[0] + dx, position[1] + dy))
-        else:
-            positions = util.getPositionsWithinDistance(position, num_iterations, centered)
-            for position in positions:
-                if util.isInBounds(position, self.board):
-                    cars += self._getCarCopies(position)
+            return [(position[0] + dx, position[1] + dy)
+                    for dx in xrange(max(-num_iterations, 0), min(num_iterations + 1, len(self.board) - 1))
+                    for dy in xrange(max(0, -num_iterations), min(num_iterations + 1, len(self.board[0]) - 1))]
+        return self.topology.getPositionsWithinDistance(position, num_iterations)
 
-        return GameState(self.config, 0, cars, init_new_trips=False)
+    def getRolloutState(self, positions):
+        """
+        Returns a RolloutState containing the cars at the provided positions, which can be simulated with RandomProtocol
+        much faster than this game (e.g. to look ahead at the effects of a decision).
+        :param positions: Iterable of (x,y) positions. Positions that are out of bounds are ignored.
+        :return: RolloutState instance.
+        """
+        rollout_state = RolloutState(self.config, self.topology)
+        height = self.config.height
+        for position in positions:
+            if self.topology.isInBounds(position):
+                cell = position[0] * height + position[1]
+                for car in self.board[position[0]][position[1]]:
+                    rollout_state.addCar(cell, car.priority, car.legs, car.leg_id, car.steps_left,
+                                         car.destination[0] * height + car.destination[1])
+        return rollout_state
 
     def printState(self, round_id, iteration_id):
         """
@@ -337,53 +804,5 @@ class GameState:
         :param iteration_id: Iteration ID number.
         """
         if util.VERBOSE >= 2:
-            print('State: round=%d\iteration=%d' % (round_id, iteration_id))
-            print('  ', end='')
-            for x in xrange(self.config.width):
-                if x % 4 == 3:
-                    print('n ', end='')
-                else:
-                    print('  ', end='')
-            print('')
-            for y in xrange(self.config.height):
-                if y % 4 == 3:
-                    print('<-', end='')
-                else:
-                    print('  ', end='')
-
-                for x in xrange(self.config.width):
-                    count = len(self.board[x][y])
-                    if x % 2 == 0 and y % 2 == 0:
-                        count_string = ' '
-                    elif count == 0:
-                        count_string = '.'
-                    else:
-                        count_string = str(count)
-                    print('%s ' % count_string, end='')
-
-                if y % 4 == 1:
-                    print('->', end='')
-                else:
-                    print('  ', end='')
-                print('')
-
-            print('  ', end='')
-            for x in xrange(self.config.width):
-                if x % 4 == 1:
-                    print('v ', end='')
-                else:
-                    print('  ', end='')
-            print('')
-
-
-    def _getCarCopies(self, position, max_num_cars=None):
-        if not util.isInBounds(position, self.board):
-            return []
-
-        cars = []
-        if max_num_cars is None:
-            max_num_cars = len(self.board[position[0]][position[1]])
-        for i in xrange(min(len(self.board[position[0]][position[1]]), max_num_cars)):
-            car = copy.deepcopy(self.board[position[0]][position[1]][i])
-            cars.append(car)
-        return cars
+            counts = [[len(queue) for queue in column] for column in self.board]
+            util.printBoardCounts(counts, round_id, iteration_id)
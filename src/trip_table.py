@@ -0,0 +1,244 @@
+import os
+import shutil
+import tempfile
+import numpy as np
+from car import DIRECTION_CODES, DIRECTION_NAMES
+
+# Version of the trips stored in a trip table. Increment it whenever the trips generated for the same scenario
+# parameters change, so that stale tables in a cache directory are not reused.
+TRIP_TABLE_VERSION = 2
+
+# Maximum number of legs in the route of a trip (see Configurer._getRandomRoute() and Configurer._getRandomTurnRoute()).
+MAX_NUM_LEGS = 2
+
+# Number of trips generated at a time when generating a trip table.
+GENERATE_BLOCK_SIZE = 1 << 18
+
+# Constants of the SplitMix64 pseudo-random number generator.
+SPLIT_MIX_64_GAMMA = np.uint64(0x9E3779B97F4A7C15)
+SPLIT_MIX_64_MULTIPLIER_0 = np.uint64(0xBF58476D1CE4E5B9)
+SPLIT_MIX_64_MULTIPLIER_1 = np.uint64(0x94D049BB133111EB)
+
+
+def splitMix64(values):
+    """
+    Returns the output of the SplitMix64 pseudo-random number generator for each state in an array. SplitMix64 is a
+    counter-based generator: the output only depends on the state, so any number of independent streams (e.g. one per
+    trip) can be drawn at once with vectorized operations.
+    :param values: Array of uint64 states. Arithmetic wraps around modulo 2**64.
+    :return: Array of uint64 pseudo-random numbers.
+    """
+    z = values + SPLIT_MIX_64_GAMMA
+    z = (z ^ (z >> np.uint64(30))) * SPLIT_MIX_64_MULTIPLIER_0
+    z = (z ^ (z >> np.uint64(27))) * SPLIT_MIX_64_MULTIPLIER_1
+    return z ^ (z >> np.uint64(31))
+
+
+def getUniforms(values):
+    """
+    Converts uint64 pseudo-random numbers to floats uniformly distributed in [0, 1), using their top 53 bits.
+    :param values: Array of uint64 pseudo-random numbers.
+    """
+    return (values >> np.uint64(11)).astype(np.float64) * (1.0 / (1 << 53))
+
+
+def getStraightTrips(sides, roads, priorities, width, height):
+    """
+    Builds the trip arrays of cars that start on a side of the board and go straight along a road to the opposite side,
+    with vectorized operations.
+    :param sides: Array of the starting side of each car: 0 = top, 1 = left, 2 = bottom, 3 = right.
+    :param roads: Array of the coordinate of each car's road along its starting side.
+    :param priorities: Array of the priority of each car.
+    :param width: Width of the board.
+    :param height: Height of the board.
+    :return: Dictionary of trip arrays with one entry per car (see TripTable).
+    """
+    side_starts = np.array([0, 0, height - 1, width - 1], dtype=np.int64)
+    side_ends = np.array([height - 1, width - 1, 0, 0], dtype=np.int64)
+    side_directions = np.array([DIRECTION_CODES['down'], DIRECTION_CODES['right'], DIRECTION_CODES['up'],
+                                DIRECTION_CODES['left']], dtype=np.int8)
+    side_steps = np.array([height - 1, width - 1, height - 1, width - 1], dtype=np.int32)
+
+    # Cars starting on the top or bottom travel vertically, so the road is their x coordinate. Cars starting on the left
+    # or right travel horizontally, so the road is their y coordinate.
+    num_trips = len(sides)
+    vertical = (sides % 2) == 0
+    starts = side_starts[sides]
+    ends = side_ends[sides]
+    trips = {'origins': np.empty((num_trips, 2), dtype=np.int32),
+             'destinations': np.empty((num_trips, 2), dtype=np.int32),
+             'num_legs': np.ones(num_trips, dtype=np.int8),
+             'leg_directions': np.zeros((num_trips, MAX_NUM_LEGS), dtype=np.int8),
+             'leg_steps': np.zeros((num_trips, MAX_NUM_LEGS), dtype=np.int32),
+             'priorities': priorities}
+    trips['origins'][:, 0] = np.where(vertical, roads, starts)
+    trips['origins'][:, 1] = np.where(vertical, starts, roads)
+    trips['destinations'][:, 0] = np.where(vertical, roads, ends)
+    trips['destinations'][:, 1] = np.where(vertical, ends, roads)
+    trips['leg_directions'][:, 0] = side_directions[sides]
+    trips['leg_steps'][:, 0] = side_steps[sides]
+    return trips
+
+
+def getTripTuples(trips):
+    """
+    Converts the arrays of a block of trips to Python values.
+    :param trips: Dictionary of trip arrays with one entry per trip (see TripTable).
+    :return: List of (origin, destination, route, priority) tuples in the format of Configurer.getNextCarTrip().
+    """
+    trip_tuples = []
+    for origin, destination, num_legs, leg_directions, leg_steps, priority in \
+            zip(trips['origins'].tolist(), trips['destinations'].tolist(), trips['num_legs'].tolist(),
+                trips['leg_directions'].tolist(), trips['leg_steps'].tolist(), trips['priorities'].tolist()):
+        route = [[DIRECTION_NAMES[direction], num_steps]
+                 for direction, num_steps in zip(leg_directions[:num_legs], leg_steps[:num_legs])]
+        trip_tuples.append((tuple(origin), tuple(destination), route, priority))
+    return trip_tuples
+
+
+def getTripArrays(trip_tuples):
+    """
+    Converts a list of trips to arrays (the inverse of getTripTuples()).
+    :param trip_tuples: List of (origin, destination, route, priority) tuples.
+    :return: Dictionary of trip arrays with one entry per trip (see TripTable).
+    """
+    num_trips = len(trip_tuples)
+    trips = {'origins': np.zeros((num_trips, 2), dtype=np.int32),
+             'destinations': np.zeros((num_trips, 2), dtype=np.int32),
+             'num_legs': np.zeros(num_trips, dtype=np.int8),
+             'leg_directions': np.zeros((num_trips, MAX_NUM_LEGS), dtype=np.int8),
+             'leg_steps': np.zeros((num_trips, MAX_NUM_LEGS), dtype=np.int32),
+             'priorities': np.zeros(num_trips, dtype=np.int8)}
+    for i, (origin, destination, route, priority) in enumerate(trip_tuples):
+        trips['origins'][i] = origin
+        trips['destinations'][i] = destination
+        trips['num_legs'][i] = len(route)
+        for leg_id, (direction, num_steps) in enumerate(route):
+            trips['leg_directions'][i, leg_id] = DIRECTION_CODES[direction]
+            trips['leg_steps'][i, leg_id] = num_steps
+        trips['priorities'][i] = priority
+    return trips
+
+
+class TripTable(object):
+    """
+    Trips of every car in every round of a simulation, stored as arrays in .npy files in a directory of a cache
+    directory. The trips of a scenario are generated once, and every later run, process and protocol with the same
+    scenario parameters memory-maps the same files, so the trips are shared without being regenerated or copied.
+
+    The arrays are indexed by [round_id, car_id]:
+    * origins, destinations: (x, y) coordinates of the start and end of the trip.
+    * num_legs: Number of legs in the route.
+    * leg_directions, leg_steps: Direction code (see car.DIRECTION_CODES) and number of steps of each leg of the route.
+      Unused legs have 0 steps.
+    * priorities: Priority of the car (0 or 1).
+    """
+    ARRAY_NAMES = ('origins', 'destinations', 'num_legs', 'leg_directions', 'leg_steps', 'priorities')
+
+    def __init__(self, path):
+        """
+        :param path: Pathname of the directory storing the arrays of the table.
+        """
+        self.path = path
+        self._load()
+
+    def __getstate__(self):
+        # Pickle the pathname instead of the arrays, so that worker processes memory-map the files themselves.
+        return {'path': self.path}
+
+    def __setstate__(self, state):
+        self.path = state['path']
+        self._load()
+
+    def _load(self):
+        """
+        Memory-maps the arrays of the table.
+        """
+        for name in self.ARRAY_NAMES:
+            setattr(self, name, np.load(os.path.join(self.path, name + '.npy'), mmap_mode='r'))
+        self.num_rounds, self.num_cars = self.priorities.shape
+
+    def getTrips(self, round_ids, car_ids):
+        """
+        Returns the trips of a block of cars by indexing the arrays of the table directly.
+        :param round_ids: Array of the round ID of each trip.
+        :param car_ids: Array of the car ID of each trip.
+        :return: Dictionary of trip arrays with one entry per trip.
+        """
+        return dict((name, getattr(self, name)[round_ids, car_ids]) for name in self.ARRAY_NAMES)
+
+    @staticmethod
+    def load(cache_dir, random_seed, num_cars, num_roads, num_rounds, high_priority_probability, getTrips):
+        """
+        Returns the trip table of a scenario from a cache directory, generating it first if it is not cached yet.
+        :param cache_dir: Pathname of the cache directory, which is created if it does not exist.
+        :param random_seed: Random seed of the scenario.
+        :param num_cars: Number of cars in the scenario.
+        :param num_roads: Number of roads in each direction.
+        :param num_rounds: Number of rounds in the scenario.
+        :param high_priority_probability: Probability that a car is high priority.
+        :param getTrips: Function that generates the trips of a block of cars, given arrays of their round IDs and car
+         IDs, as a dictionary of trip arrays (see Configurer.getCarTrips()). Each trip must not depend on anything but
+         its round ID, car ID and the scenario parameters.
+        :return: TripTable instance.
+        """
+        path = os.path.join(cache_dir, 'trips_v%d_seed%d_cars%d_roads%d_rounds%d_p%r' %
+                            (TRIP_TABLE_VERSION, random_seed, num_cars, num_roads, num_rounds,
+                             high_priority_probability))
+        if not os.path.isdir(path):
+            TripTable._generate(path, num_cars, num_rounds, getTrips)
+        return TripTable(path)
+
+    @staticmethod
+    def _generate(path, num_cars, num_rounds, getTrips):
+        """
+        Generates the trips of a scenario into the directory path. The arrays are written to memory-mapped files in a
+        temporary directory, a block of rounds at a time. The temporary directory is then renamed to path, so that
+        processes that generate the same table concurrently never read a partially written table.
+        :param path: Pathname of the directory of the table.
+        :param num_cars: Number of cars in the scenario.
+        :param num_rounds: Number of rounds in the scenario.
+        :param getTrips: See load().
+        """
+        cache_dir = os.path.dirname(path)
+        if cache_dir and not os.path.isdir(cache_dir):
+            try:
+                os.makedirs(cache_dir)
+            except OSError:
+                if not os.path.isdir(cache_dir):
+                    raise
+        temp_path = tempfile.mkdtemp(dir=cache_dir)
+        try:
+            shape = (num_rounds, num_cars)
+            arrays = {'origins': (np.int32, shape + (2,)),
+                      'destinations': (np.int32, shape + (2,)),
+                      'num_legs': (np.int8, shape),
+                      'leg_directions': (np.int8, shape + (MAX_NUM_LEGS,)),
+                      'leg_steps': (np.int32, shape + (MAX_NUM_LEGS,)),
+                      'priorities': (np.int8, shape)}
+            for name, (dtype, array_shape) in arrays.iteritems():
+                arrays[name] = np.lib.format.open_memmap(os.path.join(temp_path, name + '.npy'), mode='w+',
+                                                         dtype=dtype, shape=array_shape)
+
+            block_num_rounds = max(1, GENERATE_BLOCK_SIZE / max(1, num_cars))
+            for start_round_id in xrange(0, num_rounds, block_num_rounds):
+                end_round_id = min(start_round_id + block_num_rounds, num_rounds)
+                round_ids = np.repeat(np.arange(start_round_id, end_round_id), num_cars)
+                car_ids = np.tile(np.arange(num_cars), end_round_id - start_round_id)
+                trips = getTrips(round_ids, car_ids)
+                for name in TripTable.ARRAY_NAMES:
+                    arrays[name][start_round_id:end_round_id] = \
+                        trips[name].reshape((end_round_id - start_round_id, num_cars) + trips[name].shape[1:])
+            for array in arrays.itervalues():
+                array.flush()
+            del arrays
+
+            os.rename(temp_path, path)
+        except OSError:
+            # Another process finished generating the same table first.
+            shutil.rmtree(temp_path, ignore_errors=True)
+            if not os.path.isdir(path):
+                raise
+        except:
+            shutil.rmtree(temp_path, ignore_errors=True)
+            raise
@@ -1,9 +1,27 @@
 import os
+import sys
+from collections import OrderedDict
 from protocol import *
 from car import *
 
 VERBOSE = False
 
+# Protocol classes by name, in the order in which they are listed (e.g. by benchmark.py).
+PROTOCOL_CLASSES = OrderedDict([('random', RandomProtocol),
+                                ('vcg', VCGProtocol),
+                                ('button', ButtonProtocol),
+                                ('greedy', GreedyProtocol),
+                                ('generalized_greedy_0', GeneralizedGreedyProtocol0),
+                                ('generalized_greedy_2', GeneralizedGreedyProtocol2),
+                                ('generalized_greedy_4', GeneralizedGreedyProtocol4),
+                                ('generalized_greedy_6', GeneralizedGreedyProtocol6),
+                                ('generalized_greedy_8', GeneralizedGreedyProtocol8),
+                                ('random_greedy', RandomGreedyProtocol),
+                                ('monte_carlo_greedy', MonteCarloGreedy)])
+
+# Names accepted by getProtocolClass().
+PROTOCOL_CLASS_NAMES = tuple(PROTOCOL_CLASSES.keys())
+
 def getProtocolClass(protocol_class_name):
     """
     Returns the *class* of a protocol.
@@ -11,28 +29,8 @@ def getProtocolClass(protocol_class_name):
     if protocol_class_name is None:
         raise Exception('Must specify a protocol class name.')
     protocol_class_name = protocol_class_name.lower()
-    if protocol_class_name == 'random':
-        return RandomProtocol
-    if protocol_class_name == 'vcg':
-        return VCGProtocol
-    if protocol_class_name == 'button':
-        return ButtonProtocol
-    if protocol_class_name == 'greedy':
-        return GreedyProtocol
-    if protocol_class_name == 'generalized_greedy_0':
-        return GeneralizedGreedyProtocol0
-    if protocol_class_name == 'generalized_greedy_2':
-        return GeneralizedGreedyProtocol2
-    if protocol_class_name == 'generalized_greedy_4':
-        return GeneralizedGreedyProtocol4
-    if protocol_class_name == 'generalized_greedy_6':
-        return GeneralizedGreedyProtocol6
-    if protocol_class_name == 'generalized_greedy_8':
-        return GeneralizedGreedyProtocol8
-    if protocol_class_name == 'random_greedy':
-        return RandomGreedyProtocol
-    if protocol_class_name == 'monte_carlo_greedy':
-        return MonteCarloGreedy
+    if protocol_class_name in PROTOCOL_CLASSES:
+        return PROTOCOL_CLASSES[protocol_class_name]
     raise Exception('Unrecognized protocol class name: %s' % protocol_class_name)
 
 def getCarClass(car_class_name):
@@ -80,6 +78,74 @@ def fixedCostToHighCost(fixed_cost):
 def highCostToFixedCost(high_cost):
     return 1.0 / (high_cost - 1)
 
+def getQueueColor(cost, cost_cutoff):
+    """
+    Returns the colour in which animations draw a queue: a shade of blue that darkens as the cost of the queue grows.
+    :param cost: Total cost of the cars in the queue.
+    :param cost_cutoff: Cost at and above which queues have the darkest shade.
+    :return: (red, green, blue) tuple of ints in [0, 255].
+    """
+    return 0, 0, 255 - int(min(1, float(cost) / cost_cutoff) * 200)
+
+class TranspositionTable(object):
+    """
+    Bounded cache of values computed for game states, keyed by a canonical key of the state (see
+    GameState.getStateKey()). Once the table is full, the least recently used entry is evicted. The table also counts
+    hits and misses, in order to report its hit rate.
+    """
+
+    def __init__(self, max_size):
+        """
+        :param max_size: Maximum number of entries in the table. If 0, no values are stored.
+        """
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.num_hits = 0
+        self.num_misses = 0
+
+    def get(self, key):
+        """
+        Returns the value stored for the provided key, or None if there is no such value.
+        """
+        value = self.entries.pop(key, None)
+        if value is None:
+            self.num_misses += 1
+            return None
+
+        # Re-insert the entry to mark it as the most recently used one.
+        self.num_hits += 1
+        self.entries[key] = value
+        return value
+
+    def put(self, key, value):
+        """
+        Stores the value for the provided key, evicting the least recently used entry if the table is full.
+        """
+        if self.max_size <= 0:
+            return
+        self.entries[key] = value
+        if len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        """
+        Removes all the entries. The hits and misses are still counted across calls.
+        """
+        self.entries.clear()
+
+    def getHitRate(self):
+        """
+        Returns the fraction of lookups that found a value (0 if there were no lookups).
+        """
+        num_lookups = self.num_hits + self.num_misses
+        if num_lookups == 0:
+            return 0.0
+        return float(self.num_hits) / num_lookups
+
+    def __str__(self):
+        return 'Hits: %d\tMisses: %d\tHit rate: %.3f\tEntries: %d' % \
+               (self.num_hits, self.num_misses, self.getHitRate(), len(self.entries))
+
 ##################
 # Board helpers. #
 ##################
@@ -87,6 +153,53 @@ def highCostToFixedCost(high_cost):
 # Street ids 1, 5, 9, etc. go down/right.
 # Street ids 3, 7, 11, etc. go up/left.
 
+def printBoardCounts(counts, round_id, iteration_id):
+    """
+    Prints the number of cars at each position in the board.
+    :param counts: List of lists, whose value at (x,y) is the number of cars at that position.
+    :param round_id: Round ID number.
+    :param iteration_id: Iteration ID number.
+    """
+    width = len(counts)
+    height = len(counts[0])
+    sys.stdout.write('State: round=%d\\iteration=%d\n' % (round_id, iteration_id))
+    sys.stdout.write('  ')
+    for x in xrange(width):
+        if x % 4 == 3:
+            sys.stdout.write('n ')
+        else:
+            sys.stdout.write('  ')
+    sys.stdout.write('\n')
+    for y in xrange(height):
+        if y % 4 == 3:
+            sys.stdout.write('<-')
+        else:
+            sys.stdout.write('  ')
+
+        for x in xrange(width):
+            count = counts[x][y]
+            if x % 2 == 0 and y % 2 == 0:
+                count_string = ' '
+            elif count == 0:
+                count_string = '.'
+            else:
+                count_string = str(count)
+            sys.stdout.write('%s ' % count_string)
+
+        if y % 4 == 1:
+            sys.stdout.write('->')
+        else:
+            sys.stdout.write('  ')
+        sys.stdout.write('\n')
+
+    sys.stdout.write('  ')
+    for x in xrange(width):
+        if x % 4 == 1:
+            sys.stdout.write('v ')
+        else:
+            sys.stdout.write('  ')
+    sys.stdout.write('\n')
+
 def getPositionDirection(position):
     x, y = position
     if x % 4 == 1:
@@ -183,6 +296,69 @@ def addPositionsWithinDistanceRec(position, distance, positions):
     addPositionsWithinDistanceRec(prev_position, distance - 2, positions)
     addPositionsWithinDistanceRec(competing_position, distance - 2, positions)
 
+class Topology(object):
+    """
+    Lookup tables of the structure of a board with the given size, which replace the arithmetic of the board helpers
+    above in hot paths. Each table is a dictionary whose key is an (x,y) position in the board. Use getTopology() to get
+    the instance shared by all games on a board of a given size.
+    """
+
+    def __init__(self, width, height):
+        self.width = width
+        self.height = height
+
+        # Initialize the tables:
+        # * directions: Value is the (dx, dy) direction of the road at the position.
+        # * next_positions: Value is the position one step ahead on the road.
+        # * upcoming_queues: Value is the position of the next queue on the road (past the upcoming intersection).
+        # * competing_positions: Value is the position that competes with the position for the upcoming intersection.
+        # * intersections: Value is True if the position is an intersection.
+        self.directions = {}
+        self.next_positions = {}
+        self.upcoming_queues = {}
+        self.competing_positions = {}
+        self.intersections = {}
+        for x in xrange(self.width):
+            for y in xrange(self.height):
+                position = (x, y)
+                self.directions[position] = getPositionDirection(position)
+                self.next_positions[position] = getNextPosition(position)
+                self.upcoming_queues[position] = getUpcomingQueue(position)
+                self.competing_positions[position] = getCompetingPosition(position)
+                self.intersections[position] = isIntersection(position)
+
+        # Cache of getPositionsWithinDistance(). Key is a (position, distance) tuple.
+        self._positions_within_distance = {}
+
+    def isInBounds(self, position):
+        return 0 <= position[0] < self.width and 0 <= position[1] < self.height
+
+    def getPositionsWithinDistance(self, position, distance):
+        """
+        Returns a tuple of the in-bounds positions returned by util.getPositionsWithinDistance(), in the same order.
+        The tuple is computed once per (position, distance) pair, and shared between callers.
+        """
+        key = (position, distance)
+        positions = self._positions_within_distance.get(key)
+        if positions is None:
+            positions = tuple([curr_position for curr_position in getPositionsWithinDistance(position, distance, False)
+                               if self.isInBounds(curr_position)])
+            self._positions_within_distance[key] = positions
+        return positions
+
+# Cache of the topology of each board size. Key is a (width, height) tuple.
+_topologies = {}
+
+def getTopology(width, height):
+    """
+    Returns the Topology of a board with the provided size, which is built the first time it is requested.
+    """
+    topology = _topologies.get((width, height))
+    if topology is None:
+        topology = Topology(width, height)
+        _topologies[(width, height)] = topology
+    return topology
+
 def getQueueCost(queue, high_cost):
     # if isDestination(x, y, board):
     #     raise Exception('Attempting to get the queue cost for a destination position.')